@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Check cosmic ray rejection by stack comparison on synthetic exposures.
+
+Usage:
+
+    python benchmarks/crstack_seeing.py [--snoise S] [--ncr N]
+
+Three exposures of a slit with a bright object, taken with different
+seeing (FWHM of 2.0, 2.3 and 2.7 pixels) and with sky lines whose
+strength changes by 10% between exposures, are compared with
+`crstack.find_outliers`. Without cosmic rays no pixel should be
+flagged; `--ncr` cosmic rays are then added to the exposures, and most
+of them should be found. Exits with status 1 if clean pixels are
+flagged or fewer than 90% of the cosmic rays are found.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import sys
+
+import numpy as np
+
+from pygmos.spectroscopy.crstack import find_outliers
+
+GAIN = 2.
+RDNOISE = 3.5
+
+
+def exposures(fwhm=(2.0, 2.3, 2.7), ny=41, nx=600, peak=3000.,
+              sky=200., seed=1):
+    """Noisy exposures of a slit, in ADU, and their noiseless models"""
+    rng = np.random.RandomState(seed)
+    y = np.arange(ny) - ny // 2
+    x = np.arange(nx)
+    continuum = 0.5 + 0.5 * np.sin(x / 50.)**2
+    lines = np.zeros(nx)
+    lines[rng.choice(nx, 15, replace=False)] = rng.uniform(500, 5000, 15)
+    models = []
+    for i, f in enumerate(fwhm):
+        sigma = f / 2.3548
+        # same total flux: the peak changes with the seeing
+        profile = np.exp(-0.5 * (y/sigma)**2) / (sigma * np.sqrt(2*np.pi))
+        obj = peak * 2. * profile[:, None] * continuum[None]
+        skylines = (1 + 0.1 * (i - 1)) * lines
+        models.append(obj + sky + skylines[None])
+    models = np.array(models)
+    stack = rng.poisson(models * GAIN) / GAIN \
+        + rng.normal(0, RDNOISE / GAIN, models.shape)
+    return stack, models
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--snoise', type=float, default=0.1)
+    parser.add_argument('--ncr', type=int, default=200)
+    args = parser.parse_args()
+    n = 3
+    gain = [GAIN] * n
+    rdnoise = [RDNOISE] * n
+    stack, models = exposures()
+    model, crmask = find_outliers(
+        stack, gain, rdnoise, snoise=args.snoise)
+    clean = np.where(crmask, model, stack)
+    flux = stack.sum(axis=(1, 2))
+    print('Clean exposures (snoise={0}):'.format(args.snoise))
+    for i in range(n):
+        print('  exposure {0}: {1} pixels flagged, flux changed by' \
+              ' {2:.3%}'.format(
+                  i+1, crmask[i].sum(),
+                  (clean[i].sum() - flux[i]) / flux[i]))
+    nfalse = crmask.sum()
+    # cosmic rays of 100 to 5000 ADU on single pixels
+    rng = np.random.RandomState(2)
+    index = tuple(rng.randint(0, size, args.ncr) for size in stack.shape)
+    hits = stack.copy()
+    hits[index] += rng.uniform(100, 5000, args.ncr)
+    model, crmask = find_outliers(hits, gain, rdnoise, snoise=args.snoise)
+    found = crmask[index].mean()
+    print('{0:.1%} of {1} cosmic rays found'.format(found, args.ncr))
+    if nfalse or found < 0.9:
+        print('FAILED')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
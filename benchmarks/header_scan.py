@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the inventory header scanner against astropy's getheader.
+
+Usage:
+
+    python benchmarks/header_scan.py <directory> [--generate N] [--gzip]
+
+With --generate, N synthetic GMOS-like frames are first written to
+<directory> (which should then be an empty scratch directory).
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+from glob import glob
+from time import time
+
+import numpy as np
+from astropy.io import fits
+from astropy.io.fits import getheader
+
+from pygmos.inventory.fitsscan import read_keywords
+from pygmos.inventory.headerindex import KEYWORDS
+
+
+def generate(path, nframes, compress=False):
+    """Write `nframes` three-amplifier frames with realistic headers"""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    data = np.zeros((512, 256), dtype=np.int16)
+    for i in range(nframes):
+        head = fits.Header()
+        for j in range(150):
+            head['DUMMY{0:03d}'.format(j)] = (j, 'padding keyword')
+        head['GEMPRGID'] = 'GS-2012A-Q-1'
+        head['MASKNAME'] = 'GS2012AQ001-{0:02d}'.format(i % 10)
+        head['OBSCLASS'] = 'science'
+        head['OBJECT'] = 'target{0}'.format(i % 7)
+        head['OBSID'] = 'GS-2012A-Q-1-{0}'.format(i % 20)
+        head['CENTWAVE'] = 670.0
+        head['EXPTIME'] = 900.0
+        head['OBSTYPE'] = 'OBJECT'
+        hdul = fits.HDUList(
+            [fits.PrimaryHDU(header=head)]
+            + [fits.ImageHDU(data) for amp in range(3)])
+        name = os.path.join(path, 'S20120301S{0:04d}.fits'.format(i))
+        if compress:
+            name += '.gz'
+        hdul.writeto(name, overwrite=True)
+    return
+
+
+def with_astropy(files):
+    headers = []
+    for filename in files:
+        head = getheader(filename)
+        headers.append(
+            dict((key, head[key]) for key in KEYWORDS if key in head))
+    return headers
+
+
+def with_scanner(files):
+    return [read_keywords(filename, KEYWORDS) for filename in files]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('path')
+    parser.add_argument('--generate', type=int, default=0)
+    parser.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+    if args.generate:
+        generate(args.path, args.generate, args.gzip)
+    files = sorted(glob(os.path.join(args.path, '*.fits*')))
+    print('{0} files in {1}'.format(len(files), args.path))
+    results = {}
+    for name, func in (('getheader', with_astropy),
+                       ('fitsscan', with_scanner)):
+        to = time()
+        results[name] = func(files)
+        dt = time() - to
+        print('{0:<10s} {1:8.2f} s  {2:10.1f} files/s'.format(
+            name, dt, len(files) / dt))
+    assert results['getheader'] == results['fitsscan'], \
+        'fitsscan and getheader disagree'
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Read raw frames directly from (compressed) tar archives.
+
+Data downloaded from the Gemini archive come as tar (or tar.bz2)
+bundles of individually compressed frames. Instead of extracting the
+whole bundle, the inventory streams through the tar members reading
+only their primary headers, and later extracts (and decompresses) only
+the members needed to reduce the chosen object.
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import bz2
+import gzip
+import io
+import logging
+import os
+import shutil
+import tarfile
+from fnmatch import fnmatch
+try:
+    from astropy.io.fits import getheader
+except ImportError:
+    from pyfits import getheader
+
+from .fitsscan import UnusualHeader, read_keywords
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.bz2', '.tbz', '.tbz2', '.tar.gz', '.tgz')
+# separates the archive name from the member name in the header index
+SEP = '::'
+
+
+def is_archive(path):
+    """Whether `path` is a tar archive"""
+    return os.path.isfile(path) \
+        and path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def uncompressed_name(name):
+    """Name of a member once decompressed, without its path"""
+    name = os.path.basename(name)
+    for ext in ('.bz2', '.gz'):
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+class _Bz2Stream(object):
+
+    """Minimal file-like bzip2 decompressor for non-seekable streams"""
+
+    def __init__(self, fileobj, chunk=65536):
+        self._fileobj = fileobj
+        self._decompressor = bz2.BZ2Decompressor()
+        self._buffer = b''
+        self._chunk = chunk
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            if self._decompressor.unused_data:
+                break
+            data = self._fileobj.read(self._chunk)
+            if not data:
+                break
+            self._buffer += self._decompressor.decompress(data)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class _Recorder(object):
+
+    """Keep a copy of everything read from a stream"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.data = io.BytesIO()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.data.write(data)
+        return data
+
+
+def _open_member(tar, member):
+    """Uncompressed stream of a tar member"""
+    f = tar.extractfile(member)
+    name = member.name.lower()
+    if name.endswith('.bz2'):
+        return _Bz2Stream(f)
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    return f
+
+
+def members(archive, pattern='*.fits*'):
+    """Iterate over the FITS members of an archive
+
+    Yields
+    ------
+    tar : `tarfile.TarFile`
+        the open archive, read as a stream
+    member : `tarfile.TarInfo`
+        the member
+
+    """
+    tar = tarfile.open(archive, 'r|*')
+    try:
+        for member in tar:
+            if member.isfile() \
+                    and fnmatch(os.path.basename(member.name), pattern):
+                yield tar, member
+    finally:
+        tar.close()
+
+
+def scan(archive, keywords):
+    """Read primary header keywords of all FITS members of an archive
+
+    Yields
+    ------
+    member : `tarfile.TarInfo`
+        the tar member
+    head : dict
+        the requested keywords present in its primary header
+
+    """
+    for tar, member in members(archive):
+        # archives are read as streams, so we cannot go back to the
+        # beginning of the member if astropy is needed
+        stream = _Recorder(_open_member(tar, member))
+        try:
+            head = read_keywords(member.name, keywords, fileobj=stream)
+        except UnusualHeader as err:
+            logger.debug('Reading {0} with astropy ({1})'.format(
+                member.name, err))
+            # the rest of the member is kept in `stream.data`
+            stream.read()
+            stream.data.seek(0)
+            head = getheader(stream.data)
+            head = dict((key, head[key]) for key in keywords if key in head)
+        yield member, head
+
+
+def extract(archive, names, outdir='./'):
+    """Extract and decompress selected members of an archive
+
+    Members are written to `outdir` without their internal path and
+    compression extension. Members already extracted are not written
+    again, and the archive is only read up to the last requested
+    member.
+
+    Parameters
+    ----------
+    archive : str
+        tar archive
+    names : list of str
+        member names, as stored in the archive
+
+    Returns
+    -------
+    extracted : list of str
+        paths to the extracted files
+
+    """
+    pending = set(names)
+    extracted = []
+    if not pending:
+        return extracted
+    archive_members = members(archive)
+    try:
+        for tar, member in archive_members:
+            if member.name not in pending:
+                continue
+            pending.remove(member.name)
+            output = os.path.join(outdir, uncompressed_name(member.name))
+            if os.path.isfile(output) \
+                    and os.path.getmtime(output) >= member.mtime:
+                logger.debug('{0} already extracted'.format(output))
+            else:
+                print('Extracting {0} from {1}'.format(member.name, archive))
+                stream = _open_member(tar, member)
+                with open(output, 'wb') as out:
+                    shutil.copyfileobj(stream, out)
+            extracted.append(output)
+            if not pending:
+                break
+    finally:
+        archive_members.close()
+    if pending:
+        logger.warning('Members not found in {0}: {1}'.format(
+            archive, ', '.join(sorted(pending))))
+    return extracted
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory association between science frames and their calibrations.
+
+An `Association` is built once by the inventory and passed through the
+reduction, so that looking up the flat or arc of a science frame does
+not require reading the ``.assoc`` file again. The ``.assoc`` file is
+still written for inspection by the user and can be read back with
+`Association.read` (e.g., for ``--read-inventory``).
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+# wavelengths are stored as in the .assoc file, i.e., in Angstrom
+Exposure = namedtuple(
+    'Exposure', ('obsid', 'mask', 'wave', 'exptime', 'science', 'flat', 'arc'))
+
+HEADER = '{0:<16s}  {1:<15s}  {2:<5s}  {3:<5s}  {4:<14s}  {5:<14s}' \
+         '  {6:<14s}'.format(
+             'ObservationID', 'Mask', 'Wave', 'Time', 'Science', 'Flat', 'Arc')
+ROW = '{0}  {1:<14s}  {2:5d}  {3:5d}  {4:<14s}  {5:<14s}  {6:<14s}'
+
+
+class Association(object):
+
+    """Science frames of an object and their associated calibrations
+
+    Parameters
+    ----------
+    obj : str
+        object name
+    exposures : list, optional
+        [obsid, mask, wave, exptime, science, flat, arc] entries. The
+        central wavelength is given in Angstrom and the file names
+        without path or extension.
+
+    """
+
+    def __init__(self, obj, exposures=()):
+        self.obj = obj
+        self.exposures = [Exposure(*exp) for exp in exposures]
+        self._by_mask = {}
+        self._by_science = {}
+        self._masks = []
+        self._waves = []
+        for exp in self.exposures:
+            if exp.mask not in self._by_mask:
+                self._by_mask[exp.mask] = []
+                self._masks.append(exp.mask)
+            self._by_mask[exp.mask].append(exp)
+            self._by_science[(exp.mask, exp.wave, exp.science)] = exp
+            if exp.wave not in self._waves:
+                self._waves.append(exp.wave)
+
+    def __len__(self):
+        return len(self.exposures)
+
+    def __iter__(self):
+        return iter(self.exposures)
+
+    @classmethod
+    def from_inventory(cls, obj, exp):
+        """Create from the output of `inventory.find_exposures`
+
+        Here, the central wavelength is given in nm and file names may
+        include their paths.
+
+        """
+        exposures = [
+            [e[0], e[1], int(10*e[2]), int(e[3])]
+            + [name.split('/')[-1] for name in e[4:7]]
+            for e in exp]
+        return cls(obj, exposures)
+
+    @classmethod
+    def read(cls, filename, obj=None):
+        """Read an association (``.assoc``) file"""
+        exposures = []
+        with open(filename) as f:
+            for line in f:
+                if line[0] == '#' or line[:13] == 'ObservationID':
+                    continue
+                line = line.split()
+                if len(line) < 7:
+                    continue
+                exposures.append(
+                    line[:2] + [int(line[2]), int(line[3])] + line[4:7])
+        if obj is None:
+            obj = filename.replace('.assoc', '').replace('_', ' ')
+        return cls(obj, exposures)
+
+    def write(self, filename, verbose=True):
+        """Write the association to a text file"""
+        with open(filename, 'w') as out:
+            print(HEADER, file=out)
+            if verbose:
+                print(HEADER)
+            for exp in self.exposures:
+                msg = ROW.format(*exp)
+                print(msg, file=out)
+                if verbose:
+                    print(msg)
+        return filename
+
+    @property
+    def masks(self):
+        """Mask names, in the order in which they were found"""
+        return list(self._masks)
+
+    @property
+    def wavelengths(self):
+        """Central wavelengths (in Angstrom) used in all masks"""
+        return list(self._waves)
+
+    def science_files(self, mask):
+        """Dictionary of {science: wave} for a given mask"""
+        return dict((exp.science, exp.wave)
+                    for exp in self._by_mask.get(mask, []))
+
+    def get_file(self, science, mask=1, obs='science', wave=670):
+        """Name of the science, flat or arc file for a science frame
+
+        Returns None if `science` is not part of the association.
+
+        """
+        if mask == 'longslit':
+            exp = [exp for exp in self.exposures
+                   if exp.wave == wave and exp.science == science]
+            exp = exp[0] if exp else None
+        else:
+            exp = self._by_science.get((mask, wave, science))
+        if exp is None:
+            return
+        if obs == 'science':
+            return exp.science
+        if obs == 'flat':
+            return exp.flat
+        if obs == 'arc' or obs == 'lamp':
+            return exp.arc
+        print('Unknown observation type in get_file(). Exiting')
+        sys.exit()
+
+    def get_file_longslit(self, obs='science', wave=670):
+        """Files of type `obs` observed at central wavelength `wave`"""
+        return np.array([getattr(exp, obs) for exp in self.exposures
+                         if exp.wave == wave])
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Fast reader for a handful of keywords in a FITS primary header.
+
+The inventory only needs a few keywords from the primary header of each
+raw frame. Instead of building a full `astropy.io.fits.Header`, this
+module reads the header 2880-byte block by block, picks up the requested
+cards and stops at END. Plain (and fpack-compressed, whose primary
+header is not compressed) files are memory-mapped, while gzip and bzip2
+files are decompressed as a stream, so only the header blocks are ever
+decompressed.
+
+Anything unusual (non-standard first card, long-string CONTINUE cards,
+complex or undefined values, truncated headers) is handed over to
+`astropy.io.fits.getheader`.
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import bz2
+import gzip
+import logging
+import mmap
+import os
+try:
+    from astropy.io.fits import getheader
+except ImportError:
+    from pyfits import getheader
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 2880
+CARD = 80
+# give up (and use astropy) if END is not found within this many blocks
+MAX_BLOCKS = 100
+
+
+class UnusualHeader(Exception):
+    """Raised when a header must be read with astropy instead"""
+    pass
+
+
+def read_keywords(filename, keywords, fileobj=None):
+    """Read the values of `keywords` from the primary header
+
+    Parameters
+    ----------
+    filename : str
+        name of the FITS file. Compression is inferred from the
+        extension (``.gz``, ``.bz2``; ``.fz`` files are read as plain
+        files).
+    keywords : list of str
+        header keywords to read
+    fileobj : file-like, optional
+        already opened (uncompressed) stream positioned at the start of
+        the FITS file, e.g. a member of a tar archive. If given,
+        `filename` is only used to report errors.
+
+    Returns
+    -------
+    head : dict
+        keyword-value pairs for the requested keywords that are present
+        in the header
+
+    """
+    try:
+        if fileobj is not None:
+            return _scan_stream(fileobj, keywords)
+        return _scan_file(filename, keywords)
+    except (UnusualHeader, ValueError, EnvironmentError) as err:
+        if fileobj is not None:
+            raise UnusualHeader('{0}: {1}'.format(filename, err))
+        logger.debug('Reading {0} with astropy ({1})'.format(filename, err))
+        head = getheader(filename)
+        return dict((key, head[key]) for key in keywords if key in head)
+
+
+def _scan_file(filename, keywords):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.gz':
+        with gzip.open(filename, 'rb') as f:
+            return _scan_stream(f, keywords)
+    if ext == '.bz2':
+        with bz2.BZ2File(filename, 'rb') as f:
+            return _scan_stream(f, keywords)
+    with open(filename, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _scan_blocks(
+                (buf[i:i+BLOCK] for i in range(0, len(buf), BLOCK)),
+                keywords)
+        finally:
+            buf.close()
+
+
+def _scan_stream(f, keywords):
+    def blocks():
+        while True:
+            block = f.read(BLOCK)
+            if not block:
+                return
+            yield block
+    return _scan_blocks(blocks(), keywords)
+
+
+def _scan_blocks(blocks, keywords):
+    """Parse 2880-byte blocks until END, keeping `keywords` only"""
+    wanted = set(keywords)
+    head = {}
+    last = None
+    for nblock, block in enumerate(blocks):
+        if len(block) < BLOCK:
+            raise UnusualHeader('truncated header block')
+        if nblock == MAX_BLOCKS:
+            raise UnusualHeader('END not found')
+        block = block.decode('ascii')
+        if nblock == 0 and (not block.startswith('SIMPLE  =')
+                            or block[29] != 'T'):
+            raise UnusualHeader('not a standard primary header')
+        for i in range(0, BLOCK, CARD):
+            card = block[i:i+CARD]
+            key = card[:8].rstrip()
+            if key == 'END':
+                return head
+            if key == 'CONTINUE' and last is not None:
+                raise UnusualHeader('long string in {0}'.format(last))
+            last = None
+            if key in wanted and card[8:10] == '= ':
+                head[key] = _parse_value(card[10:])
+                last = key
+    raise UnusualHeader('END not found')
+
+
+def _parse_value(value):
+    """Parse the value field of a fixed-format card"""
+    value = value.strip()
+    if value.startswith("'"):
+        # doubled quotes are escaped quotes
+        i = 1
+        while True:
+            i = value.find("'", i)
+            if i == -1:
+                raise UnusualHeader('unterminated string')
+            if value[i+1:i+2] == "'":
+                i += 2
+                continue
+            break
+        text = value[1:i].replace("''", "'").rstrip()
+        if text.endswith('&'):
+            raise UnusualHeader('long string')
+        return text
+    value = value.split('/')[0].strip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    if not value or value.startswith('('):
+        raise UnusualHeader('undefined or complex value')
+    try:
+        return int(value)
+    except ValueError:
+        return float(value.replace('D', 'E'))
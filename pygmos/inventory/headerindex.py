@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the primary-header keywords used by the inventory.
+
+The index is a small SQLite database stored next to the raw data. Each
+file is keyed by its absolute path, size and modification time, so a
+new inventory only needs to read the headers of files that are new or
+have changed since the last run.
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import os
+import sqlite3
+from multiprocessing.pool import ThreadPool
+from time import time
+
+from . import archive
+from .fitsscan import read_keywords
+
+logger = logging.getLogger(__name__)
+
+# primary header keywords stored in the index. Changing this list
+# triggers a rebuild of existing indices.
+KEYWORDS = ('GEMPRGID', 'MASKNAME', 'OBSCLASS', 'OBJECT', 'OBSID',
+            'CENTWAVE', 'EXPTIME', 'OBSTYPE', 'DATE-OBS', 'UT')
+
+INDEX_NAME = 'pygmos_headers.db'
+
+
+def _column(key):
+    """SQLite column name for a header keyword"""
+    return 'k_{0}'.format(key.replace('-', '_'))
+
+
+class HeaderIndex(object):
+
+    """Incrementally updated index of FITS primary headers
+
+    Parameters
+    ----------
+    filename : str
+        name of the SQLite database. If it cannot be written (e.g., a
+        read-only data directory), the index is kept in memory.
+    keywords : list of str, optional
+        header keywords to store
+
+    """
+
+    def __init__(self, filename, keywords=KEYWORDS):
+        self.filename = filename
+        self.keywords = tuple(keywords)
+        try:
+            self._db = sqlite3.connect(filename)
+            self._create()
+        except sqlite3.Error as err:
+            logger.warning(
+                'Cannot use header index {0} ({1}). Using a temporary' \
+                ' index instead.'.format(filename, err))
+            self.filename = ':memory:'
+            self._db = sqlite3.connect(self.filename)
+            self._create()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _create(self):
+        columns = ['path TEXT PRIMARY KEY', 'size INTEGER', 'mtime REAL']
+        columns.extend(_column(key) for key in self.keywords)
+        cursor = self._db.execute('PRAGMA table_info(headers)')
+        existing = [row[1] for row in cursor]
+        wanted = [col.split()[0] for col in columns]
+        if existing and existing != wanted:
+            logger.info('Header keywords changed; rebuilding {0}'.format(
+                self.filename))
+            self._db.execute('DROP TABLE headers')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS headers ({0})'.format(
+                ', '.join(columns)))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def _row_to_header(self, row):
+        return dict((key, value) for key, value in zip(self.keywords, row)
+                    if value is not None)
+
+    def _read(self, filename):
+        """Read the indexed keywords from the primary header"""
+        return read_keywords(filename, self.keywords)
+
+    def update(self, files, workers=1):
+        """Return the indexed headers of `files`, reading as needed
+
+        Only files not yet in the index, or whose size or modification
+        time have changed, are opened.
+
+        Parameters
+        ----------
+        files : list of str
+            FITS file names
+        workers : int, optional
+            number of threads used to read headers concurrently. Useful
+            on network filesystems, where reading headers one at a time
+            is latency-bound. The result does not depend on `workers`.
+
+        Returns
+        -------
+        headers : list of dict
+            one dictionary per file, in the same order as `files`,
+            containing the keywords present in each primary header
+
+        """
+        select = 'SELECT size, mtime, {0} FROM headers WHERE path = ?'.format(
+            ', '.join(_column(key) for key in self.keywords))
+        insert = 'INSERT OR REPLACE INTO headers VALUES ({0})'.format(
+            ', '.join('?' * (len(self.keywords)+3)))
+        headers = [None] * len(files)
+        stale = []
+        for i, filename in enumerate(files):
+            path = os.path.abspath(filename)
+            stat = os.stat(path)
+            row = self._db.execute(select, (path,)).fetchone()
+            if row is not None and row[0] == stat.st_size \
+                    and row[1] == stat.st_mtime:
+                headers[i] = self._row_to_header(row[2:])
+            else:
+                stale.append((i, path, stat))
+        to = time()
+        paths = [path for i, path, stat in stale]
+        if workers > 1 and len(stale) > 1:
+            pool = ThreadPool(min(workers, len(stale)))
+            try:
+                new = pool.map(self._read, paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            new = [self._read(path) for path in paths]
+        dt = time() - to
+        for (i, path, stat), head in zip(stale, new):
+            self._db.execute(
+                insert, [path, stat.st_size, stat.st_mtime]
+                        + [head.get(key) for key in self.keywords])
+            headers[i] = head
+        self._db.commit()
+        if stale:
+            print('Read {0} of {1} headers with {2} thread(s) in {3:.1f} s' \
+                  ' ({4:.1f} files/s)'.format(
+                      len(stale), len(files), max(workers, 1), dt,
+                      len(stale) / max(dt, 1e-6)))
+        return headers
+
+    def update_archive(self, filename):
+        """Return the member names and headers of a tar archive
+
+        Members are indexed as ``<archive>::<member>``. The archive is
+        only read again if its size or modification time changed.
+
+        Returns
+        -------
+        members : list of str
+            names of the FITS members within the archive
+        headers : list of dict
+            primary header keywords of each member
+
+        """
+        path = os.path.abspath(filename)
+        prefix = '{0}{1}'.format(path, archive.SEP)
+        stat = os.stat(path)
+        row = self._db.execute(
+            'SELECT size, mtime FROM headers WHERE path = ?',
+            (path,)).fetchone()
+        columns = ', '.join(_column(key) for key in self.keywords)
+        if row is not None and row[0] == stat.st_size \
+                and row[1] == stat.st_mtime:
+            cursor = self._db.execute(
+                'SELECT path, {0} FROM headers WHERE substr(path, 1, ?) = ?' \
+                ' ORDER BY path'.format(columns), (len(prefix), prefix))
+            rows = cursor.fetchall()
+            return ([row[0][len(prefix):] for row in rows],
+                    [self._row_to_header(row[1:]) for row in rows])
+        self._db.execute(
+            'DELETE FROM headers WHERE substr(path, 1, ?) = ?',
+            (len(prefix), prefix))
+        insert = 'INSERT OR REPLACE INTO headers VALUES ({0})'.format(
+            ', '.join('?' * (len(self.keywords)+3)))
+        to = time()
+        members = []
+        headers = []
+        for member, head in archive.scan(path, self.keywords):
+            self._db.execute(
+                insert, ['{0}{1}'.format(prefix, member.name), member.size,
+                         member.mtime]
+                        + [head.get(key) for key in self.keywords])
+            members.append(member.name)
+            headers.append(head)
+        # the archive itself marks the members as up to date
+        self._db.execute(
+            insert, [path, stat.st_size, stat.st_mtime]
+                    + [None] * len(self.keywords))
+        self._db.commit()
+        dt = time() - to
+        print('Read {0} headers from {1} in {2:.1f} s ({3:.1f} files/s)'.format(
+            len(members), filename, dt, len(members) / max(dt, 1e-6)))
+        order = sorted(range(len(members)), key=lambda i: members[i])
+        return [members[i] for i in order], [headers[i] for i in order]
+
+    def query(self, **conditions):
+        """Return the paths of indexed files matching header values
+
+        Conditions are given as keyword arguments, e.g.,
+        ``index.query(OBSTYPE='DARK')``.
+
+        """
+        sql = 'SELECT path FROM headers'
+        if conditions:
+            sql = '{0} WHERE {1}'.format(
+                sql, ' AND '.join('{0} = ?'.format(_column(key))
+                                  for key in conditions))
+        cursor = self._db.execute(sql, list(conditions.values()))
+        return sorted(row[0] for row in cursor)
+
+    def distinct(self, key, **conditions):
+        """Unique values of `key` among files matching `conditions`"""
+        sql = 'SELECT DISTINCT {0} FROM headers WHERE {0} IS NOT NULL'.format(
+            _column(key))
+        if conditions:
+            sql = '{0} AND {1}'.format(
+                sql, ' AND '.join('{0} = ?'.format(_column(k))
+                                  for k in conditions))
+        cursor = self._db.execute(sql, list(conditions.values()))
+        return sorted(row[0] for row in cursor)
+
+
+def index_filename(path, filename=None):
+    """Default location of the header index for raw data in `path`"""
+    if filename:
+        return filename
+    return os.path.join(path, INDEX_NAME)
+
+
+def open_index(path='./', filename=None):
+    """Open the header index for the raw data in `path`"""
+    return HeaderIndex(index_filename(path, filename))
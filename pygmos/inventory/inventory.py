@@ -4,37 +4,50 @@ from __future__ import (absolute_import, division, print_function,
 
 import logging
 import os
-import sys
-try:
-    from astropy.io.fits import getheader
-except ImportError:
-    from pyfits import getheader
+from calendar import timegm
+from collections import defaultdict
+from datetime import datetime
 from glob import glob
 
+from . import archive, headerindex
+from .association import Association
 from ..utilities import utils
 
-import numpy as np
-from astropy.table import Table
-
 logger = logging.getLogger(__name__)
 
 
-def assoc(target, program, bias, path='./', verbose=True):
-    files = sorted(glob(os.path.join(path, '*.fits*')))
+def assoc(target, program, bias, path='./', verbose=True, index=None,
+          workers=1):
+    # `path` may also be a tar archive, in which case the index is
+    # stored alongside it
+    in_archive = archive.is_archive(path)
+    if index is None:
+        with headerindex.open_index(
+                os.path.dirname(path) if in_archive else path) as index:
+            return assoc(target, program, bias, path=path, verbose=verbose,
+                         index=index, workers=workers)
+    if in_archive:
+        files, headers = index.update_archive(path)
+    else:
+        files = sorted(glob(os.path.join(path, '*.fits*')))
+        headers = index.update(files, workers=workers)
     print('Found {0} FITS files in {1}\n'.format(len(files), path))
-    exp, masks = find_masks(files, target, program, bias)
+    exp, masks = find_masks(headers, target, program, bias)
     # did we find the object?
     msg = 'object {0} not found. Make sure you have defined the path' \
           ' correctly (type `pygmos -h` for help).'.format(target)
     assert len(exp.keys()) > 0, msg
     for obj in exp:
-        exp[obj] = find_exposures(files, exp[obj])
+        exp[obj] = find_exposures(files, headers, exp[obj])
+        association = Association.from_inventory(obj, exp[obj])
         # print file information to file
-        assoc_file = print_assoc(obj, exp[obj], bias, verbose=verbose)
-    return masks, assoc_file
+        print_assoc(obj, exp[obj], bias, verbose=verbose,
+                    association=association, path=path, members=files,
+                    stage=(target != 'inventory'))
+    return masks, association
 
 
-def find_masks(files, target, program, bias):
+def find_masks(headers, target, program, bias):
     """Identify available masks and wavelength configurations"""
     # auxiliary
     if target == 'inventory':
@@ -43,8 +56,8 @@ def find_masks(files, target, program, bias):
         search_targets = False
     masks = {}
     exp = {}
-    for filename in files:
-        head = getheader(filename)
+    seen = set()
+    for head in headers:
         # is this a Gemini observation?
         if 'GEMPRGID' not in head:
             continue
@@ -68,7 +81,8 @@ def find_masks(files, target, program, bias):
             if obj not in masks:
                 masks[obj] = []
                 exp[obj] = []
-            if [obsid, mask, wave, exptime] not in exp[obj]:
+            if (obj, obsid, mask, wave, exptime) not in seen:
+                seen.add((obj, obsid, mask, wave, exptime))
                 if mask not in masks[obj]:
                     newdir = os.path.join(obj, newdir).replace(' ', '_')
                     utils.makedir(newdir)
@@ -86,39 +100,87 @@ def find_masks(files, target, program, bias):
     return exp, masks
 
 
-def find_exposures(files, exp):
-    Nexp = len(exp)
-    """Identify files corresponding to each mask"""
-    info = []
-    for filename in files:
-        head = getheader(filename)
-        # is this a Gemini observation?
-        if 'CENTWAVE' in head and 'MASKNAME' in head and 'OBSTYPE' in head:
-            for i in range(Nexp):
-               if float(head['CENTWAVE']) == exp[i][2] \
-                        and head['MASKNAME'] == exp[i][1]:
-                    obsID = exp[i][0]
-                    wave  = exp[i][2]
-                    mask  = exp[i][1]
-                    info.append(
-                        [filename[:filename.index('.fits')],
-                         obsID, mask, head['OBSTYPE'], wave])
-
-    # this is where the filenames will be stored
-    for i in range(Nexp):
-        for j in range(3):
-            exp[i].append('')
-    # only takes one flat and one arc per mask+wavelength for now.
-    for i in range(Nexp):
-        for j in range(len(info)):
-            if exp[i][0] == info[j][1] and exp[i][2] == info[j][4]:
-                if info[j][3] == 'OBJECT':
-                    exp[i][4] = info[j][0]
-                if info[j][3] == 'FLAT':
-                    exp[i][5] = info[j][0]
-                if info[j][3] == 'ARC':
-                    exp[i][6] = info[j][0]
-    return exp
+def find_exposures(files, headers, exp):
+    """Identify the science, flat and arc files of each exposure
+
+    Frames are grouped in a single pass into dictionaries keyed by
+    (OBSID, MASKNAME, CENTWAVE, OBSTYPE) and by (MASKNAME, CENTWAVE,
+    OBSTYPE). Every science frame is then associated with the flat
+    and arc closest in time, preferring calibrations taken within the
+    same observation.
+
+    Parameters
+    ----------
+    files : list of str
+        FITS file names
+    headers : list of dict
+        primary header keywords of each file
+    exp : list of lists
+        [obsid, mask, wave, exptime] entries from `find_masks`
+
+    Returns
+    -------
+    exp : list of lists
+        [obsid, mask, wave, exptime, science, flat, arc] for each
+        science frame, where file names are given without extension
+
+    """
+    by_obs = defaultdict(list)
+    by_config = defaultdict(list)
+    for i, (filename, head) in enumerate(zip(files, headers)):
+        if 'CENTWAVE' not in head or 'MASKNAME' not in head \
+                or 'OBSTYPE' not in head:
+            continue
+        frame = (filename[:filename.index('.fits')], i, _obstime(head), head)
+        wave = float(head['CENTWAVE'])
+        by_obs[(head.get('OBSID'), head['MASKNAME'], wave,
+                head['OBSTYPE'])].append(frame)
+        by_config[(head['MASKNAME'], wave, head['OBSTYPE'])].append(frame)
+
+    associated = []
+    for obsid, mask, wave, exptime in exp:
+        wave = float(wave)
+        for science in by_obs[(obsid, mask, wave, 'OBJECT')]:
+            head = science[3]
+            if head.get('OBSCLASS') != 'science' \
+                    or int(head['EXPTIME']) != exptime:
+                continue
+            calibs = []
+            for obstype in ('FLAT', 'ARC'):
+                candidates = by_obs[(obsid, mask, wave, obstype)] \
+                    or by_config[(mask, wave, obstype)]
+                calibs.append(_closest(science, candidates))
+            associated.append(
+                [obsid, mask, wave, exptime, science[0]] + calibs)
+    return associated
+
+
+def _obstime(head):
+    """Start of the observation in seconds, or None if not available"""
+    try:
+        obstime = datetime.strptime(
+            '{0} {1}'.format(head['DATE-OBS'], head['UT'].split('.')[0]),
+            '%Y-%m-%d %H:%M:%S')
+    except (KeyError, AttributeError, ValueError):
+        return None
+    return timegm(obstime.timetuple())
+
+
+def _closest(frame, candidates):
+    """Name of the candidate frame closest in time to `frame`
+
+    Time differences are computed from DATE-OBS and UT. If either is
+    missing, the distance in the sorted file list (i.e., the Gemini
+    file sequence) is used instead.
+
+    """
+    if not candidates:
+        return ''
+    def distance(other):
+        if frame[2] is None or other[2] is None:
+            return (1, abs(other[1] - frame[1]))
+        return (0, abs(other[2] - frame[2]))
+    return min(candidates, key=distance)[0]
 
 
 def generate(args, program, target, bias, path='./', verbose=True):
@@ -131,39 +193,51 @@ def generate(args, program, target, bias, path='./', verbose=True):
         print('#-' * 20 + '#\n')
     # will fix later
     bias = args.bias
-    masks, assoc_file = assoc(target, program, bias, path)
+    if archive.is_archive(path):
+        index = headerindex.open_index(os.path.dirname(path), args.header_index)
+    else:
+        index = headerindex.open_index(path, args.header_index)
+    masks, association = assoc(
+        target, program, bias, path, index=index, workers=args.scan_workers)
+    index.close()
     if verbose:
         print()
         print('#-' * 20 + '#')
         if target == 'inventory':
             print('Inventory ready. Look for *.assoc files')
         else:
-            print(' Inventory ready. Look for "{0}.assoc"'.format(assoc_file))
+            print(' Inventory ready. Look for "{0}"'.format(
+                assoc_filename(target)))
         print('#-' * 20 + '#')
-    return masks
+    return masks, association
 
 
-def print_assoc(obj, exp, bias, verbose=True):
-    output = '{0}.assoc'.format(obj.replace(' ', '_'))
+def assoc_filename(obj):
+    """Name of the association file of an object"""
+    return '{0}.assoc'.format(obj.replace(' ', '_'))
+
+
+def print_assoc(obj, exp, bias, verbose=True, association=None, path='./',
+                members=None, stage=True):
+    """Write the association file and link the files of each mask
+
+    If `path` is a tar archive (whose FITS `members` are given), the
+    members needed by `obj` are first extracted to the working
+    directory, unless `stage` is False.
+
+    """
+    output = assoc_filename(obj)
     print('{0}\n-----'.format(output))
-    out = open(output, 'w')
-    head = '{0:<16s}  {1:<15s}  {2:<5s}  {3:<5s}' \
-           '  {4:<14s}  {5:<14s}  {6:<14s}'.format(
-               'ObservationID', 'Mask', 'Wave', 'Time', 'Science', 'Flat',
-               'Arc')
-    print(head, file=out)
-    if verbose:
-        print(head)
+    if association is None:
+        association = Association.from_inventory(obj, exp)
+    association.write(output, verbose=verbose)
+
+    if archive.is_archive(path):
+        if not stage:
+            return output
+        exp = stage_archive(path, exp, members)
 
     for i in range(len(exp)):
-        msg = '{0}  {1:<14s}  {2:5d}  {3:5d}  {4:<14s}  {5:<14s}' \
-              '  {6:<14s}'.format(
-                exp[i][0], exp[i][1], int(10*exp[i][2]),
-                exp[i][3], exp[i][4].split('/')[-1],
-                exp[i][5].split('/')[-1], exp[i][6].split('/')[-1])
-        print(msg, file=out)
-        if verbose:
-            print(msg)
         science = exp[i][4] + '.fits'
         flat = exp[i][5] + '.fits'
         arc = exp[i][6] + '.fits'
@@ -183,7 +257,43 @@ def print_assoc(obj, exp, bias, verbose=True):
     return output
 
 
-def read(target, bias, col=1):
+def stage_archive(path, exp, members):
+    """Extract the files of the given exposures from a tar archive
+
+    The science, flat, arc and (if present in the archive) MDF files are
+    decompressed into the working directory.
+
+    Returns
+    -------
+    exp : list
+        the exposures, with file names pointing to the extracted files
+
+    """
+    names = set(name for e in exp for name in e[4:7] if name)
+    masks = set(e[1] for e in exp)
+    wanted = []
+    for member in members:
+        base = archive.uncompressed_name(member)
+        if member[:member.index('.fits')] in names \
+                or base.split('.fits')[0] in masks:
+            wanted.append(member)
+    archive.extract(path, wanted)
+    return [e[:4] + [os.path.basename(name) for name in e[4:7]]
+            for e in exp]
+
+
+def read(target, bias, col=1, index=None):
+    """Read the masks of `target` from an existing inventory
+
+    If a header index is given, the masks are taken from it, without
+    opening the association file or any FITS file.
+
+    """
+    if index is not None:
+        masks = index.distinct('MASKNAME', OBJECT=target, OBSCLASS='science')
+        masks = [mask for mask in masks if mask != 'None']
+        if masks:
+            return masks
     masks = []
     with open('{0}.assoc'.format(target.replace(' ', '_'))) as f:
         for line in f:
@@ -203,71 +313,50 @@ def run(args):
     """Main inventory routine."""
     # longslit observations
     if args.masks == 'longslit':
-        masks = generate(
+        masks, association = generate(
             args, args.program, args.objectid, args.bias,
             args.path, masktype=args.masks)
 
     # just read masks from pre-existing assoc files
     elif args.read_inventory:
-        masks = read(args.objectid, args.bias)
+        index_file = headerindex.index_filename(args.path, args.header_index)
+        if os.path.isfile(index_file):
+            with headerindex.HeaderIndex(index_file) as index:
+                masks = read(args.objectid, args.bias, index=index)
+        else:
+            masks = read(args.objectid, args.bias)
+        association = Association.read(
+            assoc_filename(args.objectid), args.objectid)
 
     # all MOS masks
     elif args.masks == 'all':
-        masks = generate(
+        masks, association = generate(
             args, '', args.objectid, args.bias, args.path)
 
     # when MOS masks are specified
     else:
-        masks = generate(
+        masks, association = generate(
             args, args.program, args.objectid, args.bias, args.path)
 
-    return masks
+    return masks, association
 
 
 def get_file_longslit(assoc, obs='science', wave=670):
     """
-    Select rows in the association file that contain 
-    the type of observation of interest for the central
-    wavelength setup of choice.
+    Select rows in the association that contain the type of
+    observation of interest for the central wavelength setup of
+    choice. `assoc` may be an `Association` or an association file.
     """
-    data = Table.read(assoc, format='ascii')
-    return np.array(data[data['Wave']==wave][str.capitalize(obs)])
+    if not isinstance(assoc, Association):
+        assoc = Association.read(assoc)
+    return assoc.get_file_longslit(obs=obs, wave=wave)
 
 
 def get_file(assoc, science, mask=1, obs='science', wave=670):
     """
-    !!! As called in other parts of the code, this function 
-    will only work for the MOS track, not the longslit functionality
-    of the code.
+    Name of the science, flat or arc file associated with a science
+    frame. `assoc` may be an `Association` or an association file.
     """
-    assocfile = open(assoc)
-    while assocfile.readline()[0] == '#':
-        pass
-    for line in assocfile:
-        if line[0] == '#':
-            continue
-        line = line.split()
-        if len(line) < 7:
-            continue
-        if mask == 'longslit':
-            if int(line[2]) == wave and line[4] == science:
-                if obs == 'science':
-                    return line[4]
-                if obs == 'flat':
-                    return line[5]
-                if obs == 'arc' or obs == 'lamp':
-                    return line[6]
-                else:
-                    print('Unknown observation type in get_file(). Exiting')
-                    sys.exit()
-        elif line[1] == mask and int(line[2]) == wave and line[4] == science:
-                if obs == 'science':
-                    return line[4]
-                if obs == 'flat':
-                    return line[5]
-                if obs == 'arc' or obs == 'lamp':
-                    return line[6]
-                else:
-                    print('Unknown observation type in get_file(). Exiting')
-                    sys.exit()
-    return
+    if not isinstance(assoc, Association):
+        assoc = Association.read(assoc)
+    return assoc.get_file(science, mask=mask, obs=obs, wave=wave)
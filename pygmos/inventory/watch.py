@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Monitor a raw-data directory for new FITS files.
+
+Uses inotify (through `pyinotify`) when available, and otherwise polls
+the directory. In both cases a file is only reported once it has been
+completely written.
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import os
+from fnmatch import fnmatch
+from glob import glob
+from time import sleep
+
+try:
+    import pyinotify
+    _have_pyinotify = True
+except ImportError:
+    _have_pyinotify = False
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher(object):
+
+    """Report FITS files that appear in a directory
+
+    Parameters
+    ----------
+    path : str
+        directory to monitor
+    interval : float, optional
+        polling interval, in seconds. When using inotify, this is the
+        longest time `wait` blocks before checking again.
+    pattern : str, optional
+        file name pattern
+    use_inotify : bool, optional
+        whether to use inotify if `pyinotify` is installed
+
+    """
+
+    def __init__(self, path, interval=30, pattern='*.fits*',
+                 use_inotify=True):
+        self.path = path
+        self.interval = interval
+        self.pattern = pattern
+        # (size, mtime) of files seen in the previous poll
+        self._previous = {}
+        self._reported = {}
+        self._events = []
+        self.inotify = use_inotify and _have_pyinotify
+        if self.inotify:
+            self._manager = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(
+                self._manager, self._handle, timeout=1000*interval)
+            self._manager.add_watch(
+                path, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+        logger.info('Watching {0} using {1}'.format(
+            path, 'inotify' if self.inotify else 'polling'))
+
+    def _handle(self, event):
+        if fnmatch(os.path.basename(event.pathname), self.pattern):
+            self._events.append(event.pathname)
+
+    def poll(self):
+        """Files that are new or have changed, and are no longer growing"""
+        if self.inotify:
+            if self._notifier.check_events():
+                self._notifier.read_events()
+                self._notifier.process_events()
+            new = sorted(set(self._events))
+            self._events = []
+            return new
+        current = {}
+        for filename in glob(os.path.join(self.path, self.pattern)):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            current[filename] = (stat.st_size, stat.st_mtime)
+        # a file is complete when it did not change since the last poll
+        new = sorted(
+            filename for filename, sig in current.items()
+            if self._previous.get(filename) == sig
+            and self._reported.get(filename) != sig)
+        for filename in new:
+            self._reported[filename] = current[filename]
+        self._previous = current
+        return new
+
+    def wait(self):
+        """Block until new files are found, and return them"""
+        while True:
+            new = self.poll()
+            if new:
+                return new
+            if not self.inotify:
+                sleep(self.interval)
+
+    def close(self):
+        if self.inotify:
+            self._notifier.stop()
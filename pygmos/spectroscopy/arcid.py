@@ -0,0 +1,430 @@
+"""
+Identification of arc lines without IRAF.
+
+Replaces `gswavelength` for the CuAr arcs of MOS and longslit data. For
+each slit of a reduced (cut) arc:
+
+1. the central rows are collapsed and the arc lines are found and
+   centroided, all at once;
+2. a linear solution is found by letting every pair of (line,
+   catalog wavelength) vote for the wavelength at the center of the
+   detector, for a range of trial dispersions around the nominal
+   dispersion of the grating. Votes are restricted to a window around
+   CENTWAVE, widened by the offset of the slit in the mask (from the
+   MDF), so that the solution is seeded by the instrument setup;
+3. lines are matched to the catalog (a sorted array, searched with
+   `np.searchsorted`) and a Chebyshev polynomial is fit with sigma
+   rejection, with decreasing matching tolerances;
+4. the matched lines are centroided in bins of rows along the slit and
+   a Chebyshev surface wavelength(x, y) is fit to all of them.
+
+The results are written as the ``database/id<arc>_NNN`` (`identify`)
+and ``database/fc<arc>_NNN`` (`fitcoords`) records that `gstransform`
+reads. Slits can be distributed over a pool of processes.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import os
+from multiprocessing import Pool, current_process
+from numpy.polynomial import chebyshev
+from time import time
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+from . import database
+from .wavetransfer import centroids
+
+# approximate dispersion of each grating, in Angstrom per unbinned pixel
+DISPERSION = {'B1200': 0.245, 'R831': 0.34, 'B600': 0.45, 'R600': 0.47,
+              'R400': 0.67, 'R150': 1.74}
+# GMOS mask scale (arcsec/mm) and unbinned pixel scale (arcsec/pixel)
+MASK_SCALE = 1.611444
+PIXEL_SCALE = 0.0727
+
+_linelists = {}
+
+
+def default_linelist():
+    """CuAr_GMOS.dat in the pygmos data folder"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    for folder in (os.environ.get('pygmos_path', ''),
+                   os.path.join(here, '..', '..')):
+        filename = os.path.join(folder, 'data', 'CuAr_GMOS.dat')
+        if os.path.isfile(filename):
+            return filename
+    return os.path.join(here, '..', '..', 'data', 'CuAr_GMOS.dat')
+
+
+def read_linelist(filename=None):
+    """Sorted wavelengths of a line list (read only once per file)
+
+    Commented lines (starting with ``#``) are not used, as in IRAF.
+
+    """
+    if filename is None:
+        filename = default_linelist()
+    if filename not in _linelists:
+        lines = []
+        with open(filename) as f:
+            for line in f:
+                line = line.split()
+                if line and not line[0].startswith('#'):
+                    lines.append(float(line[0]))
+        _linelists[filename] = np.sort(lines)
+    return _linelists[filename]
+
+
+def nearest(catalog, wavelengths):
+    """Index of the closest catalog line to each wavelength"""
+    idx = np.clip(np.searchsorted(catalog, wavelengths), 1, catalog.size-1)
+    left = catalog[idx-1]
+    right = catalog[idx]
+    return np.where(np.abs(wavelengths - left) <= np.abs(right - wavelengths),
+                    idx - 1, idx)
+
+
+def find_lines(spectrum, nsigma=5., max_lines=80, halfwidth=3):
+    """Centroids (1-indexed pixels) and peaks of the lines of an arc"""
+    s = np.where(np.isfinite(spectrum), spectrum, 0)
+    level = np.median(s)
+    noise = 1.4826 * np.median(np.abs(s - level)) or np.std(s) or 1.
+    peaks = np.nonzero((s[1:-1] > s[:-2]) & (s[1:-1] >= s[2:])
+                       & (s[1:-1] > level + nsigma*noise))[0] + 1
+    peaks = peaks[np.argsort(-s[peaks])][:max_lines]
+    x = centroids(s, peaks, halfwidth=halfwidth)
+    good = np.isfinite(x)
+    return x[good] + 1, s[peaks[good]]
+
+
+def vote(x, catalog, center, dispersion, window, xc, ntrial=61,
+         spread=0.15, tolerance=2.):
+    """Linear solution from the lines `x` and a catalog
+
+    Returns
+    -------
+    lambda0 : float
+        wavelength at pixel `xc`
+    dispersion : float
+        Angstrom per pixel
+
+    """
+    trials = dispersion * np.linspace(1 - spread, 1 + spread, ntrial)
+    lo = center - window - trials.max() * np.abs(x - xc).max()
+    hi = center + window + trials.max() * np.abs(x - xc).max()
+    lines = catalog[(catalog >= lo) & (catalog <= hi)]
+    if lines.size == 0:
+        return center, dispersion
+    # (trial, line, catalog) wavelength at xc
+    lambda0 = lines[None, None, :] \
+        - trials[:, None, None] * (x[None, :, None] - xc)
+    binsize = tolerance * dispersion
+    nbins = int(np.ceil(2 * window / binsize)) + 1
+    bins = np.floor((lambda0 - center + window) / binsize).astype(int)
+    valid = (bins >= 0) & (bins < nbins)
+    trial = np.broadcast_to(np.arange(ntrial)[:, None, None], bins.shape)
+    votes = np.bincount(trial[valid] * nbins + bins[valid],
+                        minlength=ntrial*nbins).reshape(ntrial, nbins)
+    # a match may fall on either side of a bin edge
+    votes[:, 1:] += votes[:, :-1]
+    best_trial, best_bin = np.unravel_index(votes.argmax(), votes.shape)
+    # average the votes of the best bin
+    d = trials[best_trial]
+    l0 = lambda0[best_trial]
+    inside = (np.abs(l0 - (center - window + best_bin*binsize))
+              <= binsize)
+    if inside.any():
+        return np.median(l0[inside]), d
+    return center - window + best_bin*binsize, d
+
+
+def fit_solution(x, catalog, lambda0, dispersion, xc, nx, order=4,
+                 tolerance=2., nsigma=3., niter=3, grow=1.3):
+    """Match lines to the catalog and fit a Chebyshev polynomial
+
+    The linear seed solution is only reliable close to `xc`, so lines
+    are matched within a region around it that grows by a factor `grow`
+    every iteration, with the number of terms of the fit increasing
+    with the number of matched lines.
+
+    Returns
+    -------
+    coeffs : array
+        Chebyshev coefficients in the IRAF normalization (x from 1 to
+        `nx` mapped to [-1, 1]), or None if no solution was found
+    matched : boolean array
+        lines used in the fit
+    wavelengths : array
+        catalog wavelength of each line
+
+    """
+    norm = (2 * x - (nx + 1)) / (nx - 1)
+    predict = lambda0 + dispersion * (x - xc)
+    coeffs = None
+    matched = np.zeros(x.size, dtype=bool)
+    user = predict
+    radius = nx / 8.
+    while True:
+        user = catalog[nearest(catalog, predict)]
+        matched = (np.abs(x - xc) <= radius) \
+            & (np.abs(user - predict) <= tolerance * dispersion)
+        # lines matched to the same catalog line are ambiguous
+        unique, counts = np.unique(user[matched], return_counts=True)
+        matched &= ~np.isin(user, unique[counts > 1])
+        # curvature is needed early on to extrapolate to the next region
+        nmatch = matched.sum()
+        deg = min(1 if nmatch < 8 else 2 if nmatch < 15 else order - 1,
+                  nmatch - 2)
+        if deg >= 1:
+            for i in range(niter):
+                coeffs = chebyshev.chebfit(norm[matched], user[matched], deg)
+                resid = user - chebyshev.chebval(norm, coeffs)
+                sigma = 1.4826 * np.median(np.abs(resid[matched]))
+                keep = matched & (np.abs(resid) <= max(nsigma*sigma,
+                                                       0.05*dispersion))
+                if keep.sum() == matched.sum() or keep.sum() < deg + 2:
+                    break
+                matched = keep
+            predict = chebyshev.chebval(norm, coeffs)
+        if radius >= nx:
+            break
+        radius *= grow
+    return coeffs, matched, user
+
+
+def fit_surface(x, y, wave, nx, ny, xorder, yorder, nsigma=3., niter=3):
+    """Chebyshev surface wavelength(x, y), with full cross terms
+
+    Returns
+    -------
+    coeffs : array
+        coefficients in the order of IRAF's gsurfit (x varies fastest)
+    rms : float
+
+    """
+    xn = (2 * x - (nx + 1)) / max(nx - 1, 1)
+    yn = (2 * y - (ny + 1)) / max(ny - 1, 1)
+    A = chebyshev.chebvander2d(xn, yn, [xorder-1, yorder-1])
+    use = np.ones(x.size, dtype=bool)
+    for i in range(niter+1):
+        c = np.linalg.lstsq(A[use], wave[use], rcond=None)[0]
+        resid = wave - A.dot(c)
+        rms = np.std(resid[use])
+        keep = np.abs(resid) <= nsigma * rms
+        if (keep == use).all() or keep.sum() < A.shape[1] + 1:
+            break
+        use = keep
+    # numpy orders coefficients with y varying fastest
+    return c.reshape(xorder, yorder).T.ravel(), rms
+
+
+def identify(data, catalog, centwave, dispersion, offset=0., order=4,
+             xorder=4, yorder=4, step=5, nsum=5, nsigma=5.,
+             min_lines=6):
+    """Wavelength solution of one slit of an arc
+
+    Parameters
+    ----------
+    data : 2d array
+        arc slit, with wavelength along x
+    catalog : 1d array
+        sorted line wavelengths
+    centwave : float
+        central wavelength, in Angstrom
+    dispersion : float
+        nominal dispersion, in Angstrom per (binned) pixel
+    offset : float
+        uncertainty in the position of `centwave` due to the position
+        of the slit in the mask, in pixels
+    order : int
+        number of terms of the 1d solution (as in `identify`)
+    xorder, yorder : int
+        number of terms of the 2d surface (as in `fitcoords`)
+    step, nsum : int
+        the surface is fit to lines measured every `step` rows, each
+        the median of `nsum` rows
+
+    Returns
+    -------
+    solution : dict
+        row, features (pixel, fit, user), 1d coefficients, surface
+        coefficients, rms (Angstrom) and number of lines; None if the
+        slit could not be calibrated
+
+    """
+    ny, nx = data.shape
+    middle = ny // 2
+    lo = max(0, middle - nsum // 2)
+    spectrum = np.median(data[lo:lo+nsum], axis=0)
+    x, peak = find_lines(spectrum, nsigma=nsigma)
+    if x.size < min_lines:
+        return None
+    xc = (nx + 1) / 2
+    window = (0.1 * nx + abs(offset)) * dispersion
+    central = np.abs(x - xc) < nx / 4
+    lambda0, d = vote(x[central] if central.sum() >= 4 else x, catalog,
+                      centwave, dispersion, window, xc)
+    coeffs, matched, user = fit_solution(
+        x, catalog, lambda0, d, xc, nx, order=order)
+    if coeffs is None or matched.sum() < min_lines:
+        return None
+    norm = (2 * x - (nx + 1)) / (nx - 1)
+    fit = chebyshev.chebval(norm, coeffs)
+    rms = np.std(fit[matched] - user[matched])
+    # follow the matched lines along the slit
+    xs, ys, ws = [], [], []
+    positions = x[matched] - 1
+    for start in range(0, ny, step):
+        row = np.median(data[start:start+nsum], axis=0)
+        found = centroids(row, positions)
+        good = np.isfinite(found) & (np.abs(found - positions) < 2)
+        xs.append(found[good] + 1)
+        ys.append(np.full(good.sum(), start + min(nsum, ny-start) / 2 + 0.5))
+        ws.append(user[matched][good])
+    xs, ys, ws = [np.concatenate(a) for a in (xs, ys, ws)]
+    if xs.size < xorder * yorder + 1 or ny < 2:
+        # not enough rows: a surface constant along y
+        xs, ys, ws = x[matched], np.full(matched.sum(), middle + 1.), \
+            user[matched]
+        yorder = 1
+    surface, surface_rms = fit_surface(xs, ys, ws, nx, ny, xorder, yorder)
+    return {'row': middle + 1, 'features': np.c_[x[matched], fit[matched],
+                                                 user[matched]],
+            'coeffs': coeffs, 'order': order, 'surface': surface,
+            'xorder': xorder, 'yorder': yorder, 'nx': nx, 'ny': ny,
+            'rms': rms, 'surface_rms': surface_rms,
+            'nlines': int(matched.sum()), 'dispersion': d}
+
+
+def records(arc, slit, solution, fwidth=4.):
+    """`identify` and `fitcoords` records of a solution"""
+    name = '{0}_{1:03d}'.format(arc, slit)
+    image = '{0}[*,{1}]'.format(name, solution['row'])
+    ident = database.Record('identify {0}'.format(image))
+    for key, value in (('id', name), ('task', 'identify'),
+                       ('image', image), ('units', 'Angstroms')):
+        ident.set(key, value)
+    ident.set('features', len(solution['features']),
+              ['{0:13.2f} {1:9.3f} {2:9.3f} {3:6.1f} 1 1'.format(
+                   px, fit, user, fwidth)
+               for px, fit, user in solution['features']])
+    for key, value in (('function', 'chebyshev'),
+                       ('order', len(solution['coeffs'])),
+                       ('sample', '*'), ('naverage', 1), ('niterate', 3),
+                       ('low_reject', 3.), ('high_reject', 3.),
+                       ('grow', 0.)):
+        ident.set(key, value)
+    ident.set_table('coefficients', np.r_[
+        1, len(solution['coeffs']), 1, solution['nx'], solution['coeffs']])
+    fc = database.Record(name)
+    for key, value in (('task', 'fitcoords'), ('axis', 1),
+                       ('units', 'angstroms')):
+        fc.set(key, value)
+    fc.set_table('surface', np.r_[
+        1, solution['xorder'], solution['yorder'], 1, 1, solution['nx'],
+        1, solution['ny'], solution['surface']])
+    return ident, fc
+
+
+def _identify(task):
+    slit, data, kwargs = task
+    to = time()
+    return slit, identify(data, **kwargs), time() - to
+
+
+def identify_file(arc, catalog=None, folder='database', order=4, xorder=4,
+                  yorder=4, fwidth=4., max_rms=0.5, workers=1,
+                  verbose=True):
+    """Identify the arc lines of all slits of a reduced arc
+
+    Parameters
+    ----------
+    arc : str
+        reduced arc (without extension), with one ``[SCI,i]`` extension
+        per slit
+    catalog : str, optional
+        line list (`default_linelist` by default)
+    folder : str
+        IRAF database folder
+    order, xorder, yorder : int
+        see `identify`
+    fwidth : float
+        feature width recorded in the `identify` records
+    max_rms : float
+        maximum rms of the 1d solution of each slit, in pixels
+    workers : int, optional
+        number of processes among which slits are distributed. Ignored
+        within daemon processes.
+
+    Returns
+    -------
+    failed : list of int
+        slits that could not be calibrated. Records are only written if
+        all slits were calibrated.
+
+    """
+    to = time()
+    lines = read_linelist(catalog)
+    with pyfits.open('{0}.fits'.format(arc)) as hdulist:
+        head = hdulist[0].header
+        grating = str(head.get('GRATING', '')).split('+')[0].split('_')[0]
+        binning = int(str(head.get('CCDSUM', '1 1')).split()[0])
+        dispersion = DISPERSION.get(grating, 0.5) * binning
+        centwave = 10 * float(head.get('CENTWAVE', 0) or 0) \
+            or np.median(lines)
+        try:
+            mdf = hdulist['MDF'].data
+            slitpos = mdf['slitpos_mx']
+        except (KeyError, IndexError):
+            slitpos = None
+        tasks = []
+        for hdu in hdulist:
+            if hdu.name != 'SCI' or hdu.data is None:
+                continue
+            slit = hdu.header['EXTVER']
+            offset = 0.
+            if slitpos is not None and slit <= len(slitpos):
+                offset = slitpos[slit-1] * MASK_SCALE / PIXEL_SCALE \
+                    / binning
+            kwargs = dict(catalog=lines, centwave=centwave,
+                          dispersion=dispersion, offset=offset,
+                          order=order, xorder=xorder, yorder=yorder)
+            tasks.append((slit, hdu.data.astype(float), kwargs))
+    if workers > 1 and len(tasks) > 1 and not current_process().daemon:
+        pool = Pool(min(workers, len(tasks)))
+        try:
+            results = pool.map(_identify, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_identify(task) for task in tasks]
+    failed = []
+    output = []
+    for slit, solution, dt in results:
+        if solution is None \
+                or solution['rms'] > max_rms * solution['dispersion']:
+            failed.append(slit)
+            if verbose:
+                print('{0}[SCI,{1}]: no solution'.format(arc, slit))
+            continue
+        if verbose:
+            print('{0}[SCI,{1}]: {2} lines, rms {3:.3f} A ({4:.2f} s)'
+                  .format(arc, slit, solution['nlines'], solution['rms'],
+                          dt))
+        output.append((slit, solution))
+    if failed:
+        return failed
+    for slit, solution in output:
+        ident, fc = records(arc, slit, solution, fwidth=fwidth)
+        database.write(os.path.join(
+            folder, 'id{0}_{1:03d}'.format(arc, slit)), [ident])
+        database.write(os.path.join(
+            folder, 'fc{0}_{1:03d}'.format(arc, slit)), [fc])
+    if verbose:
+        print('{0}: {1} slits calibrated in {2:.1f} s'.format(
+            arc, len(output), time()-to))
+    return failed
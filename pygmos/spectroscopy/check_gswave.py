@@ -12,6 +12,7 @@ import shutil
 from pyraf import iraf
 from iraf import tv
 
+from . import arcid, wavecheck
 from ..utilities import utils
 from ..inventory import inventory
 
@@ -22,73 +23,28 @@ pygmos_path = os.path.dirname(os.path.split(
 os.environ['pygmos_path'] = pygmos_path
 
 
-def main(cluster, mask, logfile, outfile, thresh=0.25):
-    """Returns the indices of those slits that went wrong."""
-    pathin = os.path.join(cluster, 'mask' + str(mask), logfile)
-    outfilename = os.path.join(cluster, 'mask' + str(mask), outfile)
-    rms = check(pathin, mask, outfilename)
-    over = 0
-    wayout = []
-    for i in range(len(rms)):
-        if rms[i][1] > 0.2:
-            over += 1
-        if rms[i][1] > thresh:
-            wayout.append(i)
-    return wayout
-
-
-def check(path, mask, outfilename):
-    fits = []
-    log = open(path)
-    out = open(outfilename, 'w')
-    slit = ''
-    for line in log:
-        if line[:9] == 'NOAO/IRAF': # to restart after every slit
-            median = numpy.median(rms)
-            std = numpy.std(rms)
-            fits.append([slit, median, std])
-            slits.append(median)
-            sdev.append(std)
-            print(slit, median, '%.4f' %std, file=out)
-            slit = ''
-        if line[:8] == 'inimages':
-            line = line.split()
-            image = line[2]
-            print(image, file=out)
-            slit = ''
-            slits = []
-            sdev = []
-        if line[:3] == 'MDF':
-            slit = int(line[9:])
-            rms = []
-
-        if slit:
-            if line[:18] == '  ' + image:
-                line = line.split()
-                try:
-                    rms.append(float(line[4]))
-                except IndexError:
-                    if line[3] == 'found':
-                        print('No solution found for slit', line[0])
-            if line[:16] == image:
-                line = line.split()
-                rms.append(float(line[6]))
-        if line[:17] == 'GSWAVELENGTH exit':
-            try:
-                print('Mask', mask)
-                print(image)
-                print('Wavelength calibration RMS (values over all slits, in' \
-                      ' Angstrom):')
-                print('  median={0:.3f}    min={1:.3f}    max={2:.3f}'.format(
-                        numpy.median(slits), min(slits), max(slits)))
-                print('  median_std={0:.3f}    min_std={1:.3f}' \
-                      '    max_std={2:.3f}'.format(
-                        numpy.median(sdev), min(sdev), max(sdev)))
-                print('-' * 50)
-                print('-' * 50)
-            except ValueError:
-                pass
-    return fits
+def main(path, mask, outfile='gswcheck.log', thresh=0.25,
+         folder='database'):
+    """Returns the numbers of those slits that went wrong.
+
+    The wavelength calibration statistics of every slit (see
+    `wavecheck.slit_table`) are written to `outfile` in `path`, the
+    directory of the mask.
+
+    """
+    table = check(path, mask, os.path.join(path, outfile), folder=folder)
+    bad = wavecheck.flagged(table, thresh=thresh)
+    return sorted(set(slit for slits in bad.values() for slit in slits))
+
+
+def check(path, mask, outfilename, folder='database'):
+    """Per-slit wavelength calibration statistics of a mask, read from
+    its database records, as an `astropy.table.Table`"""
+    table = wavecheck.slit_table(
+        [os.path.join(path, folder)], masks=[str(mask)])
+    table.write(outfilename, format='ascii.fixed_width', overwrite=True)
+    wavecheck.summary(table)
+    return table
 
 
 def Look(image, mask):
@@ -162,21 +118,10 @@ def getNslits(filename):
 
 def ManualCheck(lines, verbose=False):
     """Change `pr` for `verbose`"""
-    f = open(os.path.join(
+    skylines = arcid.read_linelist(os.path.join(
         os.environ['pygmos_path'], 'data', 'CuAr_GMOS-ACT.dat'))
-    skylines = []
-    for l in f:
-        if l[0] != '#':
-            l = l.split()
-            skylines.append(float(l[0]))
-
-    diff = []
-    for line in lines:
-        diff.append(100)
-        i = len(diff) - 1
-        for skyline in skylines:
-            if abs(line - skyline) < diff[i]:
-                diff[i] = line - skyline
+    lines = numpy.asarray(lines, dtype=float)
+    diff = lines - skylines[arcid.nearest(skylines, lines)]
 
     med = numpy.median(diff)
     std = numpy.std(diff)
@@ -0,0 +1,248 @@
+"""
+Running coadd of the exposures of a mask.
+
+Each sky-subtracted exposure is folded into a running (optionally
+inverse variance-weighted) mean as soon as it is reduced, so that a
+coadded frame is available at any time, and adding one more exposure
+costs a single read of that exposure and of the running state, instead
+of combining all exposures again.
+
+The state of each coadd (per slit: the weighted mean, sum of weights,
+weighted sum of squared deviations following West 1979, and the number
+of exposures contributing to each pixel) is stored in a FITS file in the
+`COADD_DIR` folder, together with a JSON list of the exposures it
+contains. An exposure whose file changed after being added cannot be
+removed from the running sums, so the coadd is then started again.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import numpy as np
+import os
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+from ..utilities import provenance
+
+COADD_DIR = '.coadd'
+STATE = ('MEAN', 'WSUM', 'M2', 'VSUM', 'NPIX')
+
+
+def _extension(hdulist, name, ver):
+    try:
+        return hdulist[name, ver]
+    except KeyError:
+        return None
+
+
+class RunningCoadd(object):
+
+    """Running mean of multi-extension frames, updated in place
+
+    Parameters
+    ----------
+    name : str
+        name of the coadded frame (without extension)
+    weights : {'none', 'ivar'}
+        weight exposures by their inverse variance (requires VAR
+        extensions)
+
+    """
+
+    def __init__(self, name, weights='none'):
+        self.name = name
+        self.weights = weights
+        self.state_file = os.path.join(COADD_DIR, '{0}.fits'.format(name))
+        self.members_file = os.path.join(
+            COADD_DIR, '{0}.json'.format(name))
+        try:
+            with open(self.members_file) as f:
+                self.members = json.load(f)
+        except (IOError, ValueError):
+            self.members = {}
+        if self.members and not os.path.isfile(self.state_file):
+            self.members = {}
+
+    def __contains__(self, image):
+        return self.members.get(image) == provenance.signature(image)
+
+    def __len__(self):
+        return len(self.members)
+
+    def reset(self):
+        """Start again from an empty coadd"""
+        self.members = {}
+        for filename in (self.state_file, self.members_file):
+            if os.path.isfile(filename):
+                os.remove(filename)
+        return
+
+    def add(self, image):
+        """Fold an exposure into the coadd
+
+        Exposures already included are ignored. If an included
+        exposure changed since it was added, the coadd is restarted
+        and `add` returns False: all exposures must be added again.
+
+        Parameters
+        ----------
+        image : str
+            sky-subtracted frame, with the same slits as the coadd
+
+        Returns
+        -------
+        added : bool
+            False if the coadd had to be restarted
+
+        """
+        filename = '{0}.fits'.format(image)
+        if image in self:
+            return True
+        restarted = image in self.members
+        if restarted:
+            print('{0} changed since it was added to {1}. Starting' \
+                  ' again.'.format(image, self.name))
+            self.reset()
+        state = self._read_state()
+        with pyfits.open(filename, memmap=True) as hdulist:
+            if state is None:
+                state = self._empty_state(hdulist)
+            for hdu in hdulist:
+                if hdu.name != 'SCI':
+                    continue
+                ver = hdu.header['EXTVER']
+                self._fold(state, ver, hdulist)
+        self.members[image] = provenance.signature(image)
+        self._write_state(state)
+        print('Added {0} to {1} ({2} exposures)'.format(
+            image, self.name, len(self.members)))
+        return not restarted
+
+    def _fold(self, state, ver, hdulist):
+        """Weighted Welford update of slit `ver`"""
+        x = hdulist['SCI', ver].data.astype(float)
+        var = _extension(hdulist, 'VAR', ver)
+        dq = _extension(hdulist, 'DQ', ver)
+        valid = np.isfinite(x)
+        if dq is not None:
+            valid &= (dq.data == 0)
+        if var is not None:
+            var = var.data.astype(float)
+            valid &= np.isfinite(var)
+        if self.weights == 'ivar' and var is not None:
+            w = np.where(valid & (var > 0),
+                         1 / np.where(var > 0, var, 1), 0)
+        else:
+            w = valid.astype(float)
+        x = np.where(valid, x, 0)
+        mean = state['MEAN', ver].data
+        wsum = state['WSUM', ver].data
+        m2 = state['M2', ver].data
+        new_wsum = wsum + w
+        delta = x - mean
+        step = w / np.where(new_wsum > 0, new_wsum, 1)
+        mean += step * delta
+        m2 += w * delta * (x - mean)
+        wsum[:] = new_wsum
+        state['NPIX', ver].data += (w > 0)
+        vsum = _extension(state, 'VSUM', ver)
+        if vsum is not None:
+            if var is None:
+                # cannot propagate variances any longer
+                state.remove(vsum)
+            else:
+                vsum.data += w**2 * np.where(valid, var, 0)
+        return
+
+    def _empty_state(self, hdulist):
+        state = pyfits.HDUList([pyfits.PrimaryHDU(
+            header=hdulist[0].header.copy())])
+        # keep the other extensions (e.g., the MDF) for the output
+        for hdu in hdulist[1:]:
+            if hdu.name not in ('SCI', 'VAR', 'DQ'):
+                state.append(hdu.copy())
+        for hdu in hdulist:
+            if hdu.name != 'SCI':
+                continue
+            ver = hdu.header['EXTVER']
+            names = list(STATE)
+            if _extension(hdulist, 'VAR', ver) is None:
+                names.remove('VSUM')
+            for name in names:
+                dtype = np.int32 if name == 'NPIX' else np.float64
+                ext = pyfits.ImageHDU(
+                    np.zeros(hdu.data.shape, dtype=dtype),
+                    header=hdu.header.copy(), name=name)
+                ext.header['EXTVER'] = ver
+                state.append(ext)
+        return state
+
+    def _read_state(self):
+        if not os.path.isfile(self.state_file):
+            return None
+        with pyfits.open(self.state_file) as state:
+            # load all data before the file is closed
+            for hdu in state:
+                hdu.data
+            return pyfits.HDUList([hdu.copy() for hdu in state])
+
+    def _write_state(self, state):
+        if not os.path.isdir(COADD_DIR):
+            os.makedirs(COADD_DIR)
+        state.writeto(self.state_file + '.tmp', overwrite=True)
+        os.rename(self.state_file + '.tmp', self.state_file)
+        with open(self.members_file, 'w') as f:
+            json.dump(self.members, f, indent=1, sort_keys=True)
+        return
+
+    def write(self, output=None):
+        """Write the current coadd as a regular multi-extension frame
+
+        The SCI extensions contain the running mean and the VAR
+        extensions its variance: propagated from the input variances if
+        all exposures had them, and from the scatter among exposures
+        otherwise. DQ flags pixels without any valid value.
+
+        Returns
+        -------
+        output : str
+            name of the output (without extension), `name` by default
+
+        """
+        if output is None:
+            output = self.name
+        state = self._read_state()
+        if state is None:
+            raise ValueError('{0} is empty'.format(self.name))
+        outlist = pyfits.HDUList([pyfits.PrimaryHDU(
+            header=state[0].header.copy())])
+        outlist[0].header['NCOMBINE'] = (
+            len(self.members), 'Number of combined frames')
+        for hdu in state[1:]:
+            if hdu.name in STATE and hdu.name != 'MEAN':
+                continue
+            if hdu.name != 'MEAN':
+                outlist.append(hdu.copy())
+                continue
+            ver = hdu.header['EXTVER']
+            wsum = state['WSUM', ver].data
+            npix = state['NPIX', ver].data
+            header = hdu.header.copy()
+            del header['EXTNAME']
+            outlist.append(pyfits.ImageHDU(
+                hdu.data.astype(np.float32), header=header, name='SCI'))
+            vsum = _extension(state, 'VSUM', ver)
+            safe = np.where(wsum > 0, wsum, 1)
+            if vsum is not None:
+                var = vsum.data / safe**2
+            else:
+                var = state['M2', ver].data / safe / np.maximum(npix-1, 1)
+            outlist.append(pyfits.ImageHDU(
+                var.astype(np.float32), header=header, name='VAR'))
+            outlist.append(pyfits.ImageHDU(
+                (npix == 0).astype(np.int16), header=header, name='DQ'))
+        outlist.writeto('{0}.fits'.format(output), overwrite=True)
+        return output
@@ -0,0 +1,405 @@
+"""
+Combine reduced multi-extension frames without IRAF.
+
+All exposures are opened as memory-mapped FITS files and each slit is
+combined in blocks of rows, so that only as many rows as fit within a
+given memory budget are read at a time, however many exposures there
+are. The output frame, which is the size of a single exposure, is
+written in a single pass. Row blocks can also be distributed over a pool
+of processes writing into a shared output buffer.
+
+Supported methods are those of `imcombine` most relevant to spectra:
+median, average (optionally weighted by inverse variance when the
+frames have VAR extensions) and sum, with optional sigma clipping.
+Pixels flagged in the DQ extensions are ignored.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import warnings
+from multiprocessing import Pool, current_process
+from time import time
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+from ..utilities import sharedmem
+
+METHODS = ('average', 'median', 'sum')
+REJECTIONS = ('none', 'sigclip')
+WEIGHTS = ('none', 'ivar')
+
+# bytes held in memory per input pixel while combining a block: data
+# and variance (float64), the valid-pixel mask and temporary arrays
+BYTES_PER_PIXEL = 48
+
+
+def sigma_clip(data, valid, lsigma=3., hsigma=3., maxiter=10):
+    """Iterative sigma clipping along the first axis
+
+    Parameters
+    ----------
+    data : array, shape ``(nimages, ...)``
+        values to clip
+    valid : boolean array, same shape as `data`
+        values to use. Not modified.
+    lsigma, hsigma : float
+        lower and upper clipping limits, in units of the standard
+        deviation of the valid values around their median (leaving
+        out the highest and lowest values if there are at least four)
+
+    Returns
+    -------
+    valid : boolean array
+        values that survive clipping
+
+    """
+    valid = valid.copy()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i in range(maxiter):
+            masked = np.where(valid, data, np.nan)
+            center = np.nanmedian(masked, axis=0)
+            n = valid.sum(axis=0)
+            sumsq = (np.where(valid, data - center, 0)**2).sum(axis=0)
+            # as in imcombine, leave out the extreme values so that a
+            # single cosmic ray does not inflate sigma
+            extremes = (np.nanmax(masked, axis=0) - center)**2 \
+                + (np.nanmin(masked, axis=0) - center)**2
+            sigma = np.where(
+                n >= 4, np.sqrt((sumsq - extremes) / np.maximum(n-3, 1)),
+                np.sqrt(sumsq / np.maximum(n-1, 1)))
+            keep = valid & (data >= center - lsigma*sigma) \
+                & (data <= center + hsigma*sigma)
+            # always keep at least one value
+            keep |= valid & (keep.sum(axis=0) == 0)
+            if (keep == valid).all():
+                break
+            valid = keep
+    return valid
+
+
+def combine_block(data, var=None, valid=None, method='average',
+                  reject='none', lsigma=3., hsigma=3., weights='none'):
+    """Combine a block of pixels along the first axis
+
+    Parameters
+    ----------
+    data : array, shape ``(nimages, ...)``
+        pixel values
+    var : array like `data`, optional
+        variances
+    valid : boolean array like `data`, optional
+        pixels to use (e.g., not flagged in DQ). Pixels that are not
+        valid in any image are combined from all images.
+    method : {'average', 'median', 'sum'}
+    reject : {'none', 'sigclip'}
+    weights : {'none', 'ivar'}
+        weight the average by the inverse variance (requires `var`)
+
+    Returns
+    -------
+    combined : array
+        combined values
+    variance : array or None
+        variance of `combined`, if `var` was given
+    nvalid : int array
+        number of values combined at each position
+
+    """
+    if method not in METHODS:
+        raise ValueError('method must be one of {0}'.format(METHODS))
+    if reject not in REJECTIONS:
+        raise ValueError('reject must be one of {0}'.format(REJECTIONS))
+    if weights not in WEIGHTS:
+        raise ValueError('weights must be one of {0}'.format(WEIGHTS))
+    if valid is None:
+        valid = np.ones(data.shape, dtype=bool)
+    valid = valid & np.isfinite(data)
+    if var is not None:
+        valid &= np.isfinite(var)
+    # positions without valid values use all values
+    valid |= (valid.sum(axis=0) == 0)
+    if reject == 'sigclip' and data.shape[0] >= 3:
+        valid = sigma_clip(data, valid, lsigma=lsigma, hsigma=hsigma)
+    nvalid = valid.sum(axis=0)
+    if weights == 'ivar' and var is not None:
+        w = np.where(valid & (var > 0), 1 / np.where(var > 0, var, 1), 0)
+        # positions where all variances are zero are averaged evenly
+        w = np.where(w.sum(axis=0) > 0, w, valid)
+    else:
+        w = valid.astype(float)
+    wsum = w.sum(axis=0)
+    wsum[wsum == 0] = 1
+    variance = None
+    if method == 'median':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            combined = np.nanmedian(np.where(valid, data, np.nan), axis=0)
+        if var is not None:
+            # variance of the median of n values, ~pi/2 times that of
+            # their mean
+            variance = np.pi/2 * (valid*var).sum(axis=0) \
+                / np.maximum(nvalid, 1)**2
+    else:
+        combined = (w*np.where(valid, data, 0)).sum(axis=0) / wsum
+        if var is not None:
+            variance = (w**2*np.where(valid, var, 0)).sum(axis=0) / wsum**2
+        if method == 'sum':
+            combined = combined * nvalid
+            if variance is not None:
+                variance = variance * nvalid**2
+    return combined, variance, nvalid
+
+
+def _extension(hdulist, name, ver):
+    try:
+        return hdulist[name, ver]
+    except KeyError:
+        return None
+
+
+def block_rows(nimages, nx, memory):
+    """Number of rows combined at a time within `memory` bytes"""
+    return max(1, int(memory // (nimages * nx * BYTES_PER_PIXEL)))
+
+
+def _combine_rows(hdulists, ver, rows, out_sci, out_var, out_dq, params):
+    """Combine rows `rows` of slit `ver` into the output arrays
+
+    Output arrays (`out_var` and `out_dq` may be None) are written in
+    place. Returns the number of input bytes read.
+
+    """
+    sci = [hdulist['SCI', ver].data for hdulist in hdulists]
+    data = np.array([s[rows] for s in sci], dtype=float)
+    variance = None
+    if out_var is not None:
+        variance = np.array([hdulist['VAR', ver].data[rows]
+                             for hdulist in hdulists], dtype=float)
+    valid = None
+    if out_dq is not None:
+        flags = np.array([hdulist['DQ', ver].data[rows]
+                          for hdulist in hdulists])
+        valid = (flags == 0)
+    combined, cvar, nvalid = combine_block(data, variance, valid, **params)
+    out_sci[rows] = combined
+    if out_var is not None:
+        out_var[rows] = cvar
+    if out_dq is not None:
+        # flag only pixels without any good value
+        out_dq[rows] = np.where(valid.any(axis=0), 0,
+                                np.bitwise_or.reduce(flags, axis=0))
+    return data.nbytes
+
+
+def _report(ver, rows, nbytes, dt):
+    print('  [SCI,{0}] rows {1}-{2}: {3:.1f} MB in {4:.2f} s ({5:.1f} MB/s)'
+          .format(ver, rows.start, rows.stop-1, nbytes / 1024**2, dt,
+                  nbytes / 1024**2 / max(dt, 1e-6)))
+    return
+
+
+# state of the worker processes of `_combine_parallel`
+_worker = {}
+
+
+def _init_worker(images, blocks, layout, params):
+    _worker['hdulists'] = [pyfits.open(image, memmap=True)
+                           for image in images]
+    _worker['blocks'] = blocks
+    _worker['layout'] = layout
+    _worker['params'] = params
+    return
+
+
+def _outputs(blocks, layout, ver):
+    """Views of the shared output buffers for slit `ver`"""
+    offset, shape, has_var, has_dq = layout[ver]
+    size = shape[0] * shape[1]
+    views = []
+    for name, dtype, present in (('SCI', np.float32, True),
+                                 ('VAR', np.float32, has_var),
+                                 ('DQ', np.int16, has_dq)):
+        if present:
+            views.append(sharedmem.array(blocks[name], dtype)
+                         [offset:offset+size].reshape(shape))
+        else:
+            views.append(None)
+    return views
+
+
+def _combine_shared(task):
+    ver, start, stop = task
+    to = time()
+    rows = slice(start, stop)
+    outputs = _outputs(_worker['blocks'], _worker['layout'], ver)
+    nbytes = _combine_rows(_worker['hdulists'], ver, rows, *outputs,
+                           params=_worker['params'])
+    # drop the views so the parent can close the shared blocks
+    del outputs
+    return ver, rows, nbytes, time() - to
+
+
+def _combine_parallel(images, layout, tasks, params, workers, verbose):
+    """Combine all row blocks over a pool of processes
+
+    Each worker opens the input frames (memory-mapped, read only) and
+    writes its blocks directly into shared output buffers, so only block
+    coordinates are sent between processes.
+
+    Returns
+    -------
+    arrays : dict
+        combined (SCI, VAR, DQ) arrays of each slit
+    nbytes : int
+        total input bytes read
+
+    """
+    sizes = dict((ver, shape[0]*shape[1])
+                 for ver, (offset, shape, has_var, has_dq) in layout.items())
+    total = sum(sizes.values())
+    blocks = {'SCI': sharedmem.allocate(4 * total),
+              'VAR': sharedmem.allocate(4 * total),
+              'DQ': sharedmem.allocate(2 * total)}
+    nbytes = 0
+    try:
+        pool = Pool(workers, _init_worker, (images, blocks, layout, params))
+        try:
+            for ver, rows, n, dt in pool.imap_unordered(
+                    _combine_shared, tasks):
+                nbytes += n
+                if verbose:
+                    _report(ver, rows, n, dt)
+        finally:
+            pool.close()
+            pool.join()
+        arrays = {}
+        for ver in layout:
+            outputs = _outputs(blocks, layout, ver)
+            arrays[ver] = [None if out is None else out.copy()
+                           for out in outputs]
+            del outputs
+    finally:
+        for block in blocks.values():
+            sharedmem.release(block)
+    return arrays, nbytes
+
+
+def combine(images, output, method='average', reject='none', lsigma=3.,
+            hsigma=3., weights='none', memory=1024, workers=1, rows=None,
+            verbose=True):
+    """Combine multi-extension frames slit by slit
+
+    Parameters
+    ----------
+    images : list of str
+        FITS files with the same ``[SCI,i]`` extensions (and optionally
+        ``[VAR,i]`` and ``[DQ,i]``) on the same grid
+    output : str
+        output file. Its primary header, and any extensions other than
+        SCI, VAR and DQ (e.g., the MDF), are those of the first image.
+    method, reject, lsigma, hsigma, weights
+        see `combine_block`
+    memory : float
+        approximate memory budget, in MB, shared among all workers
+    workers : int
+        number of processes among which row blocks are distributed.
+        The result does not depend on the number of workers. Ignored
+        within daemon processes (e.g., `scheduler.Scheduler` workers).
+    rows : int, optional
+        number of rows per block. By default, the largest number that
+        fits in `memory`.
+
+    Returns
+    -------
+    output : str
+        the output file name
+
+    """
+    to = time()
+    params = dict(method=method, reject=reject, lsigma=lsigma,
+                  hsigma=hsigma, weights=weights)
+    if current_process().daemon:
+        workers = 1
+    memory = memory * 1024**2 / workers
+    hdulists = [pyfits.open(image, memmap=True) for image in images]
+    try:
+        first = hdulists[0]
+        # slit extension versions and output layout
+        layout = {}
+        offset = 0
+        for hdu in first[1:]:
+            if hdu.name != 'SCI':
+                continue
+            ver = hdu.header['EXTVER']
+            shapes = set(hdulist['SCI', ver].data.shape
+                         for hdulist in hdulists)
+            if len(shapes) > 1:
+                raise ValueError('[SCI,{0}] has different shapes: {1}'.format(
+                    ver, sorted(shapes)))
+            has_var = all(_extension(hdulist, 'VAR', ver) is not None
+                          for hdulist in hdulists)
+            has_dq = all(_extension(hdulist, 'DQ', ver) is not None
+                         for hdulist in hdulists)
+            layout[ver] = (offset, hdu.data.shape, has_var, has_dq)
+            offset += hdu.data.size
+        tasks = []
+        for ver, (offset, (ny, nx), has_var, has_dq) in sorted(
+                layout.items()):
+            step = rows or block_rows(len(images), nx, memory)
+            tasks.extend((ver, start, min(start+step, ny))
+                         for start in range(0, ny, step))
+        if workers > 1 and len(tasks) > 1:
+            arrays, nbytes = _combine_parallel(
+                images, layout, tasks, params, workers, verbose)
+        else:
+            arrays = {}
+            for ver, (offset, shape, has_var, has_dq) in layout.items():
+                arrays[ver] = [
+                    np.empty(shape, dtype=np.float32),
+                    np.empty(shape, dtype=np.float32) if has_var else None,
+                    np.empty(shape, dtype=np.int16) if has_dq else None]
+            nbytes = 0
+            for ver, start, stop in tasks:
+                t1 = time()
+                n = _combine_rows(hdulists, ver, slice(start, stop),
+                                  *arrays[ver], params=params)
+                nbytes += n
+                if verbose:
+                    _report(ver, slice(start, stop), n, time()-t1)
+        # write the output in the order of the first image
+        outlist = pyfits.HDUList([pyfits.PrimaryHDU(
+            header=first[0].header.copy())])
+        outlist[0].header['NCOMBINE'] = (
+            len(images), 'Number of combined frames')
+        for hdu in first[1:]:
+            if hdu.name in ('VAR', 'DQ'):
+                continue
+            if hdu.name != 'SCI':
+                outlist.append(hdu.copy())
+                continue
+            ver = hdu.header['EXTVER']
+            out_sci, out_var, out_dq = arrays[ver]
+            outlist.append(pyfits.ImageHDU(
+                out_sci, header=hdu.header.copy(), name='SCI'))
+            if out_var is not None:
+                outlist.append(pyfits.ImageHDU(
+                    out_var, header=first['VAR', ver].header.copy(),
+                    name='VAR'))
+            if out_dq is not None:
+                outlist.append(pyfits.ImageHDU(
+                    out_dq, header=first['DQ', ver].header.copy(),
+                    name='DQ'))
+        outlist.writeto(output, overwrite=True)
+    finally:
+        for hdulist in hdulists:
+            hdulist.close()
+    if verbose:
+        dt = time() - to
+        print('Combined {0} frames into {1} in {2:.1f} s ({3:.1f} MB/s)'
+              .format(len(images), output, dt,
+                      nbytes / 1024**2 / max(dt, 1e-6)))
+    return output
@@ -0,0 +1,195 @@
+"""
+Cosmic ray rejection by comparing several exposures of the same mask.
+
+After `gstransform`, exposures of a mask taken with the same setup share
+the same pixel grid, so each pixel can be compared with the median of
+all exposures: a pixel that is higher than the (exposure time-scaled)
+median by more than `nsigma` times the expected noise is a cosmic ray.
+The noise model uses the GAIN and RDNOISE header keywords, as
+`lacosmic` does, plus a fraction `snoise` of the median (as the
+``snoise`` parameter of ``imcombine``), which allows for the ordinary
+differences between exposures: changes in seeing, which make object
+profiles sharper or broader, and in the strength of sky lines. This is
+much cheaper than detecting cosmic rays on each frame separately, and
+unlike Laplacian detection it does not mistake sharp emission lines for
+cosmic rays, but it needs at least three exposures to have a robust
+median, taken at the same telescope offset.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+from time import time
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+from .lacosmic import CR_BIT
+
+
+# telescope offsets (in arcsec), which move the objects along the slits
+OFFSET_KEYS = ('YOFFSET', 'POFFSET', 'QOFFSET')
+
+
+class GridMismatch(ValueError):
+    """Exposures do not share the same pixel grid"""
+    pass
+
+
+def _differ(headers, key, tolerance):
+    """Whether `key` differs among the headers that have it"""
+    values = [float(head[key]) for head in headers
+              if head.get(key) is not None]
+    return len(values) > 1 and np.ptp(values) > tolerance
+
+
+def _check_grid(headers, shapes, slit, primary=()):
+    """Raise `GridMismatch` if slits differ in shape or wavelength WCS,
+    or the exposures (with primary headers `primary`) in their offsets"""
+    for key in OFFSET_KEYS:
+        if _differ(primary, key, 1e-3):
+            raise GridMismatch('Exposures have different {0}: {1}'.format(
+                key, [head.get(key) for head in primary]))
+    if len(set(shapes)) > 1:
+        raise GridMismatch(
+            'Slit {0} has different shapes: {1}'.format(slit, shapes))
+    for key in ('CRVAL1', 'CRPIX1', 'CD1_1', 'CDELT1'):
+        if _differ(headers, key, 1e-6):
+            raise GridMismatch(
+                'Slit {0} has different {1}: {2}'.format(
+                    slit, key, [head.get(key) for head in headers]))
+    return
+
+
+def find_outliers(stack, gain, rdnoise, scales=None, nsigma=5.,
+                  sigfrac=0.5, snoise=0.1):
+    """Cosmic rays in a stack of registered images
+
+    Parameters
+    ----------
+    stack : 3d array
+        images, with shape ``(nimages, ny, nx)``, in ADU
+    gain : array of float
+        gain of each image, in e-/ADU
+    rdnoise : array of float
+        read noise of each image, in e-
+    scales : array of float, optional
+        relative flux scale of each image (e.g., the exposure times).
+        Images are divided by their scale to compute the median.
+    nsigma : float
+        detection limit
+    sigfrac : float
+        detection limit of the pixels next to a cosmic ray, as a
+        fraction of `nsigma` (as in `lacos_spec`)
+    snoise : float
+        fractional noise added to the model: the expected noise of a
+        pixel is ``sqrt(model/gain + (rdnoise/gain)**2 + (snoise*model)**2)``
+        (in ADU)
+
+    Returns
+    -------
+    model : 3d array
+        expected value of each pixel, from the median of all images
+    crmask : 3d boolean array
+        pixels affected by cosmic rays
+
+    """
+    n = stack.shape[0]
+    gain = np.asarray(gain, dtype=float).reshape(n, 1, 1)
+    rdnoise = np.asarray(rdnoise, dtype=float).reshape(n, 1, 1)
+    if scales is None:
+        scales = np.ones(n)
+    scales = np.asarray(scales, dtype=float).reshape(n, 1, 1)
+    model = np.median(stack / scales, axis=0)[None] * scales
+    positive = np.clip(model, 0, None)
+    noise = np.sqrt((positive*gain + rdnoise**2) / gain**2
+                    + (snoise*positive)**2)
+    significance = (stack - model) / noise
+    crmask = significance > nsigma
+    if sigfrac < 1 and crmask.any():
+        crmask |= _grow(crmask) & (significance > sigfrac*nsigma)
+    return model, crmask
+
+
+def _grow(mask):
+    """Grow each image of a 3d mask by one pixel in all directions"""
+    ny, nx = mask.shape[1:]
+    padded = np.pad(mask, ((0, 0), (1, 1), (1, 1)), mode='constant')
+    grown = np.zeros(mask.shape, dtype=bool)
+    for dy in range(3):
+        for dx in range(3):
+            grown |= padded[:, dy:dy+ny, dx:dx+nx]
+    return grown
+
+
+def clean_stack(images, outputs, nsigma=5., sigfrac=0.5, snoise=0.1,
+                verbose=True):
+    """Replace cosmic rays in registered exposures by the stack median
+
+    Parameters
+    ----------
+    images : list of str
+        transformed multi-extension FITS files (at least three), with the
+        same slits on the same pixel grid
+    outputs : list of str
+        output file names, one per image. Cosmic rays are flagged with
+        `CR_BIT` in their DQ extensions (if present).
+    nsigma, sigfrac, snoise : float
+        see `find_outliers`
+
+    Returns
+    -------
+    ncr : list of int
+        number of pixels flagged in each image
+
+    Raises
+    ------
+    GridMismatch
+        if the slits of the images do not share the same grid, or the
+        images were taken at different telescope offsets
+
+    """
+    if len(images) < 3:
+        raise ValueError('At least three images are needed')
+    to = time()
+    hdulists = [pyfits.open(image) for image in images]
+    try:
+        heads = [hdulist[0].header for hdulist in hdulists]
+        gain = [float(head['GAIN']) for head in heads]
+        rdnoise = [float(head['RDNOISE']) for head in heads]
+        scales = [float(head.get('EXPTIME', 1)) or 1. for head in heads]
+        ncr = np.zeros(len(images), dtype=int)
+        for hdu in hdulists[0]:
+            if hdu.name != 'SCI' or hdu.data is None:
+                continue
+            slit = hdu.header['EXTVER']
+            sci = [hdulist['SCI', slit] for hdulist in hdulists]
+            _check_grid([s.header for s in sci], [s.data.shape for s in sci],
+                        slit, primary=heads)
+            stack = np.array([s.data for s in sci], dtype=float)
+            model, crmask = find_outliers(
+                stack, gain, rdnoise, scales=scales, nsigma=nsigma,
+                sigfrac=sigfrac, snoise=snoise)
+            for i, (s, hdulist) in enumerate(zip(sci, hdulists)):
+                s.data = np.where(crmask[i], model[i], stack[i]).astype(
+                    s.data.dtype)
+                try:
+                    dq = hdulist['DQ', slit]
+                except KeyError:
+                    pass
+                else:
+                    dq.data = dq.data \
+                        | (CR_BIT * crmask[i]).astype(dq.data.dtype)
+            ncr += crmask.sum(axis=(1, 2))
+        for hdulist, output in zip(hdulists, outputs):
+            hdulist.writeto(output, overwrite=True)
+    finally:
+        for hdulist in hdulists:
+            hdulist.close()
+    if verbose:
+        for image, n in zip(images, ncr):
+            print('{0}: {1} pixels flagged'.format(image, n))
+        print('{0} exposures cleaned in {1:.1f} s'.format(
+            len(images), time()-to))
+    return [int(n) for n in ncr]
@@ -0,0 +1,136 @@
+"""
+Copy the slits of a combined or extracted frame to individual files.
+
+The frame is read once and all outputs are written from memory
+(optionally by a pool of processes), instead of calling `imcopy` once
+per slit. Alternatively, all slits can be written to a single
+multi-extension file with an INDEX table relating output names, slits
+and extensions, which is much lighter on the file system for large
+programs.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+from multiprocessing import Pool, current_process
+from time import time
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+
+def slit_number(hdu):
+    """Slit of an extension: SLIT if given (extracted spectra), EXTVER
+    otherwise"""
+    return int(hdu.header.get('SLIT', hdu.header.get('EXTVER', 1)))
+
+
+def spectrum_header(primary, header):
+    """Primary header updated with the keywords of an extension"""
+    merged = primary.copy()
+    merged.extend(header.cards, update=True, strip=True)
+    for key in ('EXTNAME', 'EXTVER'):
+        merged.remove(key, ignore_missing=True)
+    return merged
+
+
+def _write(task):
+    data, header, output = task
+    if os.path.isfile(output):
+        os.remove(output)
+    pyfits.PrimaryHDU(data, header=header).writeto(output)
+    return output
+
+
+def split(image, template, workers=1, verbose=True):
+    """Write each SCI extension of a frame to its own file
+
+    Parameters
+    ----------
+    image : str
+        multi-extension FITS file
+    template : str
+        output file name, formatted with the slit number (see
+        `slit_number`), e.g. ``'spectra/obj_mask_{0:02d}s.fits'``
+    workers : int, optional
+        number of processes writing files. Ignored within daemon
+        processes.
+
+    Returns
+    -------
+    outputs : list of str
+
+    """
+    to = time()
+    with pyfits.open(image) as hdulist:
+        primary = hdulist[0].header
+        tasks = [(hdu.data, spectrum_header(primary, hdu.header),
+                  template.format(slit_number(hdu)))
+                 for hdu in hdulist
+                 if hdu.name == 'SCI' and hdu.data is not None]
+        if workers > 1 and len(tasks) > 1 and not current_process().daemon:
+            pool = Pool(min(workers, len(tasks)))
+            try:
+                outputs = pool.map(_write, tasks, chunksize=8)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            outputs = [_write(task) for task in tasks]
+    if verbose:
+        print('{0}: {1} slits written in {2:.1f} s'.format(
+            image, len(outputs), time()-to))
+    return outputs
+
+
+def write_multispec(image, output, names, verbose=True):
+    """Write all slits of a frame to a single indexed file
+
+    The output contains the primary header of `image`, an INDEX table
+    with the output name, slit and extension version of each spectrum,
+    and the SCI (and VAR, if present) extensions of all slits, with
+    EXTVER equal to their slit number.
+
+    Parameters
+    ----------
+    image : str
+        multi-extension FITS file
+    output : str
+        output file name
+    names : str
+        name of each spectrum in the index, formatted with the slit
+        number (as `template` in `split`)
+
+    """
+    to = time()
+    with pyfits.open(image) as hdulist:
+        sci = [hdu for hdu in hdulist
+               if hdu.name == 'SCI' and hdu.data is not None]
+        slits = [slit_number(hdu) for hdu in sci]
+        index = pyfits.BinTableHDU.from_columns([
+            pyfits.Column(name='NAME', format='64A',
+                          array=[names.format(slit) for slit in slits]),
+            pyfits.Column(name='SLIT', format='J', array=slits),
+            pyfits.Column(name='EXTVER', format='J', array=slits)],
+            name='INDEX')
+        outlist = pyfits.HDUList(
+            [pyfits.PrimaryHDU(header=hdulist[0].header.copy()), index])
+        for hdu, slit in zip(sci, slits):
+            header = hdu.header.copy()
+            header['EXTVER'] = slit
+            outlist.append(pyfits.ImageHDU(hdu.data, header=header,
+                                           name='SCI'))
+            try:
+                var = hdulist['VAR', hdu.header['EXTVER']]
+            except KeyError:
+                continue
+            header = var.header.copy()
+            header['EXTVER'] = slit
+            outlist.append(pyfits.ImageHDU(var.data, header=header,
+                                           name='VAR'))
+        outlist.writeto(output, overwrite=True)
+    if verbose:
+        print('{0}: {1} slits written to {2} in {3:.1f} s'.format(
+            image, len(sci), output, time()-to))
+    return output
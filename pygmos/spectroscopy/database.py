@@ -0,0 +1,210 @@
+"""
+Reading and writing IRAF database records.
+
+`identify` (run by `gswavelength`) and `fitcoords` store their
+solutions as text files in the ``database`` folder (``id<arc>_NNN`` and
+``fc<arc>_NNN`` for slit NNN), made of records such as::
+
+    begin	identify gsarc_001[*,47]
+    	id	gsarc_001
+    	task	identify
+    	features	2
+    	        36.09  4764.865  4764.865    4.0 1 1
+    	       183.95  5017.163  5017.163    4.0 1 1
+    	function	chebyshev
+    	coefficients	6
+    		1.
+    		...
+
+Each record is kept as a `Record`: its name and an ordered list of
+fields, each with a value and the (possibly empty) list of lines that
+follow it, so that records can be modified and written back with the
+same layout.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import os
+from numpy.polynomial import chebyshev, legendre
+from time import strftime
+
+# IRAF curfit and gsurfit function codes
+FUNCTIONS = {1: 'chebyshev', 2: 'legendre', 3: 'spline3', 4: 'spline1'}
+
+
+class Record(object):
+
+    """A record of an IRAF database file
+
+    Parameters
+    ----------
+    name : str
+        everything after ``begin`` in the first line
+    fields : list of [key, value, lines] lists
+        fields of the record
+
+    """
+
+    def __init__(self, name, fields=None):
+        self.name = name
+        self.fields = [] if fields is None else fields
+
+    def __contains__(self, key):
+        return any(field[0] == key for field in self.fields)
+
+    def _field(self, key):
+        for field in self.fields:
+            if field[0] == key:
+                return field
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """Value of a field"""
+        try:
+            return self._field(key)[1]
+        except KeyError:
+            return default
+
+    def set(self, key, value, lines=None):
+        """Set the value (and following lines) of a field"""
+        try:
+            field = self._field(key)
+        except KeyError:
+            field = [key, '', []]
+            self.fields.append(field)
+        field[1] = str(value)
+        if lines is not None:
+            field[2] = list(lines)
+        return
+
+    def table(self, key):
+        """Lines following a field, as a 2d float array"""
+        lines = self._field(key)[2]
+        if not lines:
+            return np.zeros((0, 0))
+        return np.array([[float(x) for x in line.split()]
+                         for line in lines])
+
+    def set_table(self, key, values, fmt='{0:.12g}'):
+        """Set the lines following a field (and their number as its
+        value) from a 1d or 2d array"""
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            lines = ['\t' + fmt.format(x) for x in values]
+        else:
+            lines = [' ' + ' '.join(fmt.format(x) for x in row)
+                     for row in values]
+        self.set(key, len(lines), lines)
+        return
+
+    def format(self):
+        lines = ['begin\t{0}'.format(self.name)]
+        for key, value, extra in self.fields:
+            lines.append('\t{0}\t{1}'.format(key, value).rstrip())
+            lines.extend('\t{0}'.format(line) for line in extra)
+        return '\n'.join(lines) + '\n'
+
+
+def read(filename):
+    """All records of a database file
+
+    Returns
+    -------
+    records : list of `Record`
+
+    """
+    records = []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            if line.startswith('begin'):
+                records.append(Record(line[5:].strip()))
+            elif not records:
+                continue
+            elif line.startswith('\t') and line[1:2] not in (' ', '\t', ''):
+                # a new field
+                parts = line[1:].split(None, 1)
+                records[-1].fields.append(
+                    [parts[0], parts[1] if len(parts) > 1 else '', []])
+            elif records[-1].fields:
+                # continuation of the previous field
+                records[-1].fields[-1][2].append(line[1:])
+    return records
+
+
+def write(filename, records):
+    """Write records to a database file, replacing it
+
+    The file is removed first, so that a link to it (e.g., to the
+    calibration cache) is replaced rather than written through.
+
+    """
+    folder = os.path.dirname(filename)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    if os.path.lexists(filename):
+        os.remove(filename)
+    with open(filename, 'w') as f:
+        print(strftime('# %a %H:%M:%S %d-%b-%Y'), file=f)
+        for record in records:
+            print(record.format(), file=f)
+    return
+
+
+def _basis(function):
+    if function in ('chebyshev', 1):
+        return chebyshev.chebval
+    if function in ('legendre', 2):
+        return legendre.legval
+    raise NotImplementedError(
+        'Unsupported function: {0}'.format(function))
+
+
+def evaluate(record, x):
+    """Dispersion solution of an `identify` record at pixels `x`
+
+    Only Chebyshev and Legendre polynomials are supported.
+
+    """
+    coeffs = record.table('coefficients')[:, 0]
+    function = FUNCTIONS[int(coeffs[0])]
+    xmin, xmax = coeffs[2], coeffs[3]
+    n = (2 * np.asarray(x, dtype=float) - (xmax + xmin)) / (xmax - xmin)
+    return _basis(function)(n, coeffs[4:])
+
+
+def shift(record, dx):
+    """Shift the solution of an `identify` or `fitcoords` record by `dx`
+    pixels along x, in place
+
+    The normalization range of the polynomials is shifted, which is
+    exact for Chebyshev and Legendre functions, and so are the feature
+    positions of `identify` records.
+
+    """
+    if 'coefficients' in record:
+        key, index = 'coefficients', (2, 3)
+    else:
+        key, index = 'surface', (4, 5)
+    lines = record._field(key)[2]
+    for i in index:
+        lines[i] = '\t{0!r}'.format(float(lines[i]) + float(dx))
+    if 'features' in record:
+        # only the first column (the pixel position) changes
+        field = record._field('features')
+        field[2] = ['{0:13.2f}{1}'.format(
+                        float(line.split()[0]) + dx,
+                        line.lstrip()[len(line.split()[0]):])
+                    for line in field[2]]
+    return record
+
+
+def rename(record, old, new):
+    """Replace the image name `old` by `new` in a record, in place"""
+    record.name = record.name.replace(old, new)
+    for field in record.fields:
+        field[1] = field[1].replace(old, new)
+    return record
@@ -0,0 +1,389 @@
+"""
+Optimal extraction of 1d spectra without IRAF.
+
+Objects are found in each rectified slit by collapsing it along the
+dispersion direction and looking for peaks in the spatial profile.
+Their traces are measured in bins of columns, and their spectra are
+extracted with the optimal extraction algorithm of Horne (1986, PASP
+98, 609), including the rejection of outlying pixels and the
+propagation of variances. Slits without a detected object are
+extracted through a fixed aperture at their center, as in `gsextract`,
+so that every slit has a spectrum.
+
+All apertures of all slits are extracted at once: the pixels around
+each trace are gathered into a single ``(apertures, rows, columns)``
+array, padded where slits differ in size. All spectra are then written
+to a single file, with one ``[SCI,i]`` (and ``[VAR,i]``) extension per
+aperture.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import warnings
+from time import time
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+from .arcid import PIXEL_SCALE
+
+# wavelength WCS keywords copied from each slit to its spectra
+WCS_KEYS = ('CTYPE1', 'CUNIT1', 'CRVAL1', 'CRPIX1', 'CDELT1', 'CD1_1',
+            'DISPAXIS', 'WAT0_001', 'WAT1_001', 'WAT2_001')
+
+
+def _robust_sigma(values):
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return 0.
+    return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+
+def spatial_profile(data):
+    """Median of each row of a slit"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(data, axis=1)
+
+
+def find_apertures(profile, nsigma=5., min_separation=4,
+                   max_apertures=None):
+    """Objects in a spatial profile
+
+    Parameters
+    ----------
+    profile : 1d array
+        spatial profile of a slit (see `spatial_profile`)
+    nsigma : float
+        detection limit, above the median of the profile and in units
+        of its robust scatter
+    min_separation : int
+        minimum separation between apertures, in rows
+    max_apertures : int, optional
+        keep only the brightest apertures
+
+    Returns
+    -------
+    apertures : list of (float, int) tuples
+        center (0-indexed row) and half-width of each aperture, ordered
+        by position
+
+    """
+    good = np.isfinite(profile)
+    if good.sum() < 3:
+        return []
+    p = np.where(good, profile, -np.inf)
+    level = np.median(profile[good])
+    sigma = _robust_sigma(profile)
+    if sigma == 0:
+        sigma = np.std(profile[good]) or 1.
+    threshold = level + nsigma*sigma
+    peaks = np.nonzero((p[1:-1] > p[:-2]) & (p[1:-1] >= p[2:])
+                       & (p[1:-1] > threshold))[0] + 1
+    peaks = sorted(peaks, key=lambda i: -p[i])
+    selected = []
+    for i in peaks:
+        if all(abs(i - j) >= min_separation for j in selected):
+            selected.append(i)
+        if max_apertures and len(selected) == max_apertures:
+            break
+    apertures = []
+    for i in sorted(selected):
+        # parabolic refinement of the peak
+        a, b, c = p[i-1], p[i], p[i+1]
+        denom = a - 2*b + c
+        offset = 0.5 * (a - c) / denom \
+            if np.isfinite(denom) and denom != 0 else 0.
+        # half width at half maximum
+        half = level + (p[i] - level) / 2
+        left = i
+        while left > 0 and p[left-1] > half:
+            left -= 1
+        right = i
+        while right < p.size - 1 and p[right+1] > half:
+            right += 1
+        fwhm = right - left + 1
+        apertures.append((i + float(np.clip(offset, -0.5, 0.5)),
+                          max(2, int(np.ceil(1.5 * fwhm)))))
+    # apertures must not overlap
+    for k in range(len(apertures) - 1):
+        (c1, h1), (c2, h2) = apertures[k], apertures[k+1]
+        limit = max(1, int((c2 - c1) / 2))
+        apertures[k] = (c1, min(h1, limit))
+        apertures[k+1] = (c2, min(h2, limit))
+    return apertures
+
+
+def trace(data, center, halfwidth, nbins=20, order=1):
+    """Position of an aperture along the dispersion direction
+
+    The centroid of the aperture is measured in `nbins` bins of
+    columns and fit with a polynomial, with one round of rejection.
+
+    Returns
+    -------
+    ycen : 1d array
+        center of the aperture (0-indexed row) at each column
+
+    """
+    ny, nx = data.shape
+    lo = max(0, int(round(center)) - halfwidth)
+    hi = min(ny, int(round(center)) + halfwidth + 1)
+    rows = np.arange(lo, hi)
+    edges = np.linspace(0, nx, nbins+1).astype(int)
+    xc = []
+    yc = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for start, end in zip(edges[:-1], edges[1:]):
+            if end <= start:
+                continue
+            prof = np.nanmedian(data[lo:hi, start:end], axis=1)
+            prof = np.where(np.isfinite(prof), prof, 0)
+            prof = prof - np.min(prof)
+            if prof.sum() <= 0:
+                continue
+            xc.append((start + end - 1) / 2)
+            yc.append((rows * prof).sum() / prof.sum())
+    x = np.arange(nx)
+    xc = np.array(xc)
+    yc = np.array(yc)
+    if xc.size <= order + 2:
+        return np.full(nx, float(center))
+    coeffs = np.polyfit(xc, yc, order)
+    resid = yc - np.polyval(coeffs, xc)
+    good = np.abs(resid) <= 3 * max(_robust_sigma(resid), 0.1)
+    if good.sum() > order + 1:
+        coeffs = np.polyfit(xc[good], yc[good], order)
+    ycen = np.polyval(coeffs, x)
+    # the trace should not wander off the aperture
+    return np.clip(ycen, center - halfwidth, center + halfwidth)
+
+
+def _smooth(values, width):
+    """Running mean along the last axis, ignoring NaNs"""
+    if width <= 1:
+        return values
+    good = np.isfinite(values)
+    filled = np.where(good, values, 0)
+    pad = [(0, 0)] * (values.ndim - 1) + [(1, 0)]
+    csum = np.cumsum(np.pad(filled, pad, mode='constant'), axis=-1)
+    ccount = np.cumsum(np.pad(good.astype(float), pad, mode='constant'),
+                       axis=-1)
+    n = values.shape[-1]
+    half = width // 2
+    start = np.clip(np.arange(n) - half, 0, n)
+    end = np.clip(np.arange(n) + half + 1, 0, n)
+    total = csum[..., end] - csum[..., start]
+    count = ccount[..., end] - ccount[..., start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def optimal_extract(data, variance=None, readvar=None, gain=1.,
+                    niter=3, sigclip=5., smooth=31):
+    """Horne optimal extraction of a stack of apertures
+
+    Parameters
+    ----------
+    data : 3d array, shape ``(apertures, rows, columns)``
+        sky-subtracted pixels around each trace, NaN where missing
+    variance : 3d array, optional
+        pixel variances. If not given, the variance is modelled as
+        ``readvar + |model| / gain``
+    readvar : array of shape ``(apertures,)``, optional
+        variance of the background (read noise and sky) of each
+        aperture, in the units of `data`. Only used without `variance`.
+    gain : float or array of shape ``(apertures,)``
+        gain in e-/ADU. Only used without `variance`.
+    niter : int
+        number of iterations of the profile fit and pixel rejection
+    sigclip : float
+        rejection limit for outlying pixels (e.g., cosmic rays)
+    smooth : int
+        width, in columns, of the running mean used to estimate the
+        spatial profile
+
+    Returns
+    -------
+    flux, var : 2d arrays, shape ``(apertures, columns)``
+        extracted spectra and their variances
+    mask : 3d boolean array
+        pixels used in the extraction
+
+    """
+    naps = data.shape[0]
+    mask = np.isfinite(data)
+    if variance is not None:
+        mask &= np.isfinite(variance) & (variance > 0)
+    D = np.where(mask, data, 0)
+    modelled = variance is None
+    if modelled:
+        readvar = np.ones(naps) if readvar is None else np.asarray(readvar)
+        readvar = readvar.reshape(naps, 1, 1)
+        gain = np.asarray(gain, dtype=float) * np.ones(naps)
+        gain = gain.reshape(naps, 1, 1)
+        V = readvar + np.abs(D) / gain
+    else:
+        V = np.where(mask, variance, 1)
+    V = np.where(V > 0, V, 1)
+    flux = D.sum(axis=1)
+    for i in range(niter):
+        # spatial profile, from the data normalized by the flux in each
+        # column and smoothed along the dispersion direction
+        with np.errstate(invalid='ignore', divide='ignore'):
+            raw = np.where(mask, D / flux[:, None, :], np.nan)
+        P = _smooth(raw, smooth)
+        P = np.where(np.isfinite(P) & (P > 0), P, 0)
+        norm = P.sum(axis=1)
+        P = P / np.where(norm > 0, norm, 1)[:, None, :]
+        # optimal weights
+        denom = (mask * P**2 / V).sum(axis=1)
+        safe = np.where(denom > 0, denom, 1)
+        flux = np.where(denom > 0, (mask * P * D / V).sum(axis=1) / safe, 0)
+        var = np.where(denom > 0, (mask * P).sum(axis=1) / safe, np.inf)
+        model = flux[:, None, :] * P
+        if modelled:
+            V = readvar + np.abs(model) / gain
+        # reject the worst outlier of each column, if significant
+        resid = np.where(mask, (D - model)**2 / V, 0)
+        worst = resid.argmax(axis=1)
+        cols = np.arange(resid.shape[2])
+        aps = np.arange(naps)[:, None]
+        reject = resid[aps, worst, cols] > sigclip**2
+        if not reject.any():
+            break
+        mask[aps, worst, cols] &= ~reject
+    return flux, var, mask
+
+
+def _windows(slit, ycen, halfwidth, height):
+    """Rows within `halfwidth` of the trace, NaN outside the slit"""
+    ny, nx = slit.shape
+    offsets = np.arange(height) - height // 2
+    rows = np.round(ycen).astype(int)[None, :] + offsets[:, None]
+    inside = (rows >= 0) & (rows < ny) \
+        & (np.abs(offsets) <= halfwidth)[:, None]
+    values = slit[np.clip(rows, 0, ny-1), np.arange(nx)[None, :]]
+    return np.where(inside, values, np.nan)
+
+
+def extract_file(image, output, nsigma=5., max_apertures=None,
+                 niter=3, sigclip=5., apwidth=1., verbose=True):
+    """Find and optimally extract all objects of a (combined) frame
+
+    Parameters
+    ----------
+    image : str
+        rectified, sky-subtracted multi-extension FITS file
+    output : str
+        output file, with one ``[SCI,i]`` (and ``[VAR,i]`` if the input
+        has VAR extensions) 1d extension per aperture. The header of
+        each spectrum records its slit (SLIT) and aperture center and
+        half-width (APCENTER, APHWIDTH).
+    nsigma, max_apertures
+        see `find_apertures`. In MOS slits, only the brightest object
+        is extracted unless `max_apertures` is given.
+    niter, sigclip
+        see `optimal_extract`
+    apwidth : float
+        width, in arcsec, of the aperture extracted at the center of
+        slits where no object is found, as in `gsextract` (these
+        spectra have APFIXED = True)
+
+    Returns
+    -------
+    napertures : int
+        number of extracted spectra
+
+    """
+    to = time()
+    with pyfits.open(image) as hdulist:
+        head = hdulist[0].header
+        gain = float(head.get('GAINMULT', head.get('GAIN', 1.)))
+        rdnoise = float(head.get('RDNOISE', 0.))
+        slits = [hdu for hdu in hdulist
+                 if hdu.name == 'SCI' and hdu.data is not None]
+        longslit = len(slits) == 1
+        ybin = int(str(head.get('CCDSUM', '1 1')).split()[-1])
+        fixed = max(2, int(round(apwidth / (2 * PIXEL_SCALE * ybin))))
+        if max_apertures is None and not longslit:
+            max_apertures = 1
+        apertures = []
+        for hdu in slits:
+            ver = hdu.header.get('EXTVER', 1)
+            data = hdu.data.astype(float)
+            try:
+                variance = hdulist['VAR', ver].data.astype(float)
+            except KeyError:
+                variance = None
+            found = find_apertures(spatial_profile(data), nsigma=nsigma,
+                                   max_apertures=max_apertures)
+            centered = not found
+            if centered:
+                found = [((data.shape[0] - 1) / 2,
+                          min(fixed, (data.shape[0] - 1) // 2))]
+            # background (read and sky) noise, away from the apertures
+            background = np.ones(data.shape[0], dtype=bool)
+            for center, halfwidth in found:
+                lo = max(0, int(round(center)) - halfwidth)
+                background[lo:int(round(center)) + halfwidth + 1] = False
+            readvar = _robust_sigma(data[background])**2 \
+                if background.any() else rdnoise**2 / gain**2
+            for center, halfwidth in found:
+                if centered:
+                    ycen = np.full(data.shape[1], center)
+                else:
+                    ycen = trace(data, center, halfwidth)
+                apertures.append(dict(
+                    hdu=hdu, data=data, variance=variance, ycen=ycen,
+                    center=center, halfwidth=halfwidth, readvar=readvar,
+                    fixed=centered))
+        if not apertures:
+            raise ValueError('No objects found in {0}'.format(image))
+        height = 2 * max(ap['halfwidth'] for ap in apertures) + 1
+        nx = max(ap['data'].shape[1] for ap in apertures)
+        stack = np.full((len(apertures), height, nx), np.nan)
+        has_var = all(ap['variance'] is not None for ap in apertures)
+        varstack = np.full(stack.shape, np.nan) if has_var else None
+        for k, ap in enumerate(apertures):
+            n = ap['data'].shape[1]
+            stack[k, :, :n] = _windows(
+                ap['data'], ap['ycen'], ap['halfwidth'], height)
+            if has_var:
+                varstack[k, :, :n] = _windows(
+                    ap['variance'], ap['ycen'], ap['halfwidth'], height)
+        flux, var, mask = optimal_extract(
+            stack, varstack, readvar=[ap['readvar'] for ap in apertures],
+            gain=gain, niter=niter, sigclip=sigclip)
+        outlist = pyfits.HDUList([pyfits.PrimaryHDU(header=head.copy())])
+        for hdu in hdulist[1:]:
+            if hdu.name not in ('SCI', 'VAR', 'DQ'):
+                outlist.append(hdu.copy())
+        for k, ap in enumerate(apertures):
+            n = ap['data'].shape[1]
+            header = pyfits.Header()
+            for key in WCS_KEYS:
+                if key in ap['hdu'].header:
+                    header[key] = ap['hdu'].header[key]
+            header['SLIT'] = (ap['hdu'].header.get('EXTVER', 1),
+                              'Slit extension of this spectrum')
+            header['APCENTER'] = (ap['center'] + 1,
+                                  'Aperture center (1-indexed row)')
+            header['APHWIDTH'] = (ap['halfwidth'],
+                                  'Aperture half-width (rows)')
+            header['APFIXED'] = (ap['fixed'],
+                                 'No object found; aperture at slit center')
+            outlist.append(pyfits.ImageHDU(
+                flux[k, :n].astype(np.float32), header=header, name='SCI',
+                ver=k+1))
+            outlist.append(pyfits.ImageHDU(
+                var[k, :n].astype(np.float32), header=header.copy(),
+                name='VAR', ver=k+1))
+        outlist.writeto(output, overwrite=True)
+    if verbose:
+        print('Extracted {0} spectra from {1} slits of {2} in {3:.1f} s'
+              .format(len(apertures), len(slits), image, time()-to))
+    return len(apertures)
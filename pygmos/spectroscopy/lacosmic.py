@@ -0,0 +1,325 @@
+"""
+Laplacian cosmic ray rejection for spectra (L.A.Cosmic) on NumPy arrays.
+
+This is a translation of `lacos_spec.cl` (van Dokkum 2001, PASP 113,
+1420) that processes all slits of a multi-extension FITS file in memory,
+instead of running the CL script (and its ~20 temporary images) once per
+slit. Each step of the CL script is noted in the comments below. It
+requires `scipy`.
+
+Slits are independent, so they can also be distributed over a pool of
+processes (see `clean_file`) sharing a single copy of the frame.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import warnings
+from multiprocessing import Pool, current_process
+from numpy.polynomial import legendre
+from time import time
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+try:
+    from scipy import ndimage
+    _have_scipy = True
+except ImportError:
+    _have_scipy = False
+
+from ..utilities import sharedmem
+
+# Gemini data quality bit for pixels affected by cosmic rays
+CR_BIT = 8
+
+LAPLACIAN = np.array([[0, -1, 0], [-1, 4, -1], [0, -1, 0]], dtype=float)
+GROWTH = np.ones((3, 3), dtype=bool)
+
+
+def fit1d(data, order, axis=1, low=4., high=4., niter=3, chunk=256):
+    """Iteratively clipped Legendre fit of every line of an image
+
+    Equivalent to IRAF's ``fit1d(type='fit', function='legendre')``,
+    with all lines fit simultaneously.
+
+    Parameters
+    ----------
+    data : 2d array
+        image
+    order : int
+        number of polynomial terms (as in IRAF)
+    axis : {1, 2}
+        IRAF axis along which to fit: 1 fits each row along x, 2 fits
+        each column along y
+    low, high : float
+        rejection limits, in units of the rms of the residuals
+    niter : int
+        maximum number of rejection iterations
+    chunk : int
+        number of lines fit at a time, to limit memory usage
+
+    Returns
+    -------
+    model : 2d array
+        the fit, with the same shape as `data`
+
+    """
+    lines = data if axis == 1 else data.T
+    n = lines.shape[1]
+    x = np.linspace(-1, 1, n) if n > 1 else np.zeros(1)
+    basis = legendre.legvander(x, order-1)
+    model = np.empty(lines.shape)
+    for start in range(0, lines.shape[0], chunk):
+        y = lines[start:start+chunk]
+        use = np.isfinite(y)
+        y = np.where(use, y, 0)
+        for i in range(niter+1):
+            weighted = use[:, :, None] * basis
+            lhs = np.matmul(weighted.transpose(0, 2, 1), basis)
+            rhs = np.einsum('ij,ijk->ik', y, weighted)
+            try:
+                coeffs = np.linalg.solve(lhs, rhs[:, :, None])[:, :, 0]
+            # too few points left in some line
+            except np.linalg.LinAlgError:
+                coeffs = np.matmul(
+                    np.linalg.pinv(lhs), rhs[:, :, None])[:, :, 0]
+            fit = np.dot(coeffs, basis.T)
+            if i == niter:
+                break
+            resid = y - fit
+            nused = use.sum(axis=1)
+            sigma = np.sqrt((use * resid**2).sum(axis=1)
+                            / np.maximum(nused-1, 1))[:, None]
+            keep = use & (resid >= -low*sigma) & (resid <= high*sigma)
+            if (keep == use).all():
+                break
+            use = keep
+        model[start:start+chunk] = fit
+    return model if axis == 1 else model.T
+
+
+def _median(data, size):
+    return ndimage.median_filter(data, size=size, mode='nearest')
+
+
+def _masked_median(data, mask, size=5):
+    """Median of the unmasked pixels around each masked pixel
+
+    Only computed at masked pixels (zero elsewhere), which is all the
+    cleaning step needs. Pixels whose neighbours are all masked are set
+    to zero, i.e., to the level of the residual image.
+
+    """
+    median = np.zeros(data.shape)
+    rows, cols = np.nonzero(mask)
+    if rows.size == 0:
+        return median
+    half = size // 2
+    padded = np.pad(np.where(mask, np.nan, data), half, mode='edge')
+    offsets = np.arange(size)
+    windows = padded[rows[:, None, None] + offsets[None, :, None],
+                     cols[:, None, None] + offsets[None, None, :]]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        values = np.nanmedian(windows.reshape(rows.size, -1), axis=1)
+    median[rows, cols] = np.where(np.isnan(values), 0, values)
+    return median
+
+
+def lacos_spec(data, gain, readn, xorder=9, yorder=3, sigclip=4.5,
+               sigfrac=0.5, objlim=1., niter=4, verbose=True):
+    """Remove cosmic rays from a 2d spectrum
+
+    Parameters are those of `lacos_spec.cl`.
+
+    Returns
+    -------
+    clean : 2d array
+        cosmic ray-cleaned image
+    crmask : 2d boolean array
+        pixels identified as cosmic rays
+
+    """
+    if gain <= 0:
+        raise ValueError('Gain is required')
+    data = np.asarray(data, dtype=float)
+    # subtract object spectra and sky lines
+    if xorder > 0:
+        galaxy = fit1d(data, xorder, axis=1)
+    else:
+        galaxy = np.zeros(data.shape)
+    residual = data - galaxy
+    if yorder > 0:
+        skymod = fit1d(residual, yorder, axis=2)
+        residual = residual - skymod
+    else:
+        skymod = np.zeros(data.shape)
+    skymod = skymod + galaxy
+    crmask = np.zeros(data.shape, dtype=bool)
+    sigcliplow = sigfrac * sigclip
+    for i in range(1, niter+1):
+        # noise model from the median-filtered image plus models
+        med5 = _median(residual, 5) + skymod
+        med5[med5 <= 0] = 0.00001
+        noise = np.sqrt(med5*gain + readn**2) / gain
+        # Laplacian of the 2x2 block-replicated image, with negative
+        # values set to zero, block-averaged back
+        blk = np.repeat(np.repeat(residual, 2, axis=0), 2, axis=1)
+        lapla = ndimage.convolve(blk, LAPLACIAN, mode='nearest')
+        lapla[lapla < 0] = 0
+        ny, nx = residual.shape
+        deriv2 = lapla.reshape(ny, 2, nx, 2).mean(axis=(1, 3))
+        # the Laplacian of block-replicated images counts edges twice
+        sigmap = deriv2 / noise / 2
+        # remove large structure (bright, extended objects)
+        sigmap = sigmap - _median(sigmap, 5)
+        # candidate cosmic rays
+        firstsel = sigmap > sigclip
+        # reject candidates that are not sharper than the underlying
+        # object (i.e., emission lines and compact sources)
+        med3 = _median(residual, 3)
+        finestruct = (med3 - _median(med3, 7)) / noise
+        finestruct[finestruct <= 0.01] = 0.01
+        firstsel &= sigmap / finestruct > objlim
+        # grow by one pixel, checking against the sigma map
+        gfirstsel = ndimage.binary_dilation(firstsel, GROWTH) \
+            & (sigmap > sigclip)
+        # grow once more with a lower detection limit
+        finalsel = ndimage.binary_dilation(gfirstsel, GROWTH) \
+            & (sigmap > sigcliplow)
+        npix = (finalsel & ~crmask).sum()
+        # replace cosmic rays by the median of the surrounding clean pixels
+        crmask |= finalsel
+        residual = np.where(
+            crmask, _masked_median(residual, crmask, 5), residual)
+        if verbose:
+            print('{0} cosmic rays found in iteration {1}'.format(npix, i))
+        if npix == 0:
+            break
+    return residual + skymod, crmask
+
+
+def _clean(data, gain, readn, kwargs):
+    """`lacos_spec` on a single slit, also returning the time it took"""
+    to = time()
+    clean, crmask = lacos_spec(data, gain, readn, verbose=False, **kwargs)
+    return clean, crmask, time() - to
+
+
+# shared memory blocks of the worker processes
+_shared = {}
+
+
+def _init_worker(data, mask):
+    _shared['data'] = data
+    _shared['mask'] = mask
+    return
+
+
+def _clean_shared(task):
+    """Clean one slit in the shared buffers, in place"""
+    offset, shape, gain, readn, kwargs = task
+    size = shape[0] * shape[1]
+    data = sharedmem.array(_shared['data'], np.float64)[offset:offset+size]
+    mask = sharedmem.array(_shared['mask'], np.uint8)[offset:offset+size]
+    clean, crmask, dt = _clean(data.reshape(shape), gain, readn, kwargs)
+    data[:] = clean.ravel()
+    mask[:] = crmask.ravel()
+    # drop the views so the parent can close the shared blocks
+    del data, mask
+    return dt
+
+
+def _clean_parallel(images, gain, readn, workers, kwargs):
+    """Clean all slits over a pool of processes
+
+    All slits are copied once into a single shared buffer, from which
+    the workers read and into which they write the cleaned pixels and
+    cosmic ray masks, so no data are sent between processes.
+
+    """
+    offsets = np.cumsum([0] + [image.size for image in images])
+    data_block = sharedmem.allocate(8 * offsets[-1])
+    mask_block = sharedmem.allocate(offsets[-1])
+    try:
+        data = sharedmem.array(data_block, np.float64)
+        mask = sharedmem.array(mask_block, np.uint8)
+        for image, offset in zip(images, offsets):
+            data[offset:offset+image.size] = image.ravel()
+        tasks = [(offset, image.shape, gain, readn, kwargs)
+                 for image, offset in zip(images, offsets)]
+        pool = Pool(min(workers, len(images)), _init_worker,
+                    (data_block, mask_block))
+        try:
+            times = pool.map(_clean_shared, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        results = [
+            (data[offset:offset+image.size].reshape(image.shape).copy(),
+             mask[offset:offset+image.size].reshape(image.shape) > 0, dt)
+            for image, offset, dt in zip(images, offsets, times)]
+        del data, mask
+    finally:
+        sharedmem.release(data_block)
+        sharedmem.release(mask_block)
+    return results
+
+
+def clean_file(science, output, gain, readn, workers=1, verbose=True,
+               **kwargs):
+    """Run `lacos_spec` on all science extensions of a reduced frame
+
+    The input is read once and the cleaned frame is written in a single
+    pass, with cosmic rays flagged with `CR_BIT` in the DQ extensions
+    (if present).
+
+    Parameters
+    ----------
+    science : str
+        reduced multi-extension FITS file
+    output : str
+        cleaned output file
+    workers : int, optional
+        number of processes among which slits are distributed. Ignored
+        (i.e., set to 1) within daemon processes, such as the workers
+        of `scheduler.Scheduler`, which cannot have children.
+    kwargs : dict
+        passed to `lacos_spec`
+
+    Returns
+    -------
+    ncr : int
+        total number of pixels flagged as cosmic rays
+
+    """
+    ncr = 0
+    to = time()
+    with pyfits.open(science) as hdulist:
+        slits = [hdu for hdu in hdulist
+                 if hdu.name == 'SCI' and hdu.data is not None]
+        if workers > 1 and len(slits) > 1 \
+                and not current_process().daemon:
+            results = _clean_parallel(
+                [hdu.data for hdu in slits], gain, readn, workers, kwargs)
+        else:
+            results = (_clean(hdu.data, gain, readn, kwargs)
+                       for hdu in slits)
+        for i, (hdu, (clean, crmask, dt)) in enumerate(zip(slits, results)):
+            slit = hdu.header.get('EXTVER', i+1)
+            hdu.data = clean.astype(hdu.data.dtype)
+            try:
+                dq = hdulist['DQ', slit]
+            except KeyError:
+                pass
+            else:
+                dq.data = dq.data | (CR_BIT * crmask).astype(dq.data.dtype)
+            ncr += crmask.sum()
+            if verbose:
+                print('{0}[SCI,{1}]: {2} pixels flagged in {3:.1f} s'.format(
+                    science, slit, crmask.sum(), dt))
+        hdulist.writeto(output, overwrite=True)
+    if verbose:
+        print('{0} slits cleaned in {1:.1f} s'.format(len(slits), time()-to))
+    return ncr
@@ -0,0 +1,328 @@
+"""
+Redshifts of extracted spectra by cross-correlation with templates.
+
+Following Tonry & Davis (1979, AJ, 84, 1511), as in `xcsao`: spectra
+and templates are rebinned to a common grid in log-wavelength, where a
+redshift is a shift, their continua are subtracted and their ends
+tapered, and the redshift is given by the highest peak of their
+cross-correlation within the allowed range. Its significance is the
+ratio ``r`` of the peak height to the noise of the correlation,
+estimated from its antisymmetric part.
+
+All spectra are correlated with all templates at once through FFTs,
+in chunks of spectra distributed over a pool of processes.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import os
+from multiprocessing import Pool, current_process
+from time import time
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+from astropy.table import Table
+
+from .lacosmic import fit1d
+
+
+def wavelength(header, n):
+    """Wavelength of each pixel of a 1d spectrum, from its WCS
+
+    Log-linear spectra (``DC-FLAG = 1``) are supported.
+
+    """
+    delta = header.get('CD1_1', header.get('CDELT1', 1.))
+    pixels = np.arange(n) + 1
+    wave = header.get('CRVAL1', 1.) \
+        + (pixels - header.get('CRPIX1', 1.)) * delta
+    if header.get('DC-FLAG', 0) == 1:
+        wave = 10**wave
+    return wave
+
+
+def read_spectrum(filename):
+    """Wavelength and flux of a spectrum
+
+    `filename` is either a FITS file with a 1d spectrum in its primary
+    or first SCI extension, or a text file with wavelength and flux
+    columns.
+
+    """
+    if not filename.endswith(('.fits', '.fit', '.fits.gz')):
+        wave, flux = np.loadtxt(filename, usecols=(0, 1), unpack=True)
+        return wave, flux
+    with pyfits.open(filename) as hdulist:
+        hdu = hdulist[0] if hdulist[0].data is not None \
+            else hdulist['SCI', 1]
+        flux = np.ravel(hdu.data).astype(float)
+        header = hdulist[0].header.copy()
+        header.update(hdu.header)
+    return wavelength(header, flux.size), flux
+
+
+def read_multispec(filename):
+    """Spectra (see `fit`) from a file written by `cut.write_multispec`,
+    named as in its INDEX table"""
+    spectra = []
+    with pyfits.open(filename) as hdulist:
+        for row in hdulist['INDEX'].data:
+            hdu = hdulist['SCI', int(row['EXTVER'])]
+            flux = np.ravel(hdu.data).astype(float)
+            header = hdulist[0].header.copy()
+            header.update(hdu.header)
+            spectra.append(({'name': str(row['NAME']).strip()},
+                            wavelength(header, flux.size), flux))
+    return spectra
+
+
+def _is_multispec(filename):
+    if not filename.endswith(('.fits', '.fit', '.fits.gz')):
+        return False
+    with pyfits.open(filename) as hdulist:
+        return 'INDEX' in [hdu.name for hdu in hdulist]
+
+
+def read_files(filenames):
+    """Spectra (see `fit`) from the files written by
+    `tasks.cut_spectra`, either one per spectrum or indexed files with
+    all spectra of a mask (see `read_multispec`)"""
+    spectra = []
+    for filename in filenames:
+        if _is_multispec(filename):
+            spectra.extend(read_multispec(filename))
+            continue
+        wave, flux = read_spectrum(filename)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        spectra.append(({'name': name}, wave, flux))
+    return spectra
+
+
+def read_store(store, **criteria):
+    """Spectra (see `fit`) from a `store.SpectraStore`, optionally
+    selected as in `SpectraStore.select`"""
+    spectra = []
+    for record in store.select(**criteria):
+        meta = {'name': '{0}_{1}_{2:02d}'.format(
+                    record['object'], record['mask'], record['slit']),
+                'object': record['object'], 'mask': record['mask'],
+                'slit': record['slit']}
+        spectra.append((meta, store.wavelength(record),
+                        np.array(store.flux(record), dtype=float)))
+    return spectra
+
+
+def log_grid(waves, step=None):
+    """Common grid in natural log-wavelength
+
+    Covers all wavelength arrays in `waves`, with a step equal to the
+    finest median dispersion among them unless given.
+
+    """
+    logs = [np.log(w[np.isfinite(w) & (w > 0)]) for w in waves]
+    if step is None:
+        step = min(np.median(np.abs(np.diff(lw))) for lw in logs
+                   if lw.size > 1)
+    start = min(lw.min() for lw in logs)
+    end = max(lw.max() for lw in logs)
+    return start + step * np.arange(int(np.ceil((end-start) / step)) + 1)
+
+
+def rebin(spectra, grid):
+    """Interpolate spectra onto `grid`, NaN outside their ranges
+
+    Parameters
+    ----------
+    spectra : list of (wave, flux) tuples
+    grid : 1d array
+        log-wavelength grid
+
+    Returns
+    -------
+    stack : 2d array, shape ``(len(spectra), grid.size)``
+
+    """
+    stack = np.full((len(spectra), grid.size), np.nan)
+    for i, (wave, flux) in enumerate(spectra):
+        good = np.isfinite(flux) & np.isfinite(wave) & (wave > 0)
+        if good.sum() < 2:
+            continue
+        logw = np.log(wave[good])
+        order = np.argsort(logw)
+        inside = (grid >= logw[order[0]]) & (grid <= logw[order[-1]])
+        stack[i, inside] = np.interp(
+            grid[inside], logw[order], flux[good][order])
+    return stack
+
+
+def prepare(stack, continuum=7, taper=0.05):
+    """Continuum-subtracted, tapered and normalized spectra
+
+    Parameters
+    ----------
+    stack : 2d array
+        rebinned spectra, NaN outside their ranges
+    continuum : int
+        number of terms of the Legendre continuum fit
+    taper : float
+        fraction of each end of the valid range of every spectrum
+        tapered with a cosine bell
+
+    Returns
+    -------
+    prepared : 2d array
+        spectra with unit norm, and zero outside their ranges
+
+    """
+    valid = np.isfinite(stack)
+    cont = fit1d(stack, continuum, axis=1, low=2.5, high=2.5, niter=3)
+    resid = np.where(valid, stack - cont, 0)
+    # cosine bell over the ends of the valid range of each spectrum
+    n = stack.shape[1]
+    index = np.arange(n)
+    first = np.where(valid.any(axis=1), valid.argmax(axis=1), 0)
+    last = n - 1 - np.where(valid.any(axis=1),
+                            valid[:, ::-1].argmax(axis=1), n-1)
+    length = np.maximum(last - first, 1)[:, None]
+    position = (index[None] - first[:, None]) / length
+    edge = np.clip(np.minimum(position, 1 - position) / taper, 0, 1)
+    prepared = resid * 0.5 * (1 - np.cos(np.pi * edge))
+    norm = np.sqrt((prepared**2).sum(axis=1))
+    return prepared / np.where(norm > 0, norm, 1)[:, None]
+
+
+def _fft_size(n):
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+
+def correlate(spectra, templates, lags, nfft):
+    """Peaks of the cross-correlations of spectra with templates
+
+    Parameters
+    ----------
+    spectra, templates : 2d arrays
+        prepared spectra (see `prepare`) on the same grid
+    lags : 1d int array
+        allowed shifts, in pixels of the grid
+    nfft : int
+        FFT length (at least twice the grid size)
+
+    Returns
+    -------
+    shift : 2d array, shape ``(len(spectra), len(templates))``
+        sub-pixel position of the highest peak within `lags`
+    height : 2d array
+        height of the peak (normalized correlation coefficient)
+    r : 2d array
+        Tonry & Davis significance of the peak
+
+    """
+    S = np.fft.rfft(spectra, nfft)
+    T = np.fft.rfft(templates, nfft)
+    xc = np.fft.irfft(S[:, None, :] * np.conj(T)[None], nfft)
+    window = xc[..., lags % nfft]
+    best = window.argmax(axis=-1)
+    peak = lags[best]
+    height = np.take_along_axis(window, best[..., None], -1)[..., 0]
+    # parabolic refinement
+    left = np.take_along_axis(xc, ((peak - 1) % nfft)[..., None], -1)[..., 0]
+    right = np.take_along_axis(xc, ((peak + 1) % nfft)[..., None], -1)[..., 0]
+    denom = left - 2*height + right
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(denom < 0, 0.5 * (left - right) / denom, 0)
+    shift = peak + np.clip(offset, -0.5, 0.5)
+    # antisymmetric part of the correlation about the peak
+    m = np.arange(1, nfft // 2)
+    plus = np.take_along_axis(xc, (peak[..., None] + m) % nfft, -1)
+    minus = np.take_along_axis(xc, (peak[..., None] - m) % nfft, -1)
+    sigma_a = np.sqrt(np.mean(((plus - minus) / 2)**2, axis=-1))
+    r = height / (np.sqrt(2) * np.where(sigma_a > 0, sigma_a, np.inf))
+    return shift, height, r
+
+
+def _correlate(args):
+    return correlate(*args)
+
+
+def fit(spectra, templates, zmin=0., zmax=1.5, continuum=7, chunk=64,
+        workers=1, verbose=True):
+    """Redshifts of many spectra
+
+    Parameters
+    ----------
+    spectra : list of (dict, wave, flux) tuples
+        metadata, wavelength and flux of each spectrum. The metadata
+        (which must include a 'name') are copied to the catalog.
+    templates : list of (str, wave, flux) tuples
+        name, rest-frame wavelength and flux of each template
+    zmin, zmax : float
+        redshift range
+    continuum : int
+        see `prepare`
+    chunk : int
+        number of spectra correlated at a time
+    workers : int, optional
+        number of processes among which chunks are distributed. Ignored
+        within daemon processes.
+
+    Returns
+    -------
+    catalog : `astropy.table.Table`
+        metadata, redshift (z), significance (r) and correlation height
+        (height) of each spectrum, for the best template (template),
+        i.e., the one giving the highest r
+
+    """
+    to = time()
+    waves = [wave for meta, wave, flux in spectra] \
+        + [wave for name, wave, flux in templates]
+    grid = log_grid(waves)
+    step = grid[1] - grid[0]
+    nfft = _fft_size(2 * grid.size)
+    lags = np.arange(int(np.floor(np.log(1 + zmin) / step)),
+                     int(np.ceil(np.log(1 + zmax) / step)) + 1)
+    stack = prepare(rebin([(wave, flux) for meta, wave, flux in spectra],
+                          grid), continuum=continuum)
+    temp = prepare(rebin([(wave, flux) for name, wave, flux in templates],
+                         grid), continuum=continuum)
+    tasks = [(stack[i:i+chunk], temp, lags, nfft)
+             for i in range(0, len(spectra), chunk)]
+    if workers > 1 and len(tasks) > 1 and not current_process().daemon:
+        pool = Pool(min(workers, len(tasks)))
+        try:
+            results = pool.map(_correlate, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_correlate(task) for task in tasks]
+    shift, height, r = [np.concatenate(x) for x in zip(*results)]
+    best = r.argmax(axis=1)
+    rows = np.arange(len(spectra))
+    catalog = Table(rows=[meta for meta, wave, flux in spectra])
+    catalog['z'] = np.exp(shift[rows, best] * step) - 1
+    catalog['r'] = r[rows, best]
+    catalog['height'] = height[rows, best]
+    catalog['template'] = [templates[i][0] for i in best]
+    catalog['z'].format = '.5f'
+    catalog['r'].format = '.2f'
+    catalog['height'].format = '.3f'
+    if verbose:
+        print('Redshifts of {0} spectra with {1} templates in {2:.1f} s'
+              .format(len(spectra), len(templates), time()-to))
+    return catalog
+
+
+def read_templates(filenames):
+    """Templates (see `fit`) from files (see `read_spectrum`)"""
+    templates = []
+    for filename in filenames:
+        wave, flux = read_spectrum(filename)
+        templates.append((os.path.splitext(os.path.basename(filename))[0],
+                          wave, flux))
+    return templates
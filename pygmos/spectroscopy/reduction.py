@@ -2,16 +2,18 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import sys
+from copy import copy
 from time import sleep
 from pyraf import iraf
-from iraf import gemini, gmos
+from iraf import gemini
 
-from . import check_gswave, tasks
-from ..inventory import inventory
+from . import check_gswave, scheduler, tasks
+from ..inventory import headerindex, inventory
+from ..inventory.watch import Watcher
 from ..utilities import utils
 
 
-def longslit(args, waves, assoc):
+def longslit(args, waves, association):
     """Reduce longslit data"""
     combine = []
     mask = 'longslit'
@@ -20,9 +22,9 @@ def longslit(args, waves, assoc):
     utils.makedir(path)
         
     for wave in waves:
-        flats = inventory.get_file_longslit(assoc, obs='flat', wave=wave)     
-        arcs = inventory.get_file_longslit(assoc, obs='arc', wave=wave)
-        sciences = inventory.get_file_longslit(assoc, obs='science', wave=wave)
+        flats = association.get_file_longslit(obs='flat', wave=wave)
+        arcs = association.get_file_longslit(obs='arc', wave=wave)
+        sciences = association.get_file_longslit(obs='science', wave=wave)
 
         iraf.chdir(path)
         
@@ -36,7 +38,8 @@ def longslit(args, waves, assoc):
                 utils.create_symlink(f, args.force_overwrite)
             
             flat, comb = tasks.call_gsflat(args, flat)
-            arc = tasks.call_gsreduce(args, arc, flat, args.bias, comb)
+            arc = tasks.call_gsreduce(args, arc, flat, args.bias, comb,
+                                      calibration=True)
             science = tasks.call_gsreduce(args, science, flat, args.bias, comb)
             tasks.call_gdisplay(args, science, 1)
             science = tasks.call_lacos(args, science, longslit=True)
@@ -46,7 +49,10 @@ def longslit(args, waves, assoc):
 
             science = tasks.call_gstransform(args, science, arc)
             tasks.call_gdisplay(args, science, 1)
-            combine.append(tasks.call_gsskysub(args, science))
+            combine.append(
+                tasks.call_gsskysub(args, science, longslit=True))
+            if args.coadd:
+                tasks.call_coadd(args, str(mask), combine, longslit=True)
             
         if len(combine) == len(waves):
             added = tasks.call_imcombine(
@@ -54,23 +60,22 @@ def longslit(args, waves, assoc):
             tasks.call_gdisplay(args, added, 1)
 
         spectra = tasks.call_gsextract(args, added)
-        Naps = raw_input('Number of apertures extracted: ')
-        # In case you don't see the message after so many
-        # consecutive "Enters"
-        while Naps == '':
-            Naps = raw_input('Please enter number of apertures extracted: ')
-        Naps = int(Naps)
-        tasks.cut_apertures(args, spectra, '{}_'.format(args.objectid), Naps)
+        Naps = tasks.cut_apertures(
+            args, spectra, '{}_'.format(args.objectid))
+        print('{0} apertures extracted'.format(Naps))
+        tasks.store_spectra(args, spectra, mask)
         utils.delete('tmp*')
         iraf.chdir('../..')
     return
 
 
-def mos(args, mask, files_science, assoc, align_suffix='_aligned'):
+def mos(args, mask, files_science, association, align_suffix='_aligned'):
     """The reduction process for MOS data.
 
     It goes through file identification, calibration and extraction of
-    spectra.
+    spectra. Cosmic rays are removed by comparing exposures with each
+    other when there are enough of them with the same setup (see
+    `crstack_groups`), and with LACos otherwise.
 
     """
     Nmasks = 0
@@ -78,16 +83,15 @@ def mos(args, mask, files_science, assoc, align_suffix='_aligned'):
     print('Mask {0}'.format(mask), end=2*'\n')
     path = os.path.join(args.objectid, mask).replace(' ', '_')
 
-    # for now
-    bias = args.bias
-
     # debugging - I don't think this should ever happen but hey
     if not files_science:
         raise ValueError('Empty variable `files_science`')
 
+    stacked = crstack_groups(args, mask, files_science, association)
+    transformed = dict((wave, []) for wave in stacked)
     for science in files_science:
-        flat = inventory.get_file(
-            assoc, science, mask, obs='flat', wave=files_science[science])
+        wave = files_science[science]
+        flat = association.get_file(science, mask, obs='flat', wave=wave)
         # finding the flat is enough to know that the mask exists.
         if not flat:
             print('Not enough data for mask {0} (science file {1})'.format(
@@ -95,56 +99,430 @@ def mos(args, mask, files_science, assoc, align_suffix='_aligned'):
             continue
         # all observations add up to 1
         Nmasks += 1 / len(files_science.keys())
-        arc = inventory.get_file(
-            assoc, science, mask, obs='arc', wave=files_science[science])
+        arc = association.get_file(science, mask, obs='arc', wave=wave)
         iraf.chdir(path)
 
-        # first gsreduce the flat to create the gradient image for gscut
-        grad = tasks.create_gradimage(args, flat, bias)
-        flat, comb = tasks.call_gsflat(args, flat)
-        arc = tasks.call_gsreduce(args, arc, flat, bias, grad)
-        science = tasks.call_gsreduce(args, science, flat, bias, grad)
-        tasks.call_gdisplay(args, science, 1)
-        Nslits = utils.get_nslits(science)
-        science = tasks.call_lacos(args, science, Nslits)
-        tasks.call_gdisplay(args, science, 1)
-        tasks.call_gswave(args, arc)
-        tasks.call_gstransform(args, arc, arc)
-        if args.align:
-            tasks.call_align(arc, align, Nslits)
-        science = tasks.call_gstransform(args, science, arc)
-        if args.align:
-            tasks.call_align(science, align_suffix, Nslits)
-            tasks.call_gdisplay(args, science + align_suffix, 1)
-            science = tasks.call_gsskysub(args, science, align_suffix)
-            tasks.call_gdisplay(args, science, 1)
-            combine.append(science)
+        if wave in stacked:
+            science, Nslits = reduce_exposure(
+                args, science, flat, arc, align_suffix=align_suffix,
+                crstack=True)
+            transformed[wave].append(science)
         else:
-            tasks.call_gdisplay(args, science, 1)
-            science = tasks.call_gsskysub(args, science, '')
-            tasks.call_gdisplay(args, science, 1)
+            science, Nslits = reduce_exposure(
+                args, science, flat, arc, align_suffix=align_suffix)
             combine.append(science)
-        # once we've reduced all individual images
-        if len(combine) == len(files_science.keys()):
-            added = tasks.call_imcombine(
-                args, mask, combine, path, Nslits)
-            tasks.call_gdisplay(args, added, 1)
-            spectra = tasks.call_gsextract(args, added)
-            if args.align:
-                aligned = tasks.call_align(added, align, Nslits)
-                tasks.call_gdisplay(args, aligned, 1)
+            if args.coadd:
+                tasks.call_coadd(args, mask, combine)
         utils.delete('tmp*')
         iraf.chdir('../..')
 
+    if not combine and not any(transformed.values()):
+        return Nmasks
+    iraf.chdir(path)
+    for wave in sorted(transformed):
+        for science in tasks.call_crstack(args, transformed[wave], Nslits):
+            combine.append(sky_subtract(args, science, Nslits, align_suffix))
+            if args.coadd:
+                tasks.call_coadd(args, mask, combine)
+    # once we've reduced all individual images
+    added = tasks.call_imcombine(args, mask, combine, path, Nslits)
+    tasks.call_gdisplay(args, added, 1)
+    spectra = tasks.call_gsextract(args, added)
+    if args.align:
+        aligned = tasks.call_align(added, align_suffix, Nslits)
+        tasks.call_gdisplay(args, aligned, 1)
+    utils.delete('tmp*')
+    iraf.chdir('../..')
+
     # cut spectra
     tasks.cut_spectra(args, added, mask, spec='2d', path=path)
     tasks.cut_spectra(args, spectra, mask, spec='1d', path=path)
-    check_gswave.main(
-        args.objectid, mask, gmos.gswavelength.logfile, 'gswcheck.log')
+    tasks.store_spectra(args, spectra, mask, path=path)
+    bad = check_gswave.main(path, mask, 'gswcheck.log')
+    if bad and args.fix_slits:
+        fix_slits(args, mask, files_science, association, bad)
     return Nmasks
 
 
-def ns(args, cluster, mask, files_science, assoc, cutdir,
+def fix_slits(args, mask, files_science, association, slits,
+              suffix='_slits'):
+    """Reduce again only some slits of a MOS mask reduced by `mos`.
+
+    The reduced arcs are cut down to `slits` (see `tasks.call_subset`)
+    and their lines identified again, with the engine not given by
+    --wave-engine (the same engine would find the same solution). Only
+    the slits whose solution is better than before in all arcs (see
+    `wavecheck.improved`) are then transformed, cleaned,
+    sky-subtracted, combined and extracted as in `mos`, from subsets of
+    the science frames, so that the cost is proportional to the number
+    of slits. Their solutions and products replace those of the same
+    slits in the whole mask, and `mos` is run again to record the
+    provenance of the updated products (see `utils.skip`), cut the
+    spectra and check the new solutions. --align is not supported.
+
+    Returns the slits that were replaced.
+
+    """
+    print('Mask {0}: reducing slits {1} again'.format(
+        mask, ', '.join(str(slit) for slit in slits)), end=2*'\n')
+    path = os.path.join(args.objectid, mask).replace(' ', '_')
+    redo = copy(args)
+    redo.wave_engine = 'iraf' if args.wave_engine == 'native' else 'native'
+    stacked = crstack_groups(args, mask, files_science, association)
+    exposures = []
+    arcs = {}
+    iraf.chdir(path)
+    for science in sorted(files_science):
+        wave = files_science[science]
+        flat = association.get_file(science, mask, obs='flat', wave=wave)
+        if not flat:
+            continue
+        arc = association.get_file(science, mask, obs='arc', wave=wave)
+        arc, science, _ = prepare_exposure(
+            args, science, flat, arc, crstack=(wave in stacked))
+        exposures.append((arc, science, wave))
+        # arcs may be shared by several exposures
+        if arc not in arcs:
+            arcs[arc] = tasks.call_subset(args, arc, slits, suffix)
+            tasks.call_gswave(redo, arcs[arc], transfer=False)
+    better = tasks.compare_solutions(args, arcs, slits)
+    if better != list(slits):
+        for arc, subset in arcs.items():
+            tasks.discard_subset(args, subset)
+        utils.delete('tmp*')
+        iraf.chdir('../..')
+        if not better:
+            print('No better wavelength solutions for slits {0} of mask' \
+                  ' {1}'.format(', '.join(str(i) for i in slits), mask))
+            return []
+        return fix_slits(args, mask, files_science, association, better,
+                         suffix=suffix)
+    transformed = dict((wave, []) for wave in stacked)
+    subsets = list(arcs.values())
+    products = [tasks.call_gstransform(args, subset, subset)
+                for subset in arcs.values()]
+    combine = []
+    Nslits = len(slits)
+    for arc, science, wave in exposures:
+        subsets.append(tasks.call_subset(args, science, slits, suffix))
+        science = tasks.call_gstransform(args, subsets[-1], arcs[arc])
+        products.append(science)
+        if wave in stacked:
+            transformed[wave].append(science)
+            continue
+        combine.append(tasks.call_gsskysub(args, science))
+    for wave in sorted(transformed):
+        for science in tasks.call_crstack(args, transformed[wave], Nslits):
+            products.append(science)
+            combine.append(tasks.call_gsskysub(args, science))
+    products.extend(combine)
+    added = tasks.call_imcombine(args, mask + suffix, combine, path, Nslits)
+    products.extend([added, tasks.call_gsextract(args, added)])
+    for arc, subset in arcs.items():
+        tasks.splice_solutions(args, subset, arc, slits)
+    updated = tasks.splice_slits(args, products, slits, suffix)
+    for image in subsets:
+        utils.delete('{0}.fits'.format(image))
+    utils.delete('tmp*')
+    iraf.chdir('../..')
+    restamp = copy(args)
+    restamp.restamp = set(
+        ['{0}.fits'.format(image) for image in updated]
+        + [os.path.join('database', 'id{0}_001'.format(arc))
+           for arc in arcs])
+    restamp.fix_slits = False
+    restamp.force_overwrite = False
+    restamp.ds9 = False
+    mos(restamp, mask, files_science, association)
+    return list(slits)
+
+
+def crstack_groups(args, mask, files_science, association):
+    """Central wavelengths with enough exposures to compare them.
+
+    Exposures of a mask taken at the same central wavelength share the
+    same grid after `gstransform`, so their cosmic rays can be found by
+    comparing them with each other (`tasks.call_crstack`) if there are
+    at least `args.crstack_min` of them (and at least three).
+
+    """
+    if args.crstack_min < 1:
+        return set()
+    counts = {}
+    for science, wave in files_science.items():
+        if association.get_file(science, mask, obs='flat', wave=wave):
+            counts[wave] = counts.get(wave, 0) + 1
+    return set(wave for wave, n in counts.items()
+               if n >= max(args.crstack_min, 3))
+
+
+def reduce_exposure(args, science, flat, arc, align_suffix='_aligned',
+                    crstack=False):
+    """Reduce a single science exposure up to sky subtraction.
+
+    Must be called from within the mask directory. Returns the name of
+    the sky-subtracted frame and the number of slits. If `crstack` is
+    set, cosmic rays are not removed and the reduction stops after
+    `gstransform` (returning the transformed frame), so that cosmic rays
+    can be found by comparing exposures (see `tasks.call_crstack`).
+
+    """
+    arc, science, Nslits = prepare_exposure(
+        args, science, flat, arc, crstack=crstack)
+    tasks.call_gswave(args, arc)
+    tasks.call_gstransform(args, arc, arc)
+    if args.align:
+        tasks.call_align(arc, align_suffix, Nslits)
+    science = tasks.call_gstransform(args, science, arc)
+    if crstack:
+        return science, Nslits
+    return sky_subtract(args, science, Nslits, align_suffix), Nslits
+
+
+def prepare_exposure(args, science, flat, arc, crstack=False):
+    """Reduce an arc and a science exposure up to the wavelength
+    calibration (see `reduce_exposure`).
+
+    Returns the names of the reduced arc and science frames and the
+    number of slits.
+
+    """
+    bias = args.bias
+    # first gsreduce the flat to create the gradient image for gscut
+    grad = tasks.create_gradimage(args, flat, bias)
+    flat, comb = tasks.call_gsflat(args, flat)
+    arc = tasks.call_gsreduce(args, arc, flat, bias, grad, calibration=True)
+    science = tasks.call_gsreduce(args, science, flat, bias, grad)
+    tasks.call_gdisplay(args, science, 1)
+    Nslits = utils.get_nslits(science)
+    if not crstack:
+        science = tasks.call_lacos(args, science, Nslits)
+        tasks.call_gdisplay(args, science, 1)
+    return arc, science, Nslits
+
+
+def sky_subtract(args, science, Nslits, align_suffix='_aligned'):
+    """Align (if requested) and sky-subtract a transformed frame"""
+    if args.align:
+        tasks.call_align(science, align_suffix, Nslits)
+        tasks.call_gdisplay(args, science + align_suffix, 1)
+        science = tasks.call_gsskysub(args, science, align_suffix)
+    else:
+        tasks.call_gdisplay(args, science, 1)
+        science = tasks.call_gsskysub(args, science, '')
+    tasks.call_gdisplay(args, science, 1)
+    return science
+
+
+def mos_parallel(args, masks, association):
+    """Reduce several MOS masks with a pool of `args.jobs` processes.
+
+    The reduction steps of all exposures of all masks are scheduled as
+    a dependency graph (see `mos_graph`), so that independent exposures
+    and masks are reduced at the same time. Frames are not displayed
+    and --align is not supported in this mode.
+
+    """
+    graph = scheduler.Scheduler(jobs=args.jobs)
+    for mask in masks:
+        mos_graph(graph, args, mask, association)
+    results, failed = graph.run()
+    if args.fix_slits:
+        # slits of each mask that failed the check (see `mos_graph`)
+        for mask in masks:
+            bad = results.get('wavecheck {0}'.format(mask))
+            if bad:
+                fix_slits(args, mask, association.science_files(mask),
+                          association, bad)
+    for mask in masks:
+        path = os.path.join(args.objectid, mask).replace(' ', '_')
+        utils.delete(os.path.join(path, 'tmp*'))
+    if failed:
+        print('\nThe following steps did not finish:')
+        for name in failed:
+            print('  {0}'.format(name))
+    return results
+
+
+def mos_graph(graph, args, mask, association):
+    """Add the reduction steps of a MOS mask to a `scheduler.Scheduler`.
+
+    The steps are the same as in `mos`, with one node per task and
+    frame. Calibrations shared by several exposures are processed once.
+
+    """
+    path = os.path.join(args.objectid, mask).replace(' ', '_')
+    bias = args.bias
+    files_science = association.science_files(mask)
+    stacked = crstack_groups(args, mask, files_science, association)
+    transformed = dict((wave, []) for wave in stacked)
+    skysub = []
+    solutions = []
+    for science in sorted(files_science):
+        wave = files_science[science]
+        flat = association.get_file(science, mask, obs='flat', wave=wave)
+        if not flat:
+            print('Not enough data for mask {0} (science file {1})'.format(
+                    mask, science))
+            continue
+        arc = association.get_file(science, mask, obs='arc', wave=wave)
+        # may prompt the user, so runs in the main process
+        grad = graph.add(
+            'gradimage {0}'.format(flat), tasks.create_gradimage, args,
+            flat, bias, path=path, local=True)
+        gsflat = graph.add(
+            'gsflat {0}'.format(flat), tasks.call_gsflat, args, flat,
+            path=path)
+        arc_red = graph.add(
+            'gsreduce {0}'.format(arc), tasks.call_gsreduce, args, arc,
+            gsflat[0], bias, grad, calibration=True, path=path)
+        sci_red = graph.add(
+            'gsreduce {0}'.format(science), tasks.call_gsreduce, args,
+            science, gsflat[0], bias, grad, path=path)
+        if wave in stacked:
+            sci_lacos = sci_red
+        else:
+            sci_lacos = graph.add(
+                'lacos {0}'.format(science), _lacos, args, sci_red,
+                path=path)
+        gswave = graph.add(
+            'gswavelength {0}'.format(arc), tasks.call_gswave, args, arc_red,
+            path=path)
+        solutions.append(gswave.name)
+        arc_trans = graph.add(
+            'gstransform {0}'.format(arc), tasks.call_gstransform, args,
+            arc_red, arc_red, path=path, deps=[gswave.name])
+        sci_trans = graph.add(
+            'gstransform {0}'.format(science), tasks.call_gstransform, args,
+            sci_lacos, arc_red, path=path, deps=[arc_trans.name])
+        if wave in stacked:
+            transformed[wave].append((science, sci_trans))
+            continue
+        skysub.append(graph.add(
+            'gsskysub {0}'.format(science), tasks.call_gsskysub, args,
+            sci_trans, '', path=path))
+    for wave in sorted(transformed):
+        if not transformed[wave]:
+            continue
+        cleaned = graph.add(
+            'crstack {0} {1}'.format(mask, wave), _crstack, args,
+            [frame for science, frame in transformed[wave]], path=path)
+        for i, (science, frame) in enumerate(transformed[wave]):
+            skysub.append(graph.add(
+                'gsskysub {0}'.format(science), tasks.call_gsskysub, args,
+                cleaned[i], '', path=path))
+    if not skysub:
+        return
+    if args.coadd:
+        # all coadds of a mask update the same state, so they run one
+        # after the other, each adding one exposure
+        previous = []
+        for i in range(len(skysub)):
+            previous = [graph.add(
+                'coadd {0} {1}'.format(mask, i+1), tasks.call_coadd, args,
+                mask, skysub[:i+1], path=path, deps=previous).name]
+    combined = graph.add(
+        'imcombine {0}'.format(mask), _combine, args, mask, skysub,
+        path=path)
+    spectra = graph.add(
+        'gsextract {0}'.format(mask), tasks.call_gsextract, args,
+        combined, path=path)
+    # these run from the top directory (the `path` argument of
+    # cut_spectra is given by position)
+    graph.add('cut 2d {0}'.format(mask), tasks.cut_spectra, args, combined,
+              mask, '2d', path)
+    graph.add('cut 1d {0}'.format(mask), tasks.cut_spectra, args, spectra,
+              mask, '1d', path)
+    graph.add('store {0}'.format(mask), tasks.store_spectra, args, spectra,
+              mask, path)
+    graph.add('wavecheck {0}'.format(mask), check_gswave.main, path, mask,
+              'gswcheck.log', deps=sorted(set(solutions)))
+    return
+
+
+def _lacos(args, science):
+    """`tasks.call_lacos` counting the slits first (for `mos_graph`)"""
+    return tasks.call_lacos(args, science, utils.get_nslits(science))
+
+
+def _crstack(args, images):
+    """`tasks.call_crstack` counting the slits first (for `mos_graph`)"""
+    return tasks.call_crstack(args, images, utils.get_nslits(images[0]))
+
+
+def _combine(args, mask, images):
+    """`tasks.call_imcombine` counting the slits first (for `mos_graph`)"""
+    return tasks.call_imcombine(
+        args, mask, images, './', utils.get_nslits(images[0]))
+
+
+def watch(args, align_suffix='_aligned', retries=2):
+    """Reduce exposures as they are written to `args.path`.
+
+    After every new file the inventory is updated (only new headers
+    are read, thanks to the header index) and every science exposure
+    whose flat and arc are available is reduced up to sky subtraction,
+    and added to the running coadd of its mask. An exposure whose
+    reduction fails (e.g., because of a transient IRAF error) is tried
+    again up to `retries` times, as new files arrive.
+    Runs until interrupted with Ctrl-C.
+
+    """
+    program = ('' if args.masks == 'all' else args.program)
+    watcher = Watcher(args.path, interval=args.watch_interval)
+    done = set()
+    failures = {}
+    # sky-subtracted exposures of each mask, for the running coadds
+    reduced = {}
+    try:
+        while True:
+            # files still being written (e.g., with incomplete headers)
+            # may break the inventory; it is generated again with the
+            # next file
+            try:
+                association = inventory.generate(
+                    args, program, args.objectid, args.bias, args.path,
+                    verbose=False)[1]
+            except Exception as err:
+                print('Could not update the inventory: {0}'.format(err))
+                association = []
+            for exp in association:
+                if exp.science in done or not (exp.flat and exp.arc):
+                    continue
+                print('New exposure {0} in mask {1}'.format(
+                    exp.science, exp.mask), end=2*'\n')
+                path = os.path.join(args.objectid, exp.mask).replace(
+                    ' ', '_')
+                iraf.chdir(path)
+                try:
+                    science, Nslits = reduce_exposure(
+                        args, exp.science, exp.flat, exp.arc,
+                        align_suffix=align_suffix)
+                    if science not in reduced.setdefault(exp.mask, []):
+                        reduced[exp.mask].append(science)
+                    if args.coadd:
+                        tasks.call_coadd(args, exp.mask, reduced[exp.mask])
+                    done.add(exp.science)
+                except Exception as err:
+                    failures[exp.science] = failures.get(exp.science, 0) + 1
+                    print('Reduction of {0} failed: {1}'.format(
+                        exp.science, err))
+                    if failures[exp.science] > retries:
+                        print('Giving up on {0}'.format(exp.science))
+                        done.add(exp.science)
+                finally:
+                    utils.delete('tmp*')
+                    iraf.chdir('../..')
+            print('Waiting for new files in {0} ...'.format(args.path))
+            watcher.wait()
+    except KeyboardInterrupt:
+        print('\nStopped watching {0}'.format(args.path))
+    finally:
+        watcher.close()
+    return
+
+
+def ns(args, cluster, mask, files_science, association, cutdir,
        align_suffix='_aligned'):
     """nod-and-shuffle -- NOT YET IMPLEMENTED"""
     Nmasks = 0
@@ -152,11 +530,11 @@ def ns(args, cluster, mask, files_science, assoc, cutdir,
     print('Mask {0}'.format(mask), end=2*'\n')
     path = os.path.join(args.objectid, 'mask{0}'.format(mask))
 
-    darks = utils.get_darks()
+    with headerindex.open_index(args.path, args.header_index) as index:
+        darks = utils.get_darks(index)
     for science in files_science.keys():
-        arc = inventory.get_file(
-            assoc, science, mask, obs='arc',
-            wave=files_science[science])
+        arc = association.get_file(
+            science, mask, obs='arc', wave=files_science[science])
         # finding the arc is enough to know that the mask exists.
         if not arc:
             print('Not enough data for mask {2} (science file {1})'.format(
@@ -218,8 +596,7 @@ def ns(args, cluster, mask, files_science, assoc, cutdir,
     # cut spectra
     tasks.cut_spectra(args, str(mask), spec='2d')
     tasks.cut_spectra(args, str(mask), spec='1d')
-    check_gswave.main(
-        args.objectid, mask, gmos.gswavelength.logfile, 'gswcheck.log')
+    check_gswave.main(path, mask, 'gswcheck.log')
     return Nmasks
 
 
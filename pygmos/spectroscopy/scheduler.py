@@ -0,0 +1,325 @@
+"""
+Run reduction steps as a dependency graph over a pool of processes.
+
+Each step of the reduction (e.g., `tasks.call_gsreduce` on a given
+frame) is a node in a directed acyclic graph, and a node runs as soon as
+all the nodes it depends on have finished. Independent exposures and
+masks therefore run in parallel.
+
+IRAF keeps its working directory and task parameters in global state, so
+steps run in separate processes. Each worker process gets its own
+``uparm`` and ``tmp`` directories, and changes into the directory of
+each step before running it. Task parameters set in the main process
+(e.g., by `paramtools.read_iraf_params`) are inherited by the workers.
+Steps of the same mask share its directory, so steps must not use fixed
+names for their intermediate files there: `tasks._lacos_iraf`, for
+instance, works in a scratch directory of its own.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import traceback
+from multiprocessing import Pool
+from time import time
+
+from pyraf import iraf
+
+from ..utilities import utils
+
+
+class Result(object):
+
+    """Placeholder for the return value of another node
+
+    Parameters
+    ----------
+    name : str
+        name of the node
+    index : int, optional
+        if given, use ``value[index]`` instead of the full return value
+
+    """
+
+    def __init__(self, name, index=None):
+        self.name = name
+        self.index = index
+
+    def __getitem__(self, index):
+        return Result(self.name, index)
+
+    def resolve(self, results):
+        value = results[self.name]
+        if self.index is not None:
+            value = value[self.index]
+        return value
+
+
+def _resolve(value, results):
+    """Replace `Result` placeholders, also within lists and tuples"""
+    if isinstance(value, Result):
+        return value.resolve(results)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_resolve(v, results) for v in value)
+    if isinstance(value, dict):
+        return dict((k, _resolve(v, results)) for k, v in value.items())
+    return value
+
+
+def _dependencies(value):
+    """Names of the nodes referenced by placeholders in `value`"""
+    if isinstance(value, Result):
+        return [value.name]
+    if isinstance(value, (list, tuple)):
+        return [name for v in value for name in _dependencies(v)]
+    if isinstance(value, dict):
+        return [name for v in value.values() for name in _dependencies(v)]
+    return []
+
+
+class Node(object):
+
+    """A single step of the reduction
+
+    Parameters
+    ----------
+    name : str
+        unique name
+    func : callable
+        module-level function (so that it can be sent to a worker)
+    args, kwargs : tuple and dict
+        arguments of `func`, which may contain `Result` placeholders
+    path : str
+        directory in which to run `func`
+    deps : list of str
+        names of nodes that must run first, in addition to those
+        referenced through `Result` placeholders
+    local : bool
+        run in the main process. Required for interactive steps.
+
+    """
+
+    def __init__(self, name, func, args=(), kwargs=None, path='./',
+                 deps=(), local=False):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.path = os.path.abspath(path)
+        self.deps = set(deps) | set(_dependencies(args)) \
+            | set(_dependencies(self.kwargs))
+        self.local = local
+
+
+# directory of the worker process (see `_init_worker`)
+_workdir = None
+
+# how often (in seconds) running steps are checked
+POLL_INTERVAL = 1
+
+
+def _init_worker(scratch):
+    """Give each worker process its own IRAF uparm and tmp directories"""
+    global _workdir
+    _workdir = os.path.join(scratch, str(os.getpid()))
+    for name in ('uparm', 'tmp'):
+        utils.makedir(os.path.join(_workdir, name))
+    iraf.set(uparm=os.path.join(_workdir, 'uparm', ''),
+             tmp=os.path.join(_workdir, 'tmp', ''))
+    return
+
+
+def _execute(func, args, kwargs, path, task=None):
+    """Run `func` within `path`, always returning to the original path
+
+    In a worker process, a ``task<task>`` file containing the process ID
+    is first written to the scratch directory, so that the main process
+    can tell when the worker running `task` died (see `_lost`).
+
+    Returns
+    -------
+    success : bool
+        whether `func` finished without raising an exception (including
+        `SystemExit`)
+    value : object or str
+        the return value of `func`, or the traceback if it failed (as
+        tracebacks are lost when exceptions cross process boundaries)
+
+    """
+    if _workdir is not None and task is not None:
+        with open(_task_file(os.path.dirname(_workdir), task), 'w') as f:
+            f.write(str(os.getpid()))
+    cwd = os.getcwd()
+    iraf.chdir(path)
+    try:
+        return True, func(*args, **kwargs)
+    except BaseException:
+        return False, traceback.format_exc()
+    finally:
+        iraf.chdir(cwd)
+
+
+def _task_file(scratch, task):
+    return os.path.join(scratch, 'task{0}'.format(task))
+
+
+def _lost(scratch, task):
+    """Whether the worker process running `task` no longer exists"""
+    try:
+        with open(_task_file(scratch, task)) as f:
+            pid = int(f.read())
+    except (IOError, ValueError):
+        # not started yet
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return True
+    return False
+
+
+class Scheduler(object):
+
+    """Execute a graph of reduction steps
+
+    Parameters
+    ----------
+    jobs : int, optional
+        number of worker processes. With ``jobs=1`` all steps run in
+        the main process, in dependency order.
+    scratch : str, optional
+        directory where a temporary directory holding the per-worker
+        IRAF directories is created, and removed after `run`
+
+    """
+
+    def __init__(self, jobs=1, scratch='./'):
+        self.jobs = jobs
+        self.scratch = os.path.abspath(scratch)
+        self.nodes = {}
+        self._order = []
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    def add(self, name, func, *args, **kwargs):
+        """Add a node, unless one with the same name already exists
+
+        Accepts the keyword arguments `path`, `deps` and `local` of
+        `Node`; all other arguments are passed to `func`.
+
+        Returns
+        -------
+        result : `Result`
+            placeholder for the return value of the node
+
+        """
+        if name not in self.nodes:
+            options = dict((key, kwargs.pop(key))
+                           for key in ('path', 'deps', 'local')
+                           if key in kwargs)
+            self.nodes[name] = Node(name, func, args, kwargs, **options)
+            self._order.append(name)
+        return Result(name)
+
+    def run(self):
+        """Run all nodes
+
+        Steps running in worker processes are failed if their worker
+        dies (e.g., killed for lack of memory), or if their return value
+        cannot be sent back to the main process.
+
+        Returns
+        -------
+        results : dict
+            return value of each successful node
+        failed : list of str
+            names of nodes that failed or were not run because a node
+            they depend on failed
+
+        """
+        for node in self.nodes.values():
+            missing = node.deps - set(self.nodes)
+            if missing:
+                raise ValueError(
+                    'Node {0} depends on unknown node(s) {1}'.format(
+                        node.name, ', '.join(sorted(missing))))
+        results = {}
+        failed = []
+        waiting = list(self._order)
+        # asynchronous result of each node running in a worker
+        running = {}
+        to = time()
+        pool = None
+        scratch = None
+        if self.jobs > 1:
+            utils.makedir(self.scratch)
+            # unique, as several runs may share the working directory
+            scratch = tempfile.mkdtemp(
+                prefix='pygmos_workers_', dir=self.scratch)
+            pool = Pool(self.jobs, _init_worker, (scratch,))
+        try:
+            while waiting or running:
+                # drop nodes whose dependencies failed
+                for name in list(waiting):
+                    if self.nodes[name].deps & set(failed):
+                        waiting.remove(name)
+                        failed.append(name)
+                        print('Skipping {0}: a previous step failed'.format(
+                            name))
+                finished = []
+                ready = [name for name in waiting
+                         if self.nodes[name].deps <= set(results)]
+                for name in ready:
+                    waiting.remove(name)
+                    node = self.nodes[name]
+                    args = (node.func, _resolve(node.args, results),
+                            _resolve(node.kwargs, results), node.path)
+                    if pool is None or node.local:
+                        finished.append((name,) + _execute(*args))
+                        continue
+                    task = self._order.index(name)
+                    running[name] = pool.apply_async(
+                        _execute, args + (task,))
+                for name, result in list(running.items()):
+                    if result.ready():
+                        try:
+                            success, value = result.get()
+                        except Exception:
+                            # e.g., a return value that cannot be pickled
+                            success, value = False, traceback.format_exc()
+                    elif _lost(scratch, self._order.index(name)):
+                        success, value = False, 'the worker process died'
+                    else:
+                        continue
+                    del running[name]
+                    finished.append((name, success, value))
+                if not finished:
+                    if not running:
+                        if waiting:
+                            raise ValueError(
+                                'Circular dependencies among {0}'.format(
+                                    ', '.join(waiting)))
+                        break
+                    # returns as soon as that node finishes
+                    next(iter(running.values())).wait(POLL_INTERVAL)
+                    continue
+                for name, success, value in finished:
+                    if success:
+                        results[name] = value
+                        print('[{0:.1f} min] finished {1}'.format(
+                            (time()-to) / 60, name))
+                    else:
+                        failed.append(name)
+                        print('[{0:.1f} min] {1} failed:\n{2}'.format(
+                            (time()-to) / 60, name, value))
+        finally:
+            if pool is not None:
+                # steps of dead workers never finish, so do not wait for
+                # them (nor for running steps, e.g., when interrupted)
+                pool.terminate()
+                pool.join()
+                shutil.rmtree(scratch, ignore_errors=True)
+        return results, failed
@@ -0,0 +1,195 @@
+"""
+Sky subtraction of rectified slits without IRAF.
+
+Works on the output of `gstransform`, where each ``[SCI,i]`` extension
+is a slit with wavelength along x and position along y. As in
+`gsskysub`, the sky in each column is a polynomial in y fit to the sky
+rows of the slit with iterative sigma rejection, but all columns of a
+slit are fit at once (see `lacosmic.fit1d`).
+
+Sky rows are those within the sky sample (a fraction of the slit
+length for MOS, an IRAF sample string for longslit), excluding rows
+where the spatial profile shows an object. Slits can be distributed
+over a pool of processes.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import warnings
+from multiprocessing import Pool, current_process
+from time import time
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+from .lacosmic import fit1d
+
+
+def sample_rows(ny, sample='*', fraction=None):
+    """Rows included in a sky sample
+
+    Parameters
+    ----------
+    ny : int
+        number of rows
+    sample : str, optional
+        IRAF sample string (1-indexed, inclusive), e.g. ``'10:40,60:90'``
+        or ``'*'`` for all rows
+    fraction : float, optional
+        if given, use only the central `fraction` of the rows instead
+        (as ``mos_sample`` in `gsskysub`)
+
+    Returns
+    -------
+    rows : boolean array
+
+    """
+    rows = np.zeros(ny, dtype=bool)
+    if fraction is not None:
+        edge = int(round(ny * (1 - fraction) / 2))
+        rows[edge:ny-edge] = True
+        return rows
+    for region in sample.replace(' ', ',').split(','):
+        if not region:
+            continue
+        if region == '*':
+            rows[:] = True
+            continue
+        start, end = [int(float(x)) for x in region.split(':')]
+        start, end = sorted((start, end))
+        rows[max(start-1, 0):end] = True
+    return rows
+
+
+def object_rows(data, rows, nsigma=3., grow=2, niter=5):
+    """Rows where the spatial profile rises above the sky
+
+    The profile is the median of each row. Its sky level and scatter
+    are estimated iteratively from the median and median absolute
+    deviation of the rows not yet identified as objects.
+
+    Parameters
+    ----------
+    data : 2d array
+        rectified slit
+    rows : boolean array
+        candidate sky rows
+    nsigma : float
+        detection limit
+    grow : int
+        number of rows added on each side of every object row
+
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        profile = np.nanmedian(data, axis=1)
+    sky = rows & np.isfinite(profile)
+    objects = np.zeros(rows.size, dtype=bool)
+    for i in range(niter):
+        if sky.sum() < 3:
+            break
+        level = np.median(profile[sky])
+        sigma = 1.4826 * np.median(np.abs(profile[sky] - level))
+        objects = np.isfinite(profile) & (profile > level + nsigma*sigma)
+        new = rows & np.isfinite(profile) & ~objects
+        if (new == sky).all():
+            break
+        sky = new
+    if grow > 0 and objects.any():
+        grown = objects.copy()
+        for shift in range(1, grow+1):
+            grown[shift:] |= objects[:-shift]
+            grown[:-shift] |= objects[shift:]
+        objects = grown
+    return objects
+
+
+def subtract(data, sample='*', fraction=None, order=1, low_reject=2.5,
+             high_reject=2.5, niterate=2, nsigma=3., grow=2):
+    """Subtract the sky from a rectified slit
+
+    Parameters
+    ----------
+    data : 2d array
+        slit, with wavelength along x
+    sample, fraction
+        sky sample, see `sample_rows`
+    order : int
+        number of terms of the sky polynomial in each column (as in IRAF)
+    low_reject, high_reject, niterate
+        sigma rejection of the fit, as in `gsskysub`
+    nsigma, grow
+        identification of object rows, see `object_rows`
+
+    Returns
+    -------
+    skysub : 2d array
+        sky-subtracted slit
+    sky : 2d array
+        sky model
+
+    """
+    data = np.asarray(data, dtype=float)
+    ny = data.shape[0]
+    rows = sample_rows(ny, sample, fraction)
+    sky_rows = rows & ~object_rows(data, rows, nsigma=nsigma, grow=grow)
+    # slits too short, or filled by the object
+    if sky_rows.sum() < max(order, 2):
+        sky_rows = rows
+    masked = np.where(sky_rows[:, None], data, np.nan)
+    sky = fit1d(masked, order, axis=2, low=low_reject, high=high_reject,
+                niter=niterate)
+    return data - sky, sky
+
+
+def _subtract(args):
+    data, kwargs = args
+    to = time()
+    skysub, sky = subtract(data, **kwargs)
+    return skysub, time() - to
+
+
+def skysub_file(image, output, workers=1, verbose=True, **kwargs):
+    """Subtract the sky from all slits of a transformed frame
+
+    Parameters
+    ----------
+    image : str
+        output of `gstransform`
+    output : str
+        sky-subtracted frame. VAR and DQ extensions are copied
+        unchanged.
+    workers : int, optional
+        number of processes among which slits are distributed. Ignored
+        within daemon processes (e.g., `scheduler.Scheduler` workers).
+    kwargs : dict
+        passed to `subtract`
+
+    """
+    to = time()
+    with pyfits.open(image) as hdulist:
+        slits = [hdu for hdu in hdulist
+                 if hdu.name == 'SCI' and hdu.data is not None]
+        tasks = [(hdu.data, kwargs) for hdu in slits]
+        if workers > 1 and len(slits) > 1 \
+                and not current_process().daemon:
+            pool = Pool(min(workers, len(slits)))
+            try:
+                results = pool.map(_subtract, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_subtract(task) for task in tasks]
+        for hdu, (skysub, dt) in zip(slits, results):
+            hdu.data = skysub.astype(hdu.data.dtype)
+            if verbose:
+                print('{0}[SCI,{1}]: sky subtracted in {2:.2f} s'.format(
+                    image, hdu.header.get('EXTVER'), dt))
+        hdulist.writeto(output, overwrite=True)
+    if verbose:
+        print('{0} slits sky-subtracted in {1:.1f} s'.format(
+            len(slits), time()-to))
+    return output
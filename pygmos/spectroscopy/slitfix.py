@@ -0,0 +1,165 @@
+"""
+Reduction of a subset of the slits of a mask.
+
+When the wavelength calibration of a few slits fails, only those slits
+need to be reduced again. `subset` copies the ``[SCI,i]``, ``[VAR,i]``
+and ``[DQ,i]`` extensions of the selected slits (and their MDF rows) to
+a smaller frame, with the slits numbered from 1, which goes through the
+usual reduction steps; `copy_solutions` and `splice` then put the
+wavelength solutions and products of those slits back into the
+database and frames of the whole mask, in place of the old ones.
+
+Extensions are matched to slits by their SLIT keyword (see
+`cut.slit_number`), so extracted frames with several apertures per
+slit are spliced as well.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import os
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+from . import database
+from .cut import slit_number
+
+EXTNAMES = ('SCI', 'VAR', 'DQ')
+
+
+def _units(hdulist):
+    """Extensions of each spectrum (sharing an EXTVER) and all others
+
+    Returns
+    -------
+    units : list of (slit, list of HDUs)
+        in the order of their SCI extensions
+    others : list of HDUs
+        primary, MDF and any other extensions
+
+    """
+    groups = {}
+    units = []
+    others = []
+    for hdu in hdulist:
+        if hdu.name not in EXTNAMES:
+            others.append(hdu)
+            continue
+        extver = hdu.header.get('EXTVER', 1)
+        if extver not in groups:
+            groups[extver] = []
+        groups[extver].append(hdu)
+        if hdu.name == 'SCI':
+            units.append((slit_number(hdu), groups[extver]))
+    return units, others
+
+
+def subset(image, output, slits):
+    """Write the extensions of some slits to a new frame
+
+    Parameters
+    ----------
+    image : str
+        multi-extension FITS file with one ``[SCI,i]`` extension per slit
+    output : str
+        output file, where slit ``slits[k-1]`` is ``[SCI,k]``
+    slits : list of int
+        slit numbers
+
+    """
+    slits = list(slits)
+    with pyfits.open(image) as hdulist:
+        units, others = _units(hdulist)
+        units = dict(units)
+        missing = [slit for slit in slits if slit not in units]
+        if missing:
+            raise KeyError('No slits {0} in {1}'.format(missing, image))
+        hdus = []
+        for hdu in others:
+            hdu = hdu.copy()
+            if hdu.name == 'MDF':
+                rows = hdu.data[np.array(slits) - 1]
+                hdu = pyfits.BinTableHDU(rows.copy(), header=hdu.header)
+                if 'EXTVER' in rows.names:
+                    hdu.data['EXTVER'] = np.arange(len(slits)) + 1
+            hdus.append(hdu)
+        if 'NSCIEXT' in hdus[0].header:
+            hdus[0].header['NSCIEXT'] = len(slits)
+        for k, slit in enumerate(slits, 1):
+            for hdu in units[slit]:
+                hdu = hdu.copy()
+                hdu.header['EXTVER'] = k
+                if 'SLIT' in hdu.header:
+                    hdu.header['SLIT'] = k
+                hdus.append(hdu)
+        pyfits.HDUList(hdus).writeto(output, overwrite=True)
+    return
+
+
+def splice(image, fixed, slits):
+    """Replace the extensions of some slits of a frame, in place
+
+    Parameters
+    ----------
+    image : str
+        frame of the whole mask
+    fixed : str
+        the same product of a frame written by `subset`, whose slit k
+        replaces slit ``slits[k-1]`` of `image`
+    slits : list of int
+        slit numbers
+
+    Returns
+    -------
+    nspec : int
+        number of spectra (SCI extensions) replaced
+
+    """
+    slits = list(slits)
+    with pyfits.open(image, memmap=False) as hdulist, \
+            pyfits.open(fixed, memmap=False) as new:
+        units, others = _units(hdulist)
+        added, _ = _units(new)
+        # spectra numbered sequentially, with the slit in a keyword
+        numbered = any('SLIT' in hdus[0].header for slit, hdus in units)
+        spectra = [unit for unit in units if unit[0] not in slits]
+        for k, hdus in added:
+            for hdu in hdus:
+                if 'SLIT' in hdu.header or numbered:
+                    hdu.header['SLIT'] = slits[k-1]
+            spectra.append((slits[k-1], hdus))
+        # stable, so several apertures of a slit keep their order
+        spectra.sort(key=lambda unit: unit[0])
+        hdus = [hdu.copy() for hdu in others]
+        if 'NSCIEXT' in hdus[0].header:
+            hdus[0].header['NSCIEXT'] = len(spectra)
+        for i, (slit, unit) in enumerate(spectra, 1):
+            for hdu in unit:
+                hdu = hdu.copy()
+                hdu.header['EXTVER'] = i if numbered else slit
+                hdus.append(hdu)
+        pyfits.HDUList(hdus).writeto(image + '.tmp', overwrite=True,
+                                     output_verify='silentfix')
+    os.rename(image + '.tmp', image)
+    return len(added)
+
+
+def _record_file(folder, kind, arc, slit):
+    return os.path.join(folder, '{0}{1}_{2:03d}'.format(kind, arc, slit))
+
+
+def copy_solutions(fixed, arc, slits, folder='database'):
+    """Move the `identify` and `fitcoords` records of an arc written by
+    `subset` to the slits of the whole arc, replacing theirs"""
+    for k, slit in enumerate(slits, 1):
+        old = '{0}_{1:03d}'.format(fixed, k)
+        new = '{0}_{1:03d}'.format(arc, slit)
+        for kind in ('id', 'fc'):
+            filename = _record_file(folder, kind, fixed, k)
+            records = [database.rename(record, old, new)
+                       for record in database.read(filename)]
+            database.write(_record_file(folder, kind, arc, slit), records)
+            os.remove(filename)
+    return
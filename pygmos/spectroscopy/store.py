@@ -0,0 +1,235 @@
+"""
+Columnar store of extracted spectra.
+
+Instead of one FITS file per spectrum, the spectra of each extracted
+frame are appended to a store directory as one chunk: the fluxes and
+variances of all its spectra, concatenated into flat ``.npy`` arrays
+that are read as memory maps. A JSON index holds one record per
+spectrum, with its position in the chunk, its wavelength WCS and its
+metadata (object, mask, slit, program and the scalar columns of its
+MDF row), so that spectra can be selected without opening any data.
+
+Appending the spectra of an object and mask already in the store
+replaces them. Access to the index is serialized with a file lock, so
+the store can be shared by several masks reduced in parallel.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import fcntl
+import json
+import numpy as np
+import os
+from contextlib import contextmanager
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+from .cut import slit_number
+
+INDEX = 'index.json'
+ARRAYS = ('flux', 'var')
+
+
+def _scalar(value):
+    """JSON-serializable version of a table value"""
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def mdf_rows(hdulist):
+    """Scalar columns of each MDF row, as dictionaries"""
+    try:
+        mdf = hdulist['MDF'].data
+    except KeyError:
+        return []
+    names = [col.name for col in mdf.columns
+             if mdf[col.name].ndim == 1]
+    return [dict((name.lower(), _scalar(row[name])) for name in names)
+            for row in mdf]
+
+
+class SpectraStore(object):
+
+    """Memory-mapped store of 1d spectra
+
+    Parameters
+    ----------
+    root : str
+        directory of the store
+
+    Examples
+    --------
+    >>> store = SpectraStore('spectra.store')
+    >>> for record in store.select(object='A1689', mask=[1, 2]):
+    ...     wave = store.wavelength(record)
+    ...     flux = store.flux(record)
+
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self._records = None
+        self._maps = {}
+
+    @contextmanager
+    def _index(self):
+        """Lock, read and (on exit) write the index"""
+        with open(os.path.join(self.root, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read()
+                yield index
+                filename = os.path.join(self.root, INDEX)
+                with open(filename + '.tmp', 'w') as f:
+                    json.dump(index, f)
+                os.rename(filename + '.tmp', filename)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._records = None
+        return
+
+    def _read(self):
+        try:
+            with open(os.path.join(self.root, INDEX)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'next': 0, 'records': []}
+
+    def _path(self, chunk, name):
+        return os.path.join(self.root, '{0}.{1}.npy'.format(chunk, name))
+
+    @property
+    def records(self):
+        """Metadata of all spectra in the store"""
+        if self._records is None:
+            self._records = self._read()['records']
+        return self._records
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, spectra, object, mask, program=''):
+        """Add the spectra of an extracted frame
+
+        Parameters
+        ----------
+        spectra : str
+            extracted multi-extension FITS file, with one 1d ``[SCI,i]``
+            (and optionally ``[VAR,i]``) extension per spectrum
+        object, mask : str
+            replace any spectra of this object and mask in the store
+        program : str, optional
+            observing program
+
+        Returns
+        -------
+        nspec : int
+            number of spectra added
+
+        """
+        with pyfits.open(spectra) as hdulist:
+            mdf = mdf_rows(hdulist)
+            sci = [hdu for hdu in hdulist
+                   if hdu.name == 'SCI' and hdu.data is not None
+                   and hdu.data.ndim == 1]
+            flux = []
+            var = []
+            meta = []
+            offset = 0
+            for hdu in sci:
+                head = hdu.header
+                slit = slit_number(hdu)
+                data = hdu.data.astype(np.float32)
+                try:
+                    variance = hdulist['VAR', head['EXTVER']].data
+                except KeyError:
+                    variance = np.full(data.shape, np.nan)
+                record = mdf[slit-1].copy() if 0 < slit <= len(mdf) else {}
+                record.update(
+                    object=object, mask=str(mask), slit=slit,
+                    program=program, source=os.path.abspath(spectra),
+                    offset=offset, npix=data.size,
+                    crval1=head.get('CRVAL1', 1.),
+                    cdelt1=head.get('CD1_1', head.get('CDELT1', 1.)),
+                    crpix1=head.get('CRPIX1', 1.))
+                flux.append(data)
+                var.append(np.asarray(variance, dtype=np.float32))
+                meta.append(record)
+                offset += data.size
+        with self._index() as index:
+            chunk = 'chunk-{0:06d}'.format(index['next'])
+            index['next'] += 1
+            for name, arrays in zip(ARRAYS, (flux, var)):
+                values = np.concatenate(arrays) if arrays \
+                    else np.zeros(0, dtype=np.float32)
+                np.save(self._path(chunk, name), values)
+            for record in meta:
+                record['chunk'] = chunk
+            old = [record for record in index['records']
+                   if record['object'] == object
+                   and record['mask'] == str(mask)]
+            index['records'] = [record for record in index['records']
+                                if record not in old] + meta
+            # remove chunks without spectra
+            used = set(record['chunk'] for record in index['records'])
+            for name in set(record['chunk'] for record in old) - used:
+                for array in ARRAYS:
+                    if os.path.isfile(self._path(name, array)):
+                        os.remove(self._path(name, array))
+        print('Added {0} spectra of {1} (mask {2}) to {3}'.format(
+            len(meta), object, mask, self.root))
+        return len(meta)
+
+    def select(self, **criteria):
+        """Records matching all criteria
+
+        Each keyword is a record field, and its value either a single
+        value or a list of accepted values, e.g.,
+        ``select(object='A1689', slit=[3, 4])``
+
+        """
+        selected = self.records
+        for key, value in criteria.items():
+            if not isinstance(value, (list, tuple, set)):
+                value = [value]
+            if key == 'mask':
+                value = [str(v) for v in value]
+            selected = [record for record in selected
+                        if record.get(key) in value]
+        return selected
+
+    def _array(self, chunk, name):
+        if (chunk, name) not in self._maps:
+            self._maps[(chunk, name)] = np.load(
+                self._path(chunk, name), mmap_mode='r')
+        return self._maps[(chunk, name)]
+
+    def _slice(self, record, name):
+        start = record['offset']
+        return self._array(record['chunk'], name)[
+            start:start+record['npix']]
+
+    def flux(self, record):
+        """Flux of a spectrum (a read-only memory map)"""
+        return self._slice(record, 'flux')
+
+    def variance(self, record):
+        """Variance of a spectrum (a read-only memory map)"""
+        return self._slice(record, 'var')
+
+    def wavelength(self, record):
+        """Wavelength of each pixel of a spectrum, from its WCS"""
+        pixels = np.arange(record['npix']) + 1
+        return record['crval1'] \
+            + (pixels - record['crpix1']) * record['cdelt1']
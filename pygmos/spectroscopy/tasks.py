@@ -7,6 +7,9 @@ from __future__ import absolute_import, division, print_function
 
 from astropy.io import fits as pyfits
 import os
+import shutil
+import tempfile
+from glob import glob
 from time import sleep, time
 
 from pyraf import iraf
@@ -14,6 +17,8 @@ from iraf import gemini
 from iraf import gemtools
 from iraf import gmos
 
+from . import (arcid, coadd, combine, crstack, cut, extract, lacosmic,
+               redshift, skysub, slitfix, store, wavecheck, wavetransfer)
 from ..utilities import utils
 
 
@@ -28,8 +33,13 @@ def call_gsflat(args, flat, bias='', fl_bias='yes', fl_over='yes',
                 fl_inter='no', fl_answer='no'):
     output = '{0}_flat'.format(flat)
     comb = '{0}_comb'.format(flat)
-    if utils.skip(args, 'flat', output):
-        return output, comb
+    if utils.skip(args, 'flat', output, inputs=[flat, args.bias],
+                  tasks=[gmos.gsflat, gmos.gmosaic],
+                  params=dict(fl_bias=fl_bias, fl_over=fl_over,
+                              nobias=args.nobias)):
+        return _gsflat_products(output, comb)
+    if utils.fetch_calibration(args, 'flat', output):
+        return _gsflat_products(output, comb)
     utils.remove_previous_files(flat, filetype='flat')
     # for now
     bias = args.bias
@@ -43,19 +53,41 @@ def call_gsflat(args, flat, bias='', fl_bias='yes', fl_over='yes',
         new_comb = utils.add_prefix(comb, gmos.gmosaic)
         os.system('rm {0}.fits'.format(new_output))
         os.system('rm {0}.fits'.format(new_comb))
+        # one log per flat, as flats may be mosaicked at the same time
+        logfile = '{0}_gmosaic.log'.format(flat)
         gmos.gmosaic(
-            output, fl_fixpix='yes', verbose='no', logfile='gmosaic.log')
+            output, fl_fixpix='yes', verbose='no', logfile=logfile)
         gmos.gmosaic(
-            comb, fl_fixpix='yes', verbose='no', logfile='gmosaic.log')
-        output = new_output
-        comb = new_comb
+            comb, fl_fixpix='yes', verbose='no', logfile=logfile)
+    products = [output, comb] + list(_gsflat_products(output, comb))
+    utils.store_calibration(
+        args, 'flat', output,
+        sorted(set('{0}.fits'.format(name) for name in products)))
+    utils.record('flat', output)
+    return _gsflat_products(output, comb)
+
+
+def _gsflat_products(output, comb):
+    """Flat and combined flat to be used, mosaicked if required"""
+    if gmos.gsflat.fl_detec == 'yes':
+        return (utils.add_prefix(output, gmos.gmosaic),
+                utils.add_prefix(comb, gmos.gmosaic))
     return output, comb
 
 
 def call_gsreduce(args, img, flat='', bias='', grad='', mode='regular',
-                  fl_bias='yes', fl_over='yes'):
+                  fl_bias='yes', fl_over='yes', calibration=False):
+    """
+    Set `calibration=True` for arcs, so that the reduced frame is kept
+    in the calibration cache (if requested)
+    """
     output = utils.add_prefix(img, gmos.gsreduce)
-    if utils.skip(args, 'reduce', output):
+    if utils.skip(args, 'reduce', output, inputs=[img, flat, args.bias, grad],
+                  tasks=[gmos.gsreduce],
+                  params=dict(mode=mode, fl_bias=fl_bias, fl_over=fl_over,
+                              nobias=args.nobias)):
+        return output
+    if calibration and utils.fetch_calibration(args, 'reduce', output):
         return output
     utils.remove_previous_files(img)
     # for now
@@ -83,6 +115,10 @@ def call_gsreduce(args, img, flat='', bias='', grad='', mode='regular',
         gmos.gsreduce(img, fl_fixpix='no', fl_trim='no', fl_bias='no',
                       fl_flat='no', fl_gsappwave='no', fl_cut='no',
                       fl_title='no', geointer='nearest')
+    if calibration:
+        utils.store_calibration(
+            args, 'reduce', output, ['{0}.fits'.format(output)])
+    utils.record('reduce', output)
     return output
 
 
@@ -90,7 +126,14 @@ def call_lacos(args, science, Nslits=0, longslit=False):
     outfile = '{0}_lacos.fits'.format(science)
     #if os.path.isfile(outfile):
         #os.remove(outfile)
-    if utils.skip(args, 'lacos', outfile):
+    engine = args.lacos_engine
+    if engine == 'native' and not lacosmic._have_scipy:
+        print('scipy not available; using the IRAF implementation of LACos')
+        engine = 'iraf'
+    if utils.skip(args, 'lacos', outfile, inputs=[science],
+                  tasks=[iraf.lacos_spec],
+                  params=dict(Nslits=Nslits, longslit=longslit,
+                              engine=engine)):
         return outfile[:-5]
     print()
     print('-' * 30)
@@ -103,33 +146,16 @@ def call_lacos(args, science, Nslits=0, longslit=False):
     #utils.delete(outfile)
     if os.path.isfile(outfile):
         iraf.imdelete(outfile)
-    os.system('cp  -p ' + science + '.fits ' +  outfile)
-    utils.removedir('slits')
-    utils.makedir('slits')
-    iraf.imcopy.unlearn()
-    if longslit:
-        slit = '{0}[sci,1]'.format(science)
-        outslit = os.path.join('slits' '{0}_long'.format(science))
-        outmask = os.path.join('slits' '{0}_longmask'.format(science))
-        iraf.lacos_spec(slit, outslit, outmask, gain=gain, readn=rdnoise)
-        iraf.imcopy(outslit, '{0}[SCI,1,overwrite]'.format(outfile[:-5]),
-                    verbose='no')
+    if engine == 'native':
+        params = dict((name, iraf.lacos_spec.getParam(name))
+                      for name in ('xorder', 'yorder', 'sigclip', 'sigfrac',
+                                   'objlim', 'niter'))
+        lacosmic.clean_file(
+            '{0}.fits'.format(science), outfile, float(gain),
+            float(rdnoise), workers=args.lacos_workers, **params)
     else:
-        for i in xrange(1, Nslits+1):
-            slit = '{0}[sci,{1}]'.format(science, i)
-            print('slit =', slit)
-            outslit = os.path.join('slits', '{0}_{1}'.format(science, i))
-            outmask = os.path.join('slits', '{0}_mask{1}'.format(science, i))
-            if os.path.isfile(outslit):
-                iraf.imdelete(outslit)
-            if os.path.isfile(outmask):
-                iraf.imdelete(outmask)
-            iraf.lacos_spec(slit, outslit, outmask, gain=gain, readn=rdnoise)
-            iraf.imcopy(
-                outslit, '{0}[SCI,{1},overwrite]'.format(outfile[:-5], i),
-                verbose='yes')
-    utils.delete('lacos*')
-    utils.removedir('slits')
+        _lacos_iraf(science, outfile, gain, rdnoise, Nslits, longslit)
+    utils.record('lacos', outfile)
     print(outfile[:-5])
     print('Done in {0:.2f}'.format((time()-to)/60))
     print()
@@ -138,25 +164,136 @@ def call_lacos(args, science, Nslits=0, longslit=False):
     return outfile[:-5]
 
 
-def call_gswave(args, arc):
+def _lacos_iraf(science, outfile, gain, rdnoise, Nslits, longslit):
+    """Run lacos_spec.cl on each slit of `science`
+
+    lacos_spec writes its intermediate files (``lacos*``, and the slits
+    in ``slits/``) to the working directory, so it runs in a scratch
+    directory of its own, and several exposures of a mask can be cleaned
+    at the same time (see `scheduler`).
+    """
+    os.system('cp  -p ' + science + '.fits ' +  outfile)
+    cwd = os.getcwd()
+    science = os.path.join(cwd, science)
+    outfile = os.path.join(cwd, outfile)
+    scratch = tempfile.mkdtemp(prefix='lacos_', dir=cwd)
+    iraf.chdir(scratch)
+    try:
+        utils.makedir('slits')
+        iraf.imcopy.unlearn()
+        if longslit:
+            slit = '{0}[sci,1]'.format(science)
+            name = os.path.basename(science)
+            outslit = os.path.join('slits', '{0}_long'.format(name))
+            outmask = os.path.join('slits', '{0}_longmask'.format(name))
+            iraf.lacos_spec(slit, outslit, outmask, gain=gain, readn=rdnoise)
+            iraf.imcopy(outslit,
+                        '{0}[SCI,1,overwrite]'.format(outfile[:-5]),
+                        verbose='no')
+        else:
+            for i in range(1, Nslits+1):
+                slit = '{0}[sci,{1}]'.format(science, i)
+                print('slit =', slit)
+                name = os.path.basename(science)
+                outslit = os.path.join('slits', '{0}_{1}'.format(name, i))
+                outmask = os.path.join(
+                    'slits', '{0}_mask{1}'.format(name, i))
+                iraf.lacos_spec(
+                    slit, outslit, outmask, gain=gain, readn=rdnoise)
+                iraf.imcopy(
+                    outslit, '{0}[SCI,{1},overwrite]'.format(
+                        outfile[:-5], i),
+                    verbose='yes')
+    finally:
+        iraf.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+    return
+
+
+def call_gswave(args, arc, transfer=True):
+    """
+    Set `transfer=False` for frames whose slits do not match those of
+    the reference arc of their setup (e.g., those of `call_subset`),
+    which then neither use nor become the reference
+    """
     print('-' * 30)
     print('calling gswavelength on', arc)
-    output_gstrans = utils.add_prefix(
-        arc, gmos.gstransform).replace('_lacos', '')
-    if utils.skip(args, 'transform', output_gstrans):
+    # the identification of the first slit represents the solution
+    output = os.path.join('database', 'id{0}_001'.format(arc))
+    # shift the solution of an arc of the same setup, if there is one
+    references = wavetransfer.References()
+    reference = references.get(arc) \
+        if args.wave_transfer and transfer else None
+    inputs = [arc]
+    if reference is not None:
+        # the shifted solution depends on that of the reference
+        inputs += [reference] + [
+            os.path.join('database', '{0}{1}_*'.format(kind, reference))
+            for kind in ('id', 'fc')]
+    if utils.skip(args, 'wavelength', output, inputs=inputs,
+                  tasks=[gmos.gswavelength], extension='',
+                  params=dict(transfer=args.wave_transfer,
+                              engine=args.wave_engine,
+                              reference=reference)):
+        return
+    if utils.fetch_calibration(args, 'wavelength', output, extension=''):
         return
-    gmos.gswavelength(arc)
+    if reference is not None:
+        print('Transferring the solution of', reference)
+        if wavetransfer.transfer(reference, arc):
+            _store_solution(args, arc, output)
+            print('-' * 30)
+            return
+        print('Transfer failed; running the full identification')
+    failed = True
+    if args.wave_engine == 'native':
+        task = gmos.gswavelength
+        failed = arcid.identify_file(
+            arc, catalog=_coordlist(), order=int(task.order),
+            xorder=int(task.fitcxord), yorder=int(task.fitcyord),
+            workers=args.wave_workers)
+        if failed:
+            print('Could not identify the lines of slits {0}; running' \
+                  ' gswavelength'.format(', '.join(str(i) for i in failed)))
+    if failed:
+        gmos.gswavelength(arc)
+    if transfer:
+        references.add(arc)
+    _store_solution(args, arc, output)
     print('-' * 30)
     return
 
 
+def _store_solution(args, arc, output):
+    """Cache and record the database records of an arc"""
+    utils.store_calibration(
+        args, 'wavelength', output,
+        glob(os.path.join('database', 'id{0}_*'.format(arc)))
+            + glob(os.path.join('database', 'fc{0}_*'.format(arc))),
+        extension='')
+    utils.record('wavelength', output, extension='')
+    return
+
+
+def _coordlist():
+    """Host path of the gswavelength line list, if it can be resolved"""
+    try:
+        filename = iraf.osfn(gmos.gswavelength.coordlist)
+    except Exception:
+        return None
+    return filename if os.path.isfile(filename) else None
+
+
 def call_gstransform(args, image, arc):
     #if image[-5:] == 'lacos':
         #out = gmos.gstransform.outpref + image[:-6]
     #else:
         #out = gmos.gstransform.outpref + image
     out = utils.add_prefix(image, gmos.gstransform).replace('_lacos', '')
-    if utils.skip(args, 'transform', out):
+    if utils.skip(args, 'transform', out,
+                  inputs=[image, arc, os.path.join('database',
+                                                   'fc{0}_*'.format(arc))],
+                  tasks=[gmos.gstransform]):
         return out
     print('-' * 30)
     print('calling gstransform')
@@ -165,10 +302,44 @@ def call_gstransform(args, image, arc):
     utils.delete('{0}.fits'.format(out))
     print('File {0} exists? {1}'.format(image, os.path.isfile(image)))
     gmos.gstransform(image, outimage=out, wavtraname=arc)
+    utils.record('transform', out)
     print('-' * 30)
     return out
 
 
+def call_crstack(args, images, Nslits):
+    """
+    Remove cosmic rays from transformed exposures of a mask taken with
+    the same setup, by comparing them with each other. If the exposures
+    turn out not to share the same grid, run LACos on each one instead.
+    """
+    outputs = ['{0}_crrej'.format(image) for image in images]
+    # stage the provenance of all outputs
+    skip = [utils.skip(args, 'crstack', output, inputs=images,
+                       params=dict(snoise=args.crstack_snoise))
+            for output in outputs]
+    if all(skip):
+        return outputs
+    print('-' * 30)
+    print('Removing cosmic rays from {0} exposures:'.format(len(images)))
+    for image in images:
+        print('  {0}'.format(image))
+    try:
+        crstack.clean_stack(
+            ['{0}.fits'.format(image) for image in images],
+            ['{0}.fits'.format(output) for output in outputs],
+            snoise=args.crstack_snoise)
+    except crstack.GridMismatch as err:
+        print('Cannot compare exposures ({0}). Using LACos instead.'.format(
+            err))
+        print('-' * 30)
+        return [call_lacos(args, image, Nslits) for image in images]
+    for output in outputs:
+        utils.record('crstack', output)
+    print('-' * 30)
+    return outputs
+
+
 def call_align(inimage, suffix, Nslits):
     print('-' * 30)
     print('Aligning spectra...')
@@ -182,9 +353,75 @@ def call_align(inimage, suffix, Nslits):
     return outimage
 
 
-def call_gsskysub(args, tgsfile, align=''):
+def call_subset(args, image, slits, suffix='_slits'):
+    """Copy some slits of a frame to a new one, where they are numbered
+    from 1 (see `slitfix.subset`)"""
+    output = '{0}{1}'.format(image, suffix)
+    print('Slits {0} of {1} --> {2}'.format(
+        ','.join(str(slit) for slit in slits), image, output))
+    slitfix.subset('{0}.fits'.format(image), '{0}.fits'.format(output),
+                   slits)
+    return output
+
+
+def compare_solutions(args, arcs, slits, folder='database'):
+    """
+    Slits whose wavelength solution in the `call_subset` frame of every
+    arc (`arcs` maps arcs to their subsets) is better than in the arc
+    itself (see `wavecheck.improved`)
+    """
+    table = wavecheck.slit_table([folder])
+    better = list(slits)
+    for arc, subset in arcs.items():
+        improved = wavecheck.improved(table, subset, arc, slits)
+        better = [slit for slit in better if slit in improved]
+    print('Wavelength solutions improved for slits {0}'.format(
+        ', '.join(str(slit) for slit in better) or 'none'))
+    return better
+
+
+def discard_subset(args, subset, folder='database'):
+    """Delete a `call_subset` frame and its wavelength solutions"""
+    utils.delete('{0}.fits'.format(subset))
+    for kind in ('id', 'fc'):
+        utils.delete(os.path.join(folder, '{0}{1}_*'.format(kind, subset)))
+    return
+
+
+def splice_solutions(args, subset, arc, slits):
+    """Replace the wavelength solutions of some slits of an arc by those
+    of a `call_subset` frame (see `slitfix.copy_solutions`)"""
+    print('Wavelength solutions of {0} --> slits {1} of {2}'.format(
+        subset, ','.join(str(slit) for slit in slits), arc))
+    slitfix.copy_solutions(subset, arc, slits)
+    return
+
+
+def splice_slits(args, images, slits, suffix='_slits'):
+    """
+    Replace the slits of the products of a whole mask by those of the
+    frames produced from `call_subset` frames, and delete the latter.
+    The product of each frame is found by removing `suffix` from its
+    name. Returns the names of the updated products.
+    """
+    print('-' * 30)
+    updated = []
+    for image in images:
+        output = image.replace(suffix, '')
+        print('{0} --> {1}'.format(image, output))
+        slitfix.splice('{0}.fits'.format(output), '{0}.fits'.format(image),
+                       slits)
+        utils.delete('{0}.fits'.format(image))
+        updated.append(output)
+    print('-' * 30)
+    return updated
+
+
+def call_gsskysub(args, tgsfile, align='', longslit=False):
     out = gmos.gsskysub.outpref + tgsfile + align
-    if utils.skip(args, 'skysub', out):
+    if utils.skip(args, 'skysub', out, inputs=[tgsfile + align],
+                  tasks=[gmos.gsskysub],
+                  params=dict(engine=args.skysub_engine, longslit=longslit)):
         return out
     print('-' * 30)
     print('calling gsskysub')
@@ -193,14 +430,29 @@ def call_gsskysub(args, tgsfile, align=''):
     utils.delete('{0}.fits'.format(out))
     print('File {0} exists? {1}'.format(
         tgsfile, os.path.isfile(tgsfile)))
-    gmos.gsskysub(tgsfile + align, output=out)
+    if args.skysub_engine == 'native':
+        task = gmos.gsskysub
+        if longslit:
+            sample = dict(sample=task.long_sample)
+        else:
+            sample = dict(fraction=float(task.mos_sample))
+        skysub.skysub_file(
+            '{0}{1}.fits'.format(tgsfile, align), '{0}.fits'.format(out),
+            workers=args.skysub_workers, order=int(task.order),
+            low_reject=float(task.low_reject),
+            high_reject=float(task.high_reject),
+            niterate=int(task.niterate), **sample)
+    else:
+        gmos.gsskysub(tgsfile + align, output=out)
+    utils.record('skysub', out)
     print('-' * 30)
     return out
 
 
 def call_gnsskysub(args, inimages):
     out = gmos.gnsskysub.outpref + inimages
-    if utils.skip(args, 'skysub', out):
+    if utils.skip(args, 'skysub', out, inputs=[inimages],
+                  tasks=[gmos.gnsskysub]):
         return out
     print('-' * 30)
     print('calling gnsskysub')
@@ -208,6 +460,7 @@ def call_gnsskysub(args, inimages):
     print(out)
     utils.delete(out + '.fits')
     gmos.gnsskysub(inimages)
+    utils.record('skysub', out)
     print('-' * 30)
     return out
 
@@ -218,7 +471,8 @@ def call_gnscombine(args, inimages, outimage=''):
     """
     if not outimage:
         outimage = 'nsc-' + args.objectid
-    if utils.skip(args, 'combine', outimage):
+    if utils.skip(args, 'combine', outimage, inputs=[inimages],
+                  tasks=[gmos.gnscombine]):
         return outimage
     print('-' * 30)
     print('calling gnscombine')
@@ -230,27 +484,83 @@ def call_gnscombine(args, inimages, outimage=''):
     gmos.gnscombine(
         inimages, 'offsets.dat', outimage,
         outcheckim='{0}_cr'.format(outimage), outmedsky=outimage + '_sky')
+    utils.record('combine', outimage)
     print('-' * 30)
     return outimage
 
 
-def call_imcombine(args, mask, im, path='./', Nslits=1, longslit=False):
+def combined_name(args, mask, longslit=False):
+    """Name of the combined frame of a mask"""
     #if mask == 'longslit':
     if longslit:
-        outimage = '{0}{1}{2}-{3}_ls'.format(
+        return '{0}{1}{2}-{3}_ls'.format(
             gmos.gsskysub.outpref, gmos.gstransform.outpref,
             gmos.gsreduce.outpref, args.objectid.replace(' ', '_'))
-    else:
-        #outimage = '{0}{1}{2}-{3}_{4}'.format(
-            #gmos.gsskysub.outpref, gmos.gstransform.outpref,
-            #gmos.gsreduce.outpref, args.objectid.replace(' ', '_'), mask)
-        outimage = '{0}{1}{2}_{3}'.format(
-            gmos.gsskysub.outpref, gmos.gstransform.outpref,
-            gmos.gsreduce.outpref,  mask.replace('-', ''))
-    if utils.skip(args, 'combine', outimage):
+    #return '{0}{1}{2}-{3}_{4}'.format(
+        #gmos.gsskysub.outpref, gmos.gstransform.outpref,
+        #gmos.gsreduce.outpref, args.objectid.replace(' ', '_'), mask)
+    return '{0}{1}{2}_{3}'.format(
+        gmos.gsskysub.outpref, gmos.gstransform.outpref,
+        gmos.gsreduce.outpref,  mask.replace('-', ''))
+
+
+def call_coadd(args, mask, im, longslit=False):
+    """
+    Fold newly sky-subtracted exposures into the running coadd of the
+    mask, and write the current coadd. Only exposures not yet in the
+    coadd are read.
+    """
+    outimage = '{0}_coadd'.format(combined_name(args, mask, longslit))
+    running = coadd.RunningCoadd(outimage, weights=args.combine_weights)
+    # exposures no longer part of the mask. A forced rerun (-f) needs no
+    # reset: it rewrites the exposures, so the first one added restarts
+    # the coadd (see `RunningCoadd.add`) and later ones are folded in
+    if set(running.members) - set(im):
+        running.reset()
+    if all(image in running for image in im):
+        return outimage
+    print('-' * 30)
+    for image in im:
+        if not running.add(image):
+            # restarted, because an exposure changed
+            for other in im:
+                running.add(other)
+    running.write()
+    print('Current coadd of {0} exposures: {1}'.format(
+        len(running), outimage))
+    print('-' * 30)
+    return outimage
+
+
+def call_imcombine(args, mask, im, path='./', Nslits=1, longslit=False):
+    outimage = combined_name(args, mask, longslit)
+    if utils.skip(args, 'combine', outimage, inputs=im,
+                  tasks=[iraf.imcombine],
+                  params=dict(Nslits=Nslits, longslit=longslit,
+                              engine=args.combine_engine,
+                              weights=args.combine_weights)):
         return outimage
     print('-' * 30)
     print('Combining images {0} --> {1}'.format(im, outimage))
+    if args.combine_engine == 'native':
+        method = iraf.imcombine.combine
+        if method not in combine.METHODS:
+            print('Using average instead of {0} combine'.format(method))
+            method = 'average'
+        reject = iraf.imcombine.reject
+        if reject not in combine.REJECTIONS:
+            print('Using sigclip instead of {0} rejection'.format(reject))
+            reject = 'sigclip'
+        combine.combine(
+            ['{0}.fits'.format(image) for image in im],
+            '{0}.fits'.format(outimage), method=method,
+            reject=reject, lsigma=float(iraf.imcombine.lsigma),
+            hsigma=float(iraf.imcombine.hsigma),
+            weights=args.combine_weights, memory=args.combine_memory,
+            workers=args.combine_workers, rows=args.combine_rows)
+        utils.record('combine', outimage)
+        print('-' * 30)
+        return outimage
     os.system('cp {0}.fits {1}.fits'.format(im[0], outimage))
     #f = pyfits.open('{0}.fits'.format(os.path.join(path, im[0])))
     f = pyfits.open('{0}.fits'.format(im[0]))
@@ -258,26 +568,28 @@ def call_imcombine(args, mask, im, path='./', Nslits=1, longslit=False):
     rdnoise = float(f[0].header['RDNOISE'])
     f.close()
     for i in range(1, Nslits+1):
-        inslit = ''
-        for jm in im:
-            inslit = '{0}[sci,{1}],'.format(jm, i)
-        # to remove the last ','
-        inslit = inslit[:-1]
+        inslit = ','.join('{0}[sci,{1}]'.format(jm, i) for jm in im)
         outslit = outimage + '[sci,{0},overwrite]'.format(i)
         iraf.imcombine(inslit, output=outslit, gain=gain, rdnoise=rdnoise)
+    utils.record('combine', outimage)
     print('-' * 30)
     return outimage
 
 
 def call_gsextract(args, img):
     out = utils.add_prefix(img, gmos.gsextract)
-    if utils.skip(args, 'extract', out):
+    if utils.skip(args, 'extract', out, inputs=[img], tasks=[gmos.gsextract],
+                  params=dict(engine=args.extract_engine)):
         return out
     print('-' * 30)
     print('calling gsextract')
     print(img, '-->', out)
     utils.delete(out + '.fits')
-    gmos.gsextract(img)
+    if args.extract_engine == 'native':
+        extract.extract_file('{0}.fits'.format(img), '{0}.fits'.format(out))
+    else:
+        gmos.gsextract(img)
+    utils.record('extract', out)
     print('-' * 30)
     return out
 
@@ -296,7 +608,11 @@ def create_gradimage(args, img, bias, suff='grad'):
     gradimage = output['gscut']
     if suff:
         gradimage = '{0}_{1}'.format(output['gscut'], suff)
-    if utils.skip(args, 'gradimage', gradimage):
+    if utils.skip(args, 'gradimage', gradimage, inputs=[img, args.bias],
+                  tasks=[gmos.gsreduce, gmos.gmosaic, gmos.gscut],
+                  params=dict(nobias=args.nobias)):
+        return gradimage
+    if utils.fetch_calibration(args, 'gradimage', gradimage):
         return gradimage
 
     """
@@ -368,6 +684,8 @@ def create_gradimage(args, img, bias, suff='grad'):
     if not args.ds9:
         msg = 'You requested no ds9 session. Cannot inspect gscut results.'
         print(msg)
+        _store_gradimage(args, gradimage, output['gscut'], secfile)
+        utils.record('gradimage', gradimage)
         return gradimage
 
     msg_hold = \
@@ -402,21 +720,30 @@ def create_gradimage(args, img, bias, suff='grad'):
         print()
     print("Great! Moving on.\n")
     os.system('cp -p {0}.fits {1}.fits'.format(output['gscut'], gradimage))
+    _store_gradimage(args, gradimage, output['gscut'], secfile)
+    utils.record('gradimage', gradimage)
     return gradimage
 
 
+def _store_gradimage(args, gradimage, gscut, secfile):
+    utils.store_calibration(
+        args, 'gradimage', gradimage,
+        ['{0}.fits'.format(gradimage), '{0}.fits'.format(gscut), secfile])
+    return
+
+
 def cut_spectra(args, filename, mask, spec='1d', path='./'):
     """
     Takes the extracted spectra and copies them to a single folder called
     spectra/ (by default) in the parent folder. All spectra from all objects 
     will be in the same folder. This is in order for the spectra to be ready
     to cross-correlate with xcsao (for this, you need the RVSAO package for 
-    IRAF).
+    IRAF). With `--cut-format mef`, all spectra of a mask are written to a
+    single file instead (see `cut.write_multispec`).
     """
     print('-' * 30)
     print('Cutting spectra...')
     utils.makedir(args.cutdir)
-    spectra = []
     obj = args.objectid.replace(' ', '_')
     mask = mask.replace('-', '')
     if spec == '1d':
@@ -425,32 +752,94 @@ def cut_spectra(args, filename, mask, spec='1d', path='./'):
     elif spec == '2d':
         prefix = gmos.gsskysub.outpref + gmos.gstransform.outprefix + \
                  gmos.gsreduce.outpref
-    filename = os.path.join(path, filename)
-    Nslits = utils.get_nslits(filename)
-    for i in range(1, Nslits+1):
-        #if i < 10:
-            #out = os.path.join(
-                #args.cutdir,
-                #'{0}_{1}_0{2}{3}'.format(obj, mask, i, prefix[0]))
-            ##utils.delete(out + '.fits')
-            ##iraf.imcopy(filename+'[sci,'+str(i)+']', out, verbose='no')
-        #else:
+    filename = '{0}.fits'.format(os.path.join(path, filename))
+    # all slits are read at once and written from memory
+    if args.cut_format == 'mef':
         out = os.path.join(
-            args.cutdir,
-            '{0}_{1}_{2:02d}{3}'.format(obj, mask, i, prefix[0]))
-        #utils.delete(out + '.fits')
-        #iraf.imcopy(filename+'[sci,'+str(i)+']', out, verbose='no')
-        utils.delete(out + '.fits')
-        iraf.imcopy(filename+'[sci,'+str(i)+']', out, verbose='no')
+            args.cutdir, '{0}_{1}{2}.fits'.format(obj, mask, prefix[0]))
+        cut.write_multispec(
+            filename, out, '{0}_{1}_{{0:02d}}{2}'.format(obj, mask, prefix[0]))
+    else:
+        template = os.path.join(
+            args.cutdir, '{0}_{1}_{{0:02d}}{2}.fits'.format(
+                obj, mask, prefix[0]))
+        cut.split(filename, template, workers=args.cut_workers)
     print('-' * 30)
     return
 
 
-def cut_apertures(args, infile, outroot, Naps, path='../../spectra'):
+def store_spectra(args, filename, mask, path='./'):
+    """
+    Append the extracted spectra of a mask to the spectra store given by
+    --spectra-store, if any (see `store.SpectraStore`).
+    """
+    if not args.spectra_store:
+        return
+    filename = '{0}.fits'.format(os.path.join(path, filename))
+    store.SpectraStore(args.spectra_store).append(
+        filename, args.objectid, mask, program=args.program)
+    return
+
+
+def call_redshift(args):
+    """
+    Cross-correlate all extracted spectra of the object with the
+    templates given by --redshift-templates (see `redshift.fit`), reading
+    them from the spectra store if there is one, and from the cut 1d
+    spectra otherwise. The catalog is written to
+    ``<objectid>_redshifts.txt``.
+    """
+    obj = args.objectid.replace(' ', '_')
+    if args.spectra_store:
+        spectra = redshift.read_store(
+            store.SpectraStore(args.spectra_store), object=args.objectid)
+    else:
+        suffix = gmos.gsextract.outprefix
+        single = set(glob(os.path.join(
+            args.cutdir, '{0}_*_[0-9][0-9]{1}.fits'.format(obj, suffix))))
+        if args.cut_format == 'mef':
+            # one file per mask (see `cut_spectra`)
+            filenames = set(glob(os.path.join(
+                args.cutdir, '{0}_*{1}.fits'.format(obj, suffix)))) - single
+        else:
+            filenames = single
+        spectra = redshift.read_files(sorted(filenames))
+    if not spectra:
+        print('No spectra to cross-correlate')
+        return
+    print('-' * 30)
+    print('Cross-correlating {0} spectra'.format(len(spectra)))
+    catalog = redshift.fit(
+        spectra, redshift.read_templates(args.redshift_templates),
+        zmin=args.redshift_range[0], zmax=args.redshift_range[1],
+        workers=args.redshift_workers)
+    output = '{0}_redshifts.txt'.format(obj)
+    catalog.write(output, format='ascii.fixed_width', overwrite=True)
+    print('Redshifts written to', output)
+    print('-' * 30)
+    return output
+
+
+def cut_apertures(args, infile, outroot, path='../../spectra'):
+    """
+    Copy each aperture extracted from a longslit frame to its own file.
+    The native extraction writes one [SCI,i] extension per aperture,
+    while gsextract writes all apertures as lines of [SCI,1].
+    """
+    with pyfits.open('{0}.fits'.format(infile)) as hdulist:
+        sci = [hdu for hdu in hdulist if hdu.name == 'SCI']
+        if sci[0].data.ndim == 1:
+            for i, hdu in enumerate(sci):
+                header = cut.spectrum_header(hdulist[0].header, hdu.header)
+                out = '{0}{1}.fits'.format(outroot, i)
+                utils.delete(out)
+                pyfits.PrimaryHDU(hdu.data, header=header).writeto(out)
+            return len(sci)
+        Naps = sci[0].data.shape[0]
     for i in range(Naps):
         iraf.scopy('{0}[sci,1] {1}{2}'.format(infile, outroot, i),
                    apertures=i)
-    return
+    return Naps
 
 
 def MakeBias(args, files=[], date='', logfile='bias.log'):
@@ -0,0 +1,222 @@
+"""
+Quality assessment of wavelength solutions.
+
+Reads the ``database/id<arc>_NNN`` records written by `gswavelength`
+(or `arcid` and `wavetransfer`) directly, instead of parsing the text
+log of `gswavelength`. Each record holds the lines identified along one
+row section of a slit, with their fitted wavelengths; every line is
+matched to the closest wavelength of the (sorted, cached) line list
+with `np.searchsorted`, and the residuals of all lines of all records,
+slits and masks are reduced to per-slit statistics at once.
+
+For each slit the table gives the number of row sections (nrows), the
+median number of lines per section (nlines), the median and standard
+deviation over sections of their rms (rms, std, in Angstrom) and the
+median residual of all lines (offset), which is far from zero when the
+lines were misidentified.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import os
+import re
+from glob import glob
+from astropy.table import Table
+
+from . import arcid, database
+
+_idfile = re.compile(r'^id(?P<arc>.+)_(?P<slit>\d+)$')
+
+
+def _group_median(values, groups, ngroups):
+    """Median of `values` within each group (NaN for empty groups)"""
+    order = np.lexsort((values, groups))
+    counts = np.bincount(groups, minlength=ngroups)
+    start = np.r_[0, np.cumsum(counts)[:-1]]
+    last = max(values.size - 1, 0)
+    lo = np.clip(start + (counts - 1) // 2, 0, last)
+    hi = np.clip(start + counts // 2, 0, last)
+    ordered = values[order] if values.size else np.zeros(1)
+    return np.where(counts > 0, 0.5 * (ordered[lo] + ordered[hi]), np.nan)
+
+
+def _group_std(values, groups, ngroups):
+    counts = np.bincount(groups, minlength=ngroups)
+    n = np.maximum(counts, 1)
+    mean = np.bincount(groups, values, ngroups) / n
+    mean2 = np.bincount(groups, values**2, ngroups) / n
+    return np.where(counts > 0, np.sqrt(np.maximum(mean2 - mean**2, 0)),
+                    np.nan)
+
+
+def read_features(folder, mask=''):
+    """Fitted wavelengths of the lines of all `identify` records in a
+    database folder
+
+    Returns
+    -------
+    slits : list of (mask, arc, slit) tuples
+    wave : 1d array
+        fitted wavelength of each line
+    slit_index : 1d int array
+        index in `slits` of the slit of each line
+    record_index : 1d int array
+        index of the record (row section) of each line, unique within
+        `folder`
+
+    """
+    slits = []
+    wave = []
+    slit_index = []
+    record_index = []
+    nrecords = 0
+    for filename in sorted(glob(os.path.join(folder, 'id*'))):
+        match = _idfile.match(os.path.basename(filename))
+        if match is None:
+            continue
+        slits.append((str(mask), match.group('arc'),
+                      int(match.group('slit'))))
+        for record in database.read(filename):
+            if 'features' not in record:
+                continue
+            features = record.table('features')
+            if features.size == 0:
+                continue
+            if features.shape[1] > 5:
+                # lines rejected by the fit have zero weight
+                features = features[features[:, 5] > 0]
+            wave.append(features[:, 1])
+            slit_index.append(np.full(len(features), len(slits) - 1))
+            record_index.append(np.full(len(features), nrecords))
+            nrecords += 1
+    if not wave:
+        return slits, np.zeros(0), np.zeros(0, int), np.zeros(0, int)
+    return slits, np.concatenate(wave), \
+        np.concatenate(slit_index).astype(int), \
+        np.concatenate(record_index).astype(int)
+
+
+def slit_table(folders, masks=None, catalog=None):
+    """Wavelength calibration statistics of every slit
+
+    Parameters
+    ----------
+    folders : list of str
+        database folders (e.g., one per mask)
+    masks : list, optional
+        label of each folder in the table. By default, the name of the
+        directory containing it.
+    catalog : str, optional
+        line list (see `arcid.read_linelist`)
+
+    Returns
+    -------
+    table : `astropy.table.Table`
+        one row per slit, with columns mask, arc, slit, nrows, nlines,
+        rms, std and offset (see the module docstring)
+
+    """
+    if masks is None:
+        masks = [os.path.basename(os.path.dirname(os.path.abspath(f)))
+                 for f in folders]
+    slits = []
+    wave = []
+    slit_index = []
+    record_index = []
+    nrecords = 0
+    for folder, mask in zip(folders, masks):
+        s, w, si, ri = read_features(folder, mask)
+        wave.append(w)
+        slit_index.append(si + len(slits))
+        record_index.append(ri + nrecords)
+        slits.extend(s)
+        nrecords += ri.max() + 1 if ri.size else 0
+    wave = np.concatenate(wave) if wave else np.zeros(0)
+    slit_index = np.concatenate(slit_index).astype(int) if wave.size \
+        else np.zeros(0, int)
+    record_index = np.concatenate(record_index).astype(int) if wave.size \
+        else np.zeros(0, int)
+    lines = arcid.read_linelist(catalog)
+    resid = wave - lines[arcid.nearest(lines, wave)] if wave.size \
+        else np.zeros(0)
+    # per record (row section)
+    nlines = np.bincount(record_index, minlength=nrecords)
+    rms = np.sqrt(np.bincount(record_index, resid**2, nrecords)
+                  / np.maximum(nlines, 1))
+    record_slit = np.zeros(nrecords, int)
+    record_slit[record_index] = slit_index
+    used = nlines > 0
+    # per slit
+    nslits = len(slits)
+    table = Table(rows=slits, names=('mask', 'arc', 'slit'),
+                  dtype=(str, str, int)) if slits \
+        else Table(names=('mask', 'arc', 'slit'), dtype=(str, str, int))
+    table['nrows'] = np.bincount(record_slit[used], minlength=nslits)
+    table['nlines'] = _group_median(
+        nlines[used].astype(float), record_slit[used], nslits)
+    table['rms'] = _group_median(rms[used], record_slit[used], nslits)
+    table['std'] = _group_std(rms[used], record_slit[used], nslits)
+    table['offset'] = _group_median(resid, slit_index, nslits)
+    table['nlines'].format = '.0f'
+    for column in ('rms', 'std', 'offset'):
+        table[column].format = '.4f'
+    return table
+
+
+def flagged(table, thresh=0.25):
+    """Slits whose median rms exceeds `thresh` (or without solution)
+
+    Returns
+    -------
+    bad : dict
+        sorted slit numbers of each (mask, arc)
+
+    """
+    bad = {}
+    for row in table:
+        if not row['rms'] <= thresh:
+            bad.setdefault((str(row['mask']), str(row['arc'])), []).append(
+                int(row['slit']))
+    return dict((key, sorted(slits)) for key, slits in bad.items())
+
+
+def improved(table, fixed, arc, slits):
+    """Slits of `arc` with a lower rms in `fixed`
+
+    `fixed` is an arc written by `slitfix.subset`, where slit
+    ``slits[k-1]`` of `arc` is slit k. Slits without a solution in
+    `arc` are improved by any solution.
+
+    """
+    rms = dict(((str(row['arc']), int(row['slit'])), row['rms'])
+               for row in table)
+    better = []
+    for k, slit in enumerate(slits, 1):
+        new = rms.get((fixed, k), np.nan)
+        old = rms.get((arc, slit), np.nan)
+        if np.isfinite(new) and not old <= new:
+            better.append(slit)
+    return better
+
+
+def summary(table):
+    """Print the rms statistics of each arc"""
+    for mask, arc in sorted(set(zip(table['mask'], table['arc']))):
+        rows = table[(table['mask'] == mask) & (table['arc'] == arc)]
+        rms = np.asarray(rows['rms'])
+        std = np.asarray(rows['std'])
+        if not np.isfinite(rms).any():
+            continue
+        print('Mask', mask)
+        print(arc)
+        print('Wavelength calibration RMS (values over all slits, in' \
+              ' Angstrom):')
+        print('  median={0:.3f}    min={1:.3f}    max={2:.3f}'.format(
+                np.nanmedian(rms), np.nanmin(rms), np.nanmax(rms)))
+        print('  median_std={0:.3f}    min_std={1:.3f}' \
+              '    max_std={2:.3f}'.format(
+                np.nanmedian(std), np.nanmin(std), np.nanmax(std)))
+        print('-' * 50)
+        print('-' * 50)
+    return
@@ -0,0 +1,236 @@
+"""
+Transfer of wavelength solutions between arcs of the same setup.
+
+Arcs of a mask taken at the same central wavelength and binning differ
+mostly by a small shift along the dispersion direction (flexure), so
+instead of identifying their lines again with `gswavelength`, each slit
+of a new arc is cross-correlated with the same slit of a reference arc
+whose lines were identified, and the `identify` and `fitcoords` records
+of the reference are shifted accordingly (see `database.shift`).
+
+The transfer is checked by measuring the positions of the identified
+lines in the new arc: if the correlation of any slit is poor, or the
+scatter of the transferred solution around the catalog wavelengths is
+too large, nothing is written and the full identification must be run
+instead.
+
+The reference arc of each setup is kept in a JSON file in the
+database folder.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import numpy as np
+import os
+try:
+    from astropy.io import fits as pyfits
+except ImportError:
+    import pyfits
+
+from . import database
+
+REFERENCES = 'references.json'
+
+
+def setup_key(arc):
+    """Mask, central wavelength and binning of an arc"""
+    head = pyfits.getheader('{0}.fits'.format(arc))
+    return '{0}_{1}_{2}'.format(
+        head.get('MASKNAME', ''), head.get('CENTWAVE', ''),
+        str(head.get('CCDSUM', '')).replace(' ', 'x'))
+
+
+def arc_spectrum(data, nrows=5):
+    """Median of the central rows of a slit"""
+    middle = data.shape[0] // 2
+    lo = max(0, middle - nrows // 2)
+    return np.median(data[lo:lo+nrows], axis=0)
+
+
+def _normalize(spectrum):
+    spectrum = np.where(np.isfinite(spectrum), spectrum, 0)
+    spectrum = spectrum - np.median(spectrum)
+    norm = np.sqrt((spectrum**2).sum())
+    return spectrum / (norm if norm > 0 else 1)
+
+
+def measure_shift(reference, spectrum, max_shift=20.):
+    """Shift of an arc spectrum with respect to a reference
+
+    Returns
+    -------
+    dx : float
+        shift, in pixels, such that a line at pixel x in the reference
+        is at x + dx in `spectrum`
+    correlation : float
+        normalized correlation coefficient at the peak
+
+    """
+    n = max(reference.size, spectrum.size)
+    nfft = 1
+    while nfft < 2 * n:
+        nfft *= 2
+    xc = np.fft.irfft(np.fft.rfft(_normalize(spectrum), nfft)
+                      * np.conj(np.fft.rfft(_normalize(reference), nfft)),
+                      nfft)
+    lags = np.arange(-int(max_shift), int(max_shift) + 1)
+    window = xc[lags % nfft]
+    best = window.argmax()
+    peak = lags[best]
+    left, center, right = xc[(peak + np.array([-1, 0, 1])) % nfft]
+    denom = left - 2*center + right
+    offset = 0.5 * (left - right) / denom if denom < 0 else 0.
+    return peak + float(np.clip(offset, -0.5, 0.5)), float(center)
+
+
+def centroids(spectrum, positions, halfwidth=3, niter=3):
+    """Centroids of the lines of a spectrum closest to `positions`
+    (0-indexed pixels), recentering the window `niter` times"""
+    positions = np.asarray(positions, dtype=float)
+    offsets = np.arange(-halfwidth, halfwidth+1)
+    for i in range(niter):
+        idx = np.round(positions).astype(int)[:, None] + offsets
+        inside = (idx >= 0) & (idx < spectrum.size)
+        values = np.where(
+            inside, spectrum[np.clip(idx, 0, spectrum.size-1)], np.nan)
+        values = values - np.nanmin(values, axis=1)[:, None]
+        values = np.where(inside, values, 0)
+        total = values.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            new = (values * idx).sum(axis=1) / total
+        positions = np.where(total > 0, new, np.nan)
+        if not np.isfinite(positions).any():
+            break
+        positions = np.where(np.isfinite(positions), positions, -1e9)
+    return np.where(positions > -1e8, positions, np.nan)
+
+
+def transfer_rms(record, spectrum):
+    """Robust scatter, in pixels, of the lines of an `identify` record
+    around their catalog wavelengths, measured in `spectrum`"""
+    features = record.table('features')
+    if features.shape[0] < 3:
+        return np.inf
+    if features.shape[1] > 5:
+        # lines deleted or rejected in the reference have zero weight
+        features = features[features[:, 5] > 0]
+    # IRAF pixel coordinates start at 1
+    x = centroids(spectrum, features[:, 0] - 1) + 1
+    good = np.isfinite(x)
+    if good.sum() < 3:
+        return np.inf
+    residuals = database.evaluate(record, x[good]) - features[good, 2]
+    center = features[:, 0].mean()
+    dispersion = np.abs(np.diff(database.evaluate(
+        record, [center - 0.5, center + 0.5]))[0])
+    # robust against blended lines, but not against an offset
+    return 1.4826 * np.median(np.abs(residuals)) / dispersion
+
+
+def _filename(folder, kind, arc, slit):
+    return os.path.join(folder, '{0}{1}_{2:03d}'.format(kind, arc, slit))
+
+
+def transfer(reference, arc, folder='database', max_shift=20.,
+             min_correlation=0.5, max_rms=0.5, verbose=True):
+    """Transfer the wavelength solution of a reference arc
+
+    Parameters
+    ----------
+    reference : str
+        arc with a full wavelength solution in `folder`
+    arc : str
+        new arc, with the same slits
+    folder : str
+        IRAF database folder
+    max_shift : float
+        maximum shift, in pixels
+    min_correlation : float
+        minimum correlation coefficient of each slit
+    max_rms : float
+        maximum scatter of the transferred solution of each slit, in
+        pixels
+
+    Returns
+    -------
+    transferred : bool
+        whether the solution was transferred (and written). If False,
+        the database was not modified.
+
+    """
+    records = {}
+    with pyfits.open('{0}.fits'.format(reference)) as ref, \
+            pyfits.open('{0}.fits'.format(arc)) as new:
+        for hdu in new:
+            if hdu.name != 'SCI' or hdu.data is None:
+                continue
+            slit = hdu.header['EXTVER']
+            files = [_filename(folder, kind, reference, slit)
+                     for kind in ('id', 'fc')]
+            if not all(os.path.isfile(f) for f in files):
+                if verbose:
+                    print('No solution of {0} for slit {1}'.format(
+                        reference, slit))
+                return False
+            try:
+                refdata = ref['SCI', slit].data
+            except KeyError:
+                return False
+            spectrum = arc_spectrum(hdu.data)
+            dx, corr = measure_shift(arc_spectrum(refdata), spectrum,
+                                     max_shift=max_shift)
+            ids, fcs = [database.read(f) for f in files]
+            for record in ids + fcs:
+                database.shift(record, dx)
+                database.rename(record, reference, arc)
+            try:
+                rms = transfer_rms(ids[0], spectrum)
+            except (KeyError, IndexError, NotImplementedError):
+                rms = np.inf
+            if verbose:
+                print('{0}[SCI,{1}]: shift {2:+.2f} px, correlation {3:.2f},'
+                      ' rms {4:.2f} px'.format(arc, slit, dx, corr, rms))
+            if corr < min_correlation or rms > max_rms:
+                return False
+            records[slit] = (ids, fcs)
+    if not records:
+        return False
+    for slit, (ids, fcs) in records.items():
+        database.write(_filename(folder, 'id', arc, slit), ids)
+        database.write(_filename(folder, 'fc', arc, slit), fcs)
+    return True
+
+
+class References(object):
+
+    """Reference arc of each setup, stored in the database folder"""
+
+    def __init__(self, folder='database'):
+        self.folder = folder
+        self.filename = os.path.join(folder, REFERENCES)
+
+    def _read(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, arc):
+        """Reference for the setup of `arc`, or None"""
+        reference = self._read().get(setup_key(arc))
+        if reference is None or reference == arc \
+                or not os.path.isfile('{0}.fits'.format(reference)):
+            return None
+        return reference
+
+    def add(self, arc):
+        """Make `arc` the reference of its setup"""
+        references = self._read()
+        references[setup_key(arc)] = arc
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        with open(self.filename, 'w') as f:
+            json.dump(references, f, indent=1, sort_keys=True)
+        return
@@ -0,0 +1,172 @@
+"""
+Shared store of processed calibration products.
+
+The same GCAL flats and CuAr arcs are usually processed in several
+object and mask directories, and in every run. Their products (reduced
+and combined flats, gradient images, reduced arcs and wavelength
+solutions) are therefore kept in a shared directory, keyed by the
+provenance digest of the step that produced them (see
+`provenance.digest`), which covers the raw calibration file and all
+processing parameters. Working directories get symbolic links to the
+stored FITS products instead of running the step again, and copies of
+the others (the small text records of the wavelength solutions, which
+tasks such as `gswavelength` update in place).
+
+Stored products are read-only, so that a task writing through a link
+fails instead of changing a product stored under the digest of other
+inputs; tasks must remove their outputs before writing them again.
+
+The least recently used products are removed when the store grows
+beyond its disk budget. Links to them are then left dangling, so the
+steps that produced them run again when needed.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from time import time
+
+INDEX = 'index.json'
+
+
+class CalibrationCache(object):
+
+    """Shared calibration product store
+
+    Parameters
+    ----------
+    root : str
+        directory of the store. May be shared by several users and
+        runs (access to the index is serialized with a file lock).
+    budget : float, optional
+        maximum size of the store, in bytes. No limit if None.
+
+    """
+
+    def __init__(self, root, budget=None):
+        self.root = os.path.abspath(root)
+        self.budget = budget
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    @contextmanager
+    def _index(self):
+        """Lock, read and (on exit) write the index"""
+        with open(os.path.join(self.root, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                filename = os.path.join(self.root, INDEX)
+                try:
+                    with open(filename) as f:
+                        index = json.load(f)
+                except (IOError, ValueError):
+                    index = {}
+                yield index
+                with open(filename + '.tmp', 'w') as f:
+                    json.dump(index, f, indent=1, sort_keys=True)
+                os.rename(filename + '.tmp', filename)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _path(self, key, product):
+        return os.path.join(self.root, key, product.replace(os.sep, '__'))
+
+    def fetch(self, step, digest):
+        """Link (or copy) stored products into the working directory
+
+        Parameters
+        ----------
+        step : str
+            name of the reduction step
+        digest : str
+            provenance digest of the step
+
+        Returns
+        -------
+        products : list of str
+            the linked products, relative to the working directory, or
+            None if they are not in the store
+
+        """
+        key = '{0}-{1}'.format(step, digest)
+        with self._index() as index:
+            entry = index.get(key)
+            if entry is None or not all(
+                    os.path.isfile(self._path(key, product))
+                    for product in entry['products']):
+                return None
+            for product in entry['products']:
+                _place(self._path(key, product), product)
+            entry['used'] = time()
+        print('Using {0} products from the calibration cache: {1}'.format(
+            step, ', '.join(entry['products'])))
+        return entry['products']
+
+    def store(self, step, digest, products):
+        """Move products into the store and link (or copy) them back
+
+        Products that do not exist, or are already links (e.g., to the
+        store), are ignored.
+
+        """
+        products = [product for product in products
+                    if os.path.isfile(product)
+                    and not os.path.islink(product)]
+        if not products:
+            return
+        key = '{0}-{1}'.format(step, digest)
+        folder = os.path.join(self.root, key)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        size = 0
+        for product in products:
+            stored = self._path(key, product)
+            shutil.move(product, stored)
+            os.chmod(stored, 0o444)
+            _place(stored, product)
+            size += os.path.getsize(stored)
+        with self._index() as index:
+            index[key] = {'products': products, 'size': size, 'used': time()}
+            self._evict(index, keep=key)
+        return
+
+    def _evict(self, index, keep=None):
+        """Remove least recently used entries beyond the budget"""
+        if self.budget is None:
+            return
+        total = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda key: index[key]['used']):
+            if total <= self.budget:
+                break
+            if key == keep:
+                continue
+            print('Removing {0} from the calibration cache'.format(key))
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            total -= index.pop(key)['size']
+        return
+
+
+def _place(source, destination):
+    """Symbolic link to a FITS file, or a writable copy of any other
+    file, replacing `destination` if it exists
+
+    Copies keep the modification time of the stored file, so that the
+    provenance digests of steps reading them (see `provenance.signature`)
+    are the same in every working directory.
+
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    folder = os.path.dirname(destination)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    if source.endswith('.fits'):
+        os.symlink(source, destination)
+    else:
+        shutil.copy2(source, destination)
+        os.chmod(destination, 0o644)
+    return
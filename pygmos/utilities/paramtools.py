@@ -74,14 +74,83 @@ def parse_args():
         help='Produce a FITS file with spectra aligned by wavelength')
     add('-b', '--bias', dest='bias', default='',
         help='Bias file')
+    add('--calib-cache', dest='calib_cache', default=None,
+        help='Directory in which to keep processed flats, gradient images,' \
+             ' arcs and wavelength solutions, to be reused by other' \
+             ' objects and runs (default: no cache)')
+    add('--calib-cache-size', dest='calib_cache_size', default=20.,
+        type=float,
+        help='Maximum size of the calibration cache, in GB. The least' \
+             ' recently used products are removed beyond this size')
+    add('--combine-engine', dest='combine_engine', default='iraf',
+        choices=('native', 'iraf'),
+        help='Implementation used to combine exposures: "native" reads all' \
+             ' frames as memory-mapped files and combines them in blocks' \
+             ' of rows; "iraf" runs imcombine on each slit. Both use the' \
+             ' combine, reject, lsigma and hsigma imcombine parameters')
+    add('--combine-memory', dest='combine_memory', default=1024.,
+        type=float,
+        help='Approximate memory, in MB, used by the native combine engine')
+    add('--combine-rows', dest='combine_rows', default=None, type=int,
+        help='Number of rows combined at a time by the native engine' \
+             ' (default: as many as fit in --combine-memory)')
+    add('--combine-workers', dest='combine_workers', default=1, type=int,
+        help='Number of processes among which the native engine' \
+             ' distributes blocks of rows (ignored when --jobs > 1)')
+    add('--combine-weights', dest='combine_weights', default='none',
+        choices=('none', 'ivar'),
+        help='Weight exposures by their inverse variance when averaging' \
+             ' them (native engine only; requires VAR extensions)')
+    add('--cr-stack-min', dest='crstack_min', default=0, type=int,
+        help='Minimum number of exposures of a mask with the same central' \
+             ' wavelength for their cosmic rays to be found by comparing' \
+             ' them with each other after gstransform, instead of running' \
+             ' LACos on each one (at least 3; 0 to always use LACos)')
+    add('--cr-stack-snoise', dest='crstack_snoise', default=0.1, type=float,
+        help='Fractional noise allowed between exposures compared to find' \
+             ' cosmic rays (see --cr-stack-min), for changes in seeing and' \
+             ' sky lines (as the snoise parameter of imcombine)')
     add('--cut-dir', dest='cutdir', default='spectra',
         help='Directory into which the individual 1d spectra will be saved' \
              ' (if --no-cut has not been set)')
+    add('--cut-format', dest='cut_format', default='files',
+        choices=('files', 'mef'),
+        help='Write cut spectra as one file per slit ("files") or as a' \
+             ' single indexed file per mask and spectrum type ("mef")')
+    add('--cut-workers', dest='cut_workers', default=1, type=int,
+        help='Number of processes writing cut spectra')
+    add('--extract-engine', dest='extract_engine', default='iraf',
+        choices=('native', 'iraf'),
+        help='Extraction implementation: "native" finds the objects in' \
+             ' each slit and extracts all of them at once with optimal' \
+             ' (Horne) weights; "iraf" runs gsextract')
+    add('--fix-slits', dest='fix_slits', action='store_true',
+        help='After reducing a MOS mask, reduce again only the slits whose' \
+             ' wavelength calibration fails the check of check_gswave,' \
+             ' and replace them in the products of the mask')
     add('-f', dest='force_overwrite', action='store_true',
-        help='Force overwrite')
+        help='Force overwrite: run all steps again, even those whose' \
+             ' outputs are up to date')
+    add('--header-index', dest='header_index', default=None,
+        help='SQLite file in which to cache the FITS headers of the raw' \
+             ' files (default: pygmos_headers.db in --path)')
     add('-i', '--inventory', dest='inventory_only', action='store_true',
         help='Only run the inventory for a given object, without actually' \
              ' reducing the data')
+    add('-j', '--jobs', dest='jobs', default=1, type=int,
+        help='Number of processes used to reduce independent exposures and' \
+             ' masks in parallel. With more than one process, frames are' \
+             ' not displayed and --align is ignored')
+    add('--lacos-engine', dest='lacos_engine', default='iraf',
+        choices=('native', 'iraf'),
+        help='Cosmic ray rejection implementation: "native" processes all' \
+             ' slits in memory with numpy/scipy (falling back to "iraf"' \
+             ' if scipy is not installed); "iraf" runs lacos_spec.cl on' \
+             ' each slit. Both use the lacos_spec parameters')
+    add('--lacos-workers', dest='lacos_workers', default=1, type=int,
+        help='Number of processes among which the slits of each frame are' \
+             ' distributed for cosmic ray rejection (native engine only;' \
+             ' ignored when --jobs > 1)')
     add('-m', '--masks', dest='masks', nargs='*', default='all',
         help='Which MOS masks to reduce (identified by their numbers),' \
              ' or "longslit" if you are going to reduce longslit' \
@@ -91,18 +160,70 @@ def parse_args():
              ' (NOT YET IMPLEMENTED)')
     add('--no-bias', dest='nobias', action='store_true',
         help='Allow the pipeline to run without applying a bias correction')
+    add('--no-coadd', dest='coadd', action='store_false',
+        help='Do not keep a running coadd of each mask, updated as soon as' \
+             ' each exposure is sky-subtracted')
     add('--no-ds9', dest='ds9', action='store_false',
         help='Do not start a ds9 session to display files as they are' \
              ' created')
+    add('--no-wave-transfer', dest='wave_transfer', action='store_false',
+        help='Always identify arc lines from scratch, instead of shifting' \
+             ' the solution of a previous arc of the same mask, central' \
+             ' wavelength and binning when it matches the new arc')
     add('-p', '--param-file', dest='paramfile', default='pygmos.param',
         help='File containing IRAF parameter definitions')
     add('--path', dest='path', default='./',
-        help='path to raw GMOS files')
+        help='path to raw GMOS files, or a tar (.tar, .tar.bz2, .tar.gz)' \
+             ' archive containing them. Only the files needed for the' \
+             ' chosen object are extracted from archives')
+    add('--scan-workers', dest='scan_workers', default=1, type=int,
+        help='Number of threads used to read FITS headers during the' \
+             ' inventory. Values larger than 1 help on network filesystems')
     add('--program', dest='program', default='',
         help='Gemini Program ID')
+    add('--redshift-range', dest='redshift_range', nargs=2, type=float,
+        default=(0., 1.5), metavar=('ZMIN', 'ZMAX'),
+        help='Redshift range searched by the cross-correlation')
+    add('--redshift-templates', dest='redshift_templates', nargs='*',
+        default=None,
+        help='Rest-frame template spectra (FITS or two-column text files).' \
+             ' If given, the redshifts of all extracted spectra are' \
+             ' measured by cross-correlation after the reduction')
+    add('--redshift-workers', dest='redshift_workers', default=1, type=int,
+        help='Number of processes among which spectra are distributed for' \
+             ' the cross-correlation')
     add('-r', '--read-inventory', dest='read_inventory', action='store_true',
         help='Read an already-existing inventory file instead of producing' \
              ' one')
+    add('--skysub-engine', dest='skysub_engine', default='iraf',
+        choices=('native', 'iraf'),
+        help='Sky subtraction implementation: "native" fits all columns' \
+             ' of each slit at once, masking rows with objects; "iraf"' \
+             ' runs gsskysub. Both use the gsskysub sample, order and' \
+             ' rejection parameters')
+    add('--skysub-workers', dest='skysub_workers', default=1, type=int,
+        help='Number of processes among which slits are distributed for' \
+             ' sky subtraction (native engine only; ignored when' \
+             ' --jobs > 1)')
+    add('--spectra-store', dest='spectra_store', default=None,
+        help='Also append the extracted spectra of each mask to this' \
+             ' memory-mapped spectra store, with their MDF metadata')
+    add('--wave-engine', dest='wave_engine', default='iraf',
+        choices=('native', 'iraf'),
+        help='Arc line identification: "native" finds and matches the' \
+             ' lines of all slits automatically (falling back to' \
+             ' gswavelength if any slit fails); "iraf" runs gswavelength.' \
+             ' Both use the gswavelength coordlist and fitting orders')
+    add('--wave-workers', dest='wave_workers', default=1, type=int,
+        help='Number of processes among which slits are distributed for' \
+             ' the native line identification')
+    add('-w', '--watch', dest='watch', action='store_true',
+        help='Keep monitoring --path and reduce each science exposure as' \
+             ' soon as its flat and arc are available (up to sky' \
+             ' subtraction). Stop with Ctrl-C')
+    add('--watch-interval', dest='watch_interval', default=30, type=float,
+        help='Polling interval, in seconds, for --watch (only used if' \
+             ' pyinotify is not installed)')
 
     # dump files
     path_docs = join(split(environ['pygmos_path'])[0], 'docs')
@@ -0,0 +1,121 @@
+"""
+Provenance records of reduction products.
+
+Every product of a reduction step is recorded together with a digest of
+everything that went into it: the size and modification time of its
+input files, the parameters of the IRAF tasks involved, any additional
+arguments and the pygmos version. A step whose output exists and whose
+digest did not change since it was produced does not need to be run
+again. Since rerunning a step updates its output, the digests of all
+downstream steps change too.
+
+Records are stored as one small JSON file per product in the
+`RECORD_DIR` folder of the working directory, so that steps running
+concurrently in the same directory do not overwrite each other.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import os
+from glob import glob
+
+from .. import __version__
+
+RECORD_DIR = '.provenance'
+
+# digests computed by `utils.skip`, waiting for the task to finish
+_pending = {}
+
+
+def signature(filename):
+    """Size and modification time of a file (following symlinks)
+
+    `filename` may lack the ``.fits`` extension, and may be a glob
+    pattern, in which case all matching files are included.
+
+    """
+    if '*' in filename or '?' in filename:
+        return [signature(name) for name in sorted(glob(filename))]
+    for name in (filename, '{0}.fits'.format(filename)):
+        if os.path.isfile(name):
+            stat = os.stat(name)
+            return [os.path.basename(name), stat.st_size, stat.st_mtime]
+    return [os.path.basename(filename), None, None]
+
+
+def task_parameters(task):
+    """Current parameters of an IRAF task, as (name, value) pairs"""
+    return [(par.name, str(par.value)) for par in task.getParList()]
+
+
+def digest(inputs=(), tasks=(), params=None):
+    """Digest of the provenance of a product
+
+    Parameters
+    ----------
+    inputs : list of str
+        input files (or glob patterns)
+    tasks : list of IRAF tasks
+        tasks whose parameters affect the product
+    params : dict, optional
+        any other arguments that affect the product
+
+    """
+    provenance = {
+        'version': __version__,
+        'inputs': [signature(name) for name in inputs if name],
+        'tasks': [[task.getName(), task_parameters(task)] for task in tasks],
+        'params': sorted((str(key), str(value))
+                         for key, value in (params or {}).items())}
+    dump = json.dumps(provenance, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(dump).hexdigest()
+
+
+def _record_file(output):
+    path, name = os.path.split(output)
+    return os.path.join(path, RECORD_DIR, '{0}.json'.format(name))
+
+
+def load(output):
+    """Digests recorded for `output`, by step name"""
+    try:
+        with open(_record_file(output)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def matches(output, step, value):
+    """Whether `output` was produced by `step` with digest `value`"""
+    return load(output).get(step) == value
+
+
+def stage(output, step, value):
+    """Keep a digest until `commit` is called for `output`"""
+    _pending[(output, step)] = value
+    return
+
+
+def pending(output, step):
+    """Digest staged for `output`, if any"""
+    return _pending.get((output, step))
+
+
+def commit(output, step):
+    """Record the digest staged for `output` once it has been produced"""
+    value = _pending.pop((output, step), None)
+    if value is None or not os.path.isfile(output):
+        return
+    records = load(output)
+    records[step] = value
+    filename = _record_file(output)
+    try:
+        os.makedirs(os.path.dirname(filename))
+    # already exists (possibly created by another process)
+    except OSError:
+        pass
+    with open(filename, 'w') as f:
+        json.dump(records, f, indent=1, sort_keys=True)
+    return
@@ -0,0 +1,43 @@
+"""
+Memory blocks shared between the processes of a `multiprocessing.Pool`.
+
+Uses `multiprocessing.shared_memory` where available (Python 3.8+), and
+`multiprocessing.sharedctypes.RawArray` otherwise. Blocks must be given
+to the workers through the pool initializer.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+from multiprocessing.sharedctypes import RawArray
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+def allocate(nbytes):
+    """New shared memory block of (at least) `nbytes` bytes"""
+    nbytes = max(int(nbytes), 1)
+    if shared_memory is not None:
+        return shared_memory.SharedMemory(create=True, size=nbytes)
+    return RawArray('b', nbytes)
+
+
+def array(block, dtype):
+    """1d numpy view of a shared memory block
+
+    Views must be deleted before the block is released.
+
+    """
+    if shared_memory is not None:
+        return np.frombuffer(block.buf, dtype=dtype)
+    return np.frombuffer(block, dtype=dtype)
+
+
+def release(block):
+    """Free a block created by `allocate` (in the creating process)"""
+    if shared_memory is not None:
+        block.close()
+        block.unlink()
+    return
@@ -10,6 +10,10 @@ try:
 except ImportError:
     import pyfits
 
+from . import provenance
+from .calibcache import CalibrationCache
+from ..inventory.association import Association
+
 if sys.version_info[0] == 3:
     basestring = str
 
@@ -78,54 +82,47 @@ def delete(filename):
 
 
 def get_science_files(assocfile, mask):
-    file = open(assocfile)
-    head = '#'
-    while head[0] == '#':
-        head = file.readline()
-    head = head.split()
-    scol = head.index('Science')
-    mcol = head.index('Mask')
-    science = {}
-    for line in file:
-        if line[0] == '#':
-            continue
-        line = line.split()
-        if len(line) >= 7:
-            if line[mcol] == mask:
-                science[line[scol]] = int(line[2])
-    return science
-
-
-def get_darks():
-    darks = []
-    for ls in glob('*.fits'):
-        head = pyfits.getheader(ls)
-        if head['OBSTYPE'] == 'DARK':
-            darks.append(ls[:-5])
+    """Dictionary of {science: wave} for a mask in an association file
+
+    Prefer `Association.science_files` when the association has
+    already been loaded.
+
+    """
+    return Association.read(assocfile).science_files(mask)
+
+
+def get_darks(index=None):
+    """Comma-separated list of dark frames in the working directory
+
+    If a `HeaderIndex` is given, headers are taken from it and only
+    files not yet indexed are opened.
+
+    """
+    files = sorted(glob('*.fits'))
+    if index is None:
+        headers = [pyfits.getheader(ls) for ls in files]
+    else:
+        headers = index.update(files)
+    darks = [ls[:-5] for ls, head in zip(files, headers)
+             if head.get('OBSTYPE') == 'DARK']
     return ','.join(darks)
 
 
 def get_wavelengths(assocfile):
-    file = open(assocfile)
-    head = '#'
-    while head[0] == '#':
-        head = file.readline()
-    head = head.split()
-    wavecol = head.index('Wave')
-    waves = []
-    for line in file:
-        if line[0] != '#':
-            line = line.split()
-            w = int(line[wavecol])
-            if not w in waves:
-                waves.append(w)
-    return waves
+    """Central wavelengths in an association file
+
+    Prefer `Association.wavelengths` when the association has already
+    been loaded.
+
+    """
+    return Association.read(assocfile).wavelengths
 
 
 def get_nslits(filename):
-    f = pyfits.open('{0}.fits'.format(filename))
-    N =  len(f) - 2
-    f.close()
+    # count SCI extensions, so that VAR and DQ planes are not mistaken
+    # for slits
+    with pyfits.open('{0}.fits'.format(filename)) as f:
+        N = sum(1 for hdu in f if hdu.name == 'SCI')
     return N
 
 
@@ -180,23 +177,120 @@ def removedir(dirname):
     return
 
 
-def skip(args, task_name, task_output):
-    """Ask the user whether we should skip a task, if the output exists"""
-    if not task_output.endswith('.fits'):
-        task_output = '{0}.fits'.format(task_output)
-    if os.path.isfile(task_output):
-        if args.force_overwrite:
-            return False
-        skip = raw_input(
-            '{1} output file {0} already exists. Replace? [y/N] '.format(
-                task_output, task_name))
-        if not skip:
-            return True
-        if skip[0].lower() != 'y':
-            return True
+def skip(args, task_name, task_output, inputs=(), tasks=(), params=None,
+         extension='.fits'):
+    """Whether a task can be skipped because its output is up to date
+
+    The output is up to date if it exists and the digest of its
+    provenance (see `provenance.digest`) matches the one recorded when
+    it was produced. Tasks are always run if `args.force_overwrite` is
+    set. Call `record` once the task has produced its output.
+
+    Outputs listed in `args.restamp` (if any) were updated in place
+    (see `reduction.fix_slits`): their provenance is recorded again
+    and the task is skipped.
+
+    Parameters
+    ----------
+    task_name : str
+        name of the reduction step
+    task_output : str
+        main output file of the step
+    inputs : list of str, optional
+        files read by the step (may be glob patterns)
+    tasks : list of IRAF tasks, optional
+        tasks whose parameters affect the output
+    params : dict, optional
+        any other arguments that affect the output
+    extension : str, optional
+        extension added to `task_output` if missing
+
+    """
+    if not task_output.endswith(extension):
+        task_output = '{0}{1}'.format(task_output, extension)
+    digest = provenance.digest(inputs, tasks, params)
+    provenance.stage(task_output, task_name, digest)
+    if not os.path.isfile(task_output) or args.force_overwrite:
+        return False
+    if task_output in getattr(args, 'restamp', ()):
+        provenance.commit(task_output, task_name)
+        print('{0} output file {1} was updated in place.'.format(
+            task_name, task_output))
+        return True
+    if provenance.matches(task_output, task_name, digest):
+        print('{0} output file {1} is up to date. Skipping.'.format(
+            task_name, task_output))
+        return True
+    print('{0} output file {1} is out of date. Running again.'.format(
+        task_name, task_output))
     return False
 
 
+def record(task_name, task_output, extension='.fits'):
+    """Record the provenance of the output of a task run after `skip`"""
+    if not task_output.endswith(extension):
+        task_output = '{0}{1}'.format(task_output, extension)
+    provenance.commit(task_output, task_name)
+    return
+
+
+def calibration_cache(args):
+    """The shared calibration cache, or None if not requested"""
+    if not getattr(args, 'calib_cache', None):
+        return None
+    budget = args.calib_cache_size
+    if budget is not None:
+        budget = budget * 1024**3
+    return CalibrationCache(args.calib_cache, budget=budget)
+
+
+def fetch_calibration(args, task_name, task_output, extension='.fits'):
+    """Link the products of a calibration step from the shared cache
+
+    Must be called after `skip`, whose digest identifies the products.
+    The provenance of `task_output` is recorded if they are found.
+
+    Returns
+    -------
+    found : bool
+        whether the products were found in the cache
+
+    """
+    cache = calibration_cache(args)
+    if cache is None:
+        return False
+    if not task_output.endswith(extension):
+        task_output = '{0}{1}'.format(task_output, extension)
+    digest = provenance.pending(task_output, task_name)
+    if digest is None or cache.fetch(task_name, digest) is None:
+        return False
+    record(task_name, task_output, extension=extension)
+    return True
+
+
+def store_calibration(args, task_name, task_output, products,
+                      extension='.fits'):
+    """Add the products of a calibration step to the shared cache
+
+    Must be called before `record`.
+
+    Parameters
+    ----------
+    products : list of str
+        files produced by the step. Missing files are ignored.
+
+    """
+    cache = calibration_cache(args)
+    if cache is None:
+        return
+    if not task_output.endswith(extension):
+        task_output = '{0}{1}'.format(task_output, extension)
+    digest = provenance.pending(task_output, task_name)
+    if digest is not None:
+        cache.store(task_name, digest, products)
+    return
+
+
 def write_offsets(inimages, output):
     xoffset = []
     yoffset = []